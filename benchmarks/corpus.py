@@ -0,0 +1,342 @@
+"""Seeded generator of synthetic Fortran source for the benchmarks.
+
+The generated code is meant to look like the legacy code FORTRESS is run on,
+not to compile: program units with declarations, deeply nested DO, IF and
+SELECT blocks, statement labels, long continuation chains, strings continued
+over several lines, preprocessor blocks, comments and tabs. The same seed
+always gives the same source, so timings of different revisions compare.
+
+  python benchmarks/corpus.py [--lines N] [--fixed] [--seed S] [OUTPUT]
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import sys
+
+FREE_FORM = 'free'
+FIXED_FORM = 'fixed'
+
+# Deepest nesting of blocks in a program unit.
+_MAX_DEPTH = 12
+
+_NAMES = ['x', 'y', 'z', 'a', 'b', 'alpha', 'beta', 'temp', 'flux', 'rho',
+          'velocity', 'pressure', 'n', 'nmax', 'i', 'j', 'k', 'ierr']
+
+_TYPES = ['integer', 'real', 'real*8', 'double precision', 'logical',
+          'character(len=80)', 'complex']
+
+_OPERATORS = ['+', '-', '*', '/', '**']
+
+_RELATIONS = ['>', '<', '==', '/=', '.gt.', '.lt.', '.eq.', '.and.', '.or.']
+
+_WORDS = ['error', 'in', 'routine', 'value', 'out', 'of', 'range', 'step',
+          'converged', 'after', 'iterations', 'warning', "don't", 'stop']
+
+
+def Generate(num_lines, form=FREE_FORM, seed=0):
+  """Return about num_lines lines of Fortran source.
+
+  Arguments:
+    num_lines : (int) The number of lines to generate at least.
+    form      : (unicode) FREE_FORM or FIXED_FORM.
+    seed      : (int) The seed of the random generator.
+
+  Returns:
+    The source code, ending in a line break.
+  """
+  if form == FIXED_FORM:
+    writer = _FixedFormWriter(seed)
+  else:
+    writer = _FreeFormWriter(seed)
+  while len(writer.lines) < num_lines:
+    writer.ProgramUnit()
+  return "\n".join(writer.lines) + "\n"
+
+
+class _Writer(object):
+  """Writes random program units; the subclasses know the source form."""
+
+  def __init__(self, seed):
+    self.rng = random.Random(seed)
+    self.lines = []
+    # number of open blocks
+    self.depth = 0
+    self.label = 100
+
+  # Source form specific parts
+
+  def Line(self, code, label=None, comment=None):
+    raise NotImplementedError
+
+  def Continued(self, parts):
+    raise NotImplementedError
+
+  def Comment(self, text):
+    raise NotImplementedError
+
+  def Keyword(self, word):
+    return word
+
+  # Common structure
+
+  def Open(self, code, label=None):
+    """Write the first line of a block."""
+    self.Line(code, label=label)
+    self.depth += 1
+
+  def Close(self, code, label=None):
+    """Write the last line of a block."""
+    self.depth -= 1
+    self.Line(code, label=label)
+
+  def Middle(self, code):
+    """Write a line that divides a block, like ELSE."""
+    self.depth -= 1
+    self.Line(code)
+    self.depth += 1
+
+  def ProgramUnit(self):
+    rng = self.rng
+    kind = rng.choice(['subroutine', 'function', 'program', 'module'])
+    name = 'unit%d' % len(self.lines)
+    if kind == 'module':
+      self.Open(self.Keyword('module ') + name)
+      self.Declarations()
+      self.Middle(self.Keyword('contains'))
+      for _ in range(rng.randint(1, 3)):
+        self.Procedure('subroutine', name + '_%d' % rng.randint(0, 99))
+      self.Close(self.Keyword('end module ') + name)
+    elif kind == 'program':
+      self.Open(self.Keyword('program ') + name)
+      self.Body()
+      self.Close(self.Keyword('end program ') + name)
+    else:
+      self.Procedure(kind, name)
+    self.lines.append("")
+
+  def Procedure(self, kind, name):
+    args = ', '.join(self.rng.sample(_NAMES, self.rng.randint(0, 4)))
+    self.Open(self.Keyword(kind + ' ') + '%s(%s)' % (name, args))
+    self.Body()
+    self.Close(self.Keyword('end ' + kind))
+
+  def Declarations(self):
+    for _ in range(self.rng.randint(1, 6)):
+      self.Line(self.Keyword(self.rng.choice(_TYPES)) + ' :: '
+                + ', '.join(self.rng.sample(_NAMES, 3)))
+
+  def Body(self):
+    self.Declarations()
+    for _ in range(self.rng.randint(5, 40)):
+      self.Statement()
+
+  def Statement(self):
+    rng = self.rng
+    choice = rng.random()
+    if choice < 0.15 and self.depth < _MAX_DEPTH:
+      self.Block()
+    elif choice < 0.25:
+      self.Comment(self.Sentence())
+    elif choice < 0.32:
+      self.ContinuationChain()
+    elif choice < 0.37:
+      self.StringContinuation()
+    elif choice < 0.40:
+      self.PreprocessorBlock()
+    elif choice < 0.45:
+      self.Line(self.Keyword('continue'), label=self.NextLabel())
+    elif choice < 0.50:
+      self.lines.append("")
+    else:
+      self.Line(self.Assignment(),
+                comment=self.Sentence() if rng.random() < 0.2 else None)
+
+  def Block(self):
+    rng = self.rng
+    kind = rng.choice(['do', 'labeled do', 'if', 'select', 'where'])
+    if kind == 'do':
+      self.Open(self.Keyword('do ') + 'i = 1, ' + rng.choice(_NAMES))
+      self.Statements()
+      self.Close(self.Keyword(rng.choice(['end do', 'enddo'])))
+    elif kind == 'labeled do':
+      label = self.NextLabel()
+      self.Open(self.Keyword('do %d ' % label) + 'j = 1, n')
+      self.Statements()
+      self.Close(self.Keyword('continue'), label=label)
+    elif kind == 'if':
+      self.Open(self.Keyword('if') + ' (%s) ' % self.Condition()
+                + self.Keyword('then'))
+      self.Statements()
+      if rng.random() < 0.4:
+        self.Middle(self.Keyword('else'))
+        self.Statements()
+      self.Close(self.Keyword(rng.choice(['end if', 'endif'])))
+    elif kind == 'select':
+      self.Open(self.Keyword('select case') + ' (%s)' % rng.choice(_NAMES))
+      for value in range(rng.randint(1, 3)):
+        self.Middle(self.Keyword('case') + ' (%d)' % value)
+        self.Statements()
+      self.Close(self.Keyword('end select'))
+    else:
+      self.Open(self.Keyword('where') + ' (%s > 0)' % rng.choice(_NAMES))
+      self.Statements()
+      self.Close(self.Keyword('end where'))
+
+  def Statements(self):
+    for _ in range(self.rng.randint(1, 6)):
+      self.Statement()
+
+  def ContinuationChain(self):
+    rng = self.rng
+    parts = [self.Keyword('call ') + 'solve(' + rng.choice(_NAMES) + ',']
+    for _ in range(rng.randint(2, 12)):
+      parts.append(self.Expression() + ',')
+    parts.append(rng.choice(_NAMES) + ')')
+    self.Continued(parts)
+
+  def StringContinuation(self):
+    words = [self.Sentence() for _ in range(self.rng.randint(2, 5))]
+    self.StringLines(self.Keyword('print') + ' *, ', words)
+
+  def PreprocessorBlock(self):
+    self.lines.append('#ifdef USE_MPI')
+    self.Line(self.Keyword('call ') + 'mpi_barrier(comm, ierr)')
+    if self.rng.random() < 0.5:
+      self.lines.append('#else')
+      self.Statements()
+    self.lines.append('#endif')
+
+  def Assignment(self):
+    rng = self.rng
+    target = rng.choice(_NAMES)
+    if rng.random() < 0.3:
+      target += '(i, j)'
+    return '%s = %s' % (target, self.Expression())
+
+  def Expression(self):
+    rng = self.rng
+    terms = [rng.choice(_NAMES + ['1.0d0', '2', '0.5e-3'])
+             for _ in range(rng.randint(1, 4))]
+    expression = terms[0]
+    for term in terms[1:]:
+      expression += rng.choice(['', ' ']) + rng.choice(_OPERATORS) \
+        + rng.choice(['', ' ']) + term
+    if rng.random() < 0.2:
+      expression = 'sqrt(%s)' % expression
+    return expression
+
+  def Condition(self):
+    rng = self.rng
+    return '%s %s %s' % (rng.choice(_NAMES), rng.choice(_RELATIONS),
+                         rng.choice(_NAMES))
+
+  def Sentence(self):
+    return ' '.join(self.rng.choice(_WORDS)
+                    for _ in range(self.rng.randint(2, 8)))
+
+  def NextLabel(self):
+    self.label += 10
+    if self.label > 99999:
+      self.label = 100
+    return self.label
+
+
+class _FreeFormWriter(_Writer):
+
+  def Indentation(self):
+    indentation = '  ' * self.depth
+    if self.rng.random() < 0.1:
+      indentation = '\t' + indentation
+    return indentation
+
+  def Line(self, code, label=None, comment=None):
+    line = self.Indentation() + code
+    if label is not None:
+      line = '%d ' % label + line
+    if comment is not None:
+      line += '  ! ' + comment
+    if self.rng.random() < 0.05:
+      line += '  '
+    self.lines.append(line)
+
+  def Continued(self, parts):
+    indentation = self.Indentation()
+    tight = self.rng.random() < 0.3
+    for index, part in enumerate(parts):
+      line = indentation + ('&' if tight else '& ') if index else indentation
+      line += part
+      if index < len(parts) - 1:
+        line += '&' if tight else ' &'
+      self.lines.append(line)
+
+  def StringLines(self, code, words):
+    indentation = self.Indentation()
+    line = indentation + code + '"' + words[0]
+    for word in words[1:]:
+      self.lines.append(line + ' &')
+      line = '&' + word
+    self.lines.append(line + '"')
+
+  def Comment(self, text):
+    self.lines.append(self.Indentation() + '! ' + text)
+
+
+class _FixedFormWriter(_Writer):
+
+  def Keyword(self, word):
+    return word.upper()
+
+  def Line(self, code, label=None, comment=None):
+    if label is not None:
+      prefix = '%-5d ' % label
+    elif self.rng.random() < 0.1:
+      prefix = '\t'
+    else:
+      prefix = '      '
+    line = prefix + '  ' * self.depth + code
+    if comment is not None:
+      line += ' ! ' + comment
+    self.lines.append(line)
+
+  def Continued(self, parts):
+    self.Line(parts[0])
+    for part in parts[1:]:
+      mark = self.rng.choice('&+$1')
+      self.lines.append('     ' + mark + '  ' + '  ' * self.depth + part)
+
+  def StringLines(self, code, words):
+    self.Line(code + "'" + words[0])
+    for word in words[1:-1]:
+      self.lines.append('     & ' + word)
+    self.lines.append('     & ' + words[-1] + "'")
+
+  def Comment(self, text):
+    self.lines.append(self.rng.choice('Cc*!') + '     ' + text.upper())
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('output', nargs='?',
+                      help='file to write to (default: stdout)')
+  parser.add_argument('--lines', type=int, default=10000,
+                      help='number of lines to generate at least')
+  parser.add_argument('--fixed', action='store_const', dest='form',
+                      const=FIXED_FORM, default=FREE_FORM,
+                      help='generate fixed-form instead of free-form source')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='seed of the random generator')
+  args = parser.parse_args(argv[1:])
+
+  source = Generate(args.lines, form=args.form, seed=args.seed)
+  if args.output:
+    with open(args.output, 'w') as fd:
+      fd.write(source)
+  else:
+    sys.stdout.write(source)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,84 @@
+"""Memory benchmark: bytes held per source line by the Reformatter.
+
+Generates a large synthetic Fortran source (see corpus.py), runs the
+Reformatter over it in batch mode (where all lines are held at once) and
+reports the memory that is still allocated afterwards, per line of source:
+
+  python benchmarks/memory.py [--lines N] [--style STYLE] [--fixed]
+
+Run it on two revisions to compare their line representation.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import corpus
+
+from fortress.lib import fortress_style
+from fortress.lib import reformatter
+
+_STYLES = {
+    'fortran2003': fortress_style.CreateFortran2003Style,
+    'strict': fortress_style.CreateStrictStyle,
+}
+
+
+def MeasureBytesPerLine(source, style):
+  """Return the bytes held per line after reformatting source.
+
+  Arguments:
+    source : (unicode) The source code.
+    style  : (dict) The style to format with.
+
+  Returns:
+    A tuple of the bytes per line held after tokenizing and after reformatting.
+  """
+  fortress_style.SetGlobalStyle(style)
+  num_lines = source.count("\n")
+
+  gc.collect()
+  tracemalloc.start()
+  try:
+    base = tracemalloc.get_traced_memory()[0]
+    reform = reformatter.Reformatter(source)
+    gc.collect()
+    tokenized = tracemalloc.get_traced_memory()[0] - base
+    reform.reformat()
+    gc.collect()
+    reformatted = tracemalloc.get_traced_memory()[0] - base
+  finally:
+    tracemalloc.stop()
+  return float(tokenized) / num_lines, float(reformatted) / num_lines
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument('--lines', type=int, default=200000,
+                      help='number of source lines to generate')
+  parser.add_argument('--style', default='strict', choices=sorted(_STYLES),
+                      help='style to format with (default: strict)')
+  parser.add_argument('--fixed', action='store_true',
+                      help='generate fixed-form instead of free-form source')
+  args = parser.parse_args(argv[1:])
+
+  source = corpus.Generate(args.lines,
+                           form=corpus.FIXED_FORM if args.fixed
+                           else corpus.FREE_FORM)
+  tokenized, reformatted = MeasureBytesPerLine(
+      source, _STYLES[args.style]())
+  print("lines:              %d" % args.lines)
+  print("bytes/line (lexed): %.1f" % tokenized)
+  print("bytes/line (final): %.1f" % reformatted)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
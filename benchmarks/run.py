@@ -0,0 +1,325 @@
+"""Time the stages of reformatting and compare against a baseline.
+
+Every case formats a synthetic source (see corpus.py) with one style and
+records the best time of each stage over a few runs, plus the peak memory
+traced while formatting it once more:
+
+  tokenize              Reformatter(), without identifying continuations
+  identifyContinuations Reformatter.identifyContinuations()
+  reformat              Reformatter.reformat(), without reindenting
+  fixIndentation        Reformatter.fixIndentation(), if the style reindents
+  generateCodeLines     Reformatter.generateCodeLines(), which marks long lines
+                        if the style adds remarks
+  diff                  fortress_api._GetUnifiedDiff()
+
+The batch cases split the source into snippets of a few lines, like the hunks
+of a diff, and time formatting them all by FormatCodeBatch() against calling
+FormatCode() for each; the batch is printed with its margin over the loop:
+
+  formatCode            fortress_api.FormatCode() for every snippet
+  formatCodeBatch       fortress_api.FormatCodeBatch() of all snippets
+
+Both format every line alike, so the batch only saves what FormatCode() does
+once per call; with snippets of 5 lines its margin is some 5 to 15%, as the
+form of every snippet is still detected on its own.
+
+The results are written as JSON. Given a baseline written the same way, every
+stage and the peak memory are compared against it and the script fails if any
+of them got slower or bigger by more than the threshold:
+
+  python benchmarks/run.py --output baseline.json
+  ... change things ...
+  python benchmarks/run.py --baseline baseline.json [--threshold 0.1]
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import gc
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import corpus
+
+import fortress
+from fortress.lib import fortress_api
+from fortress.lib import fortress_style
+from fortress.lib import reformatter
+
+STAGES = ['tokenize', 'identifyContinuations', 'reformat', 'fixIndentation',
+          'generateCodeLines', 'diff']
+
+# Timings below this many seconds are too noisy to call a regression.
+MIN_SECONDS = 0.005
+
+
+def _FixedToFreeStyle():
+  style = fortress_style.CreateStrictStyle()
+  style.update(CONVERT_FIXED_TO_FREE=True, ADD_REMARKS=True)
+  return style
+
+
+# name: (source form, style factory)
+CASES = collections.OrderedDict([
+    ('free-fortran2003', (corpus.FREE_FORM,
+                          fortress_style.CreateFortran2003Style)),
+    ('free-strict', (corpus.FREE_FORM, fortress_style.CreateStrictStyle)),
+    ('fixed-to-free', (corpus.FIXED_FORM, _FixedToFreeStyle)),
+])
+
+BATCH_STAGES = ['formatCode', 'formatCodeBatch']
+
+# name: (source form, style factory, lines per snippet)
+BATCH_CASES = collections.OrderedDict([
+    ('batch-free-strict', (corpus.FREE_FORM,
+                           fortress_style.CreateStrictStyle, 5)),
+])
+
+
+def RunStages(source, style):
+  """Run the stages of reformatting source once.
+
+  Arguments:
+    source : (unicode) The source code.
+    style  : (dict) The style to format with.
+
+  Returns:
+    An OrderedDict of the seconds each stage took.
+  """
+  clock = timeit.default_timer
+  seconds = collections.OrderedDict()
+
+  # reformat() reindents itself, which is timed on its own here.
+  plan = reformatter.CompileStyle(style)
+
+  start = clock()
+  reform = reformatter.Reformatter(plan=plan._replace(reindent=False))
+  # resolve the form as Reformatter.__init__() does
+  sourceLines = reform.detectForm(reformatter.SplitLines(source))
+  reform.codeLines = list(reform.iterTokenize(sourceLines))
+  seconds['tokenize'] = clock() - start
+
+  start = clock()
+  reform.identifyContinuations()
+  seconds['identifyContinuations'] = clock() - start
+
+  start = clock()
+  reform.reformat()
+  seconds['reformat'] = clock() - start
+
+  reform.plan = plan
+  start = clock()
+  if plan.reindent:
+    reform.fixIndentation(plan.indentWidth, plan.contiIndentWidth)
+  seconds['fixIndentation'] = clock() - start
+
+  start = clock()
+  reform.generateCodeLines()
+  seconds['generateCodeLines'] = clock() - start
+
+  start = clock()
+  fortress_api._GetUnifiedDiff(reform)
+  seconds['diff'] = clock() - start
+  return seconds
+
+
+def RunBatch(snippets, style):
+  """Format snippets one at a time and as a batch.
+
+  Arguments:
+    snippets : (list of unicode) The pieces of code.
+    style    : (dict) The style to format with.
+
+  Returns:
+    An OrderedDict of the seconds each way took.
+  """
+  clock = timeit.default_timer
+  seconds = collections.OrderedDict()
+
+  # FormatCode() formats with the global style.
+  fortress_style.SetGlobalStyle(style)
+  start = clock()
+  for snippet in snippets:
+    fortress_api.FormatCode(snippet)
+  seconds['formatCode'] = clock() - start
+
+  start = clock()
+  fortress_api.FormatCodeBatch(snippets, style)
+  seconds['formatCodeBatch'] = clock() - start
+  return seconds
+
+
+def MeasurePeakMemory(run, source, style):
+  """Return the peak of memory traced while run formats source, in bytes."""
+  gc.collect()
+  tracemalloc.start()
+  try:
+    run(source, style)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+def _Snippets(source, size):
+  """Split source into pieces of size lines."""
+  lines = source.splitlines(True)
+  return [''.join(lines[start:start + size])
+          for start in range(0, len(lines), size)]
+
+
+def RunCase(name, num_lines, seed, repeat):
+  """Run one of CASES or BATCH_CASES; returns its results as a dict."""
+  if name in BATCH_CASES:
+    form, createStyle, size = BATCH_CASES[name]
+    run, stages = RunBatch, BATCH_STAGES
+  else:
+    form, createStyle = CASES[name]
+    run, stages = RunStages, STAGES
+  source = corpus.Generate(num_lines, form=form, seed=seed)
+  lines = source.count("\n")
+  if run is RunBatch:
+    source = _Snippets(source, size)
+  style = createStyle()
+
+  best = collections.OrderedDict((stage, None) for stage in stages)
+  for _ in range(repeat):
+    gc.collect()
+    for stage, seconds in run(source, style).items():
+      if best[stage] is None or seconds < best[stage]:
+        best[stage] = seconds
+  if run is RunStages:
+    best['total'] = sum(best[stage] for stage in stages)
+
+  return collections.OrderedDict([
+      ('lines', lines),
+      ('seconds', best),
+      ('peak_memory', MeasurePeakMemory(run, source, style)),
+  ])
+
+
+def Compare(results, baseline, threshold, min_seconds=MIN_SECONDS):
+  """Compare results against a baseline.
+
+  Arguments:
+    results     : (dict) The results as returned by main().
+    baseline    : (dict) Earlier results.
+    threshold   : (float) The allowed relative increase, e.g. 0.1 for 10%.
+    min_seconds : (float) Timings below this are never a regression.
+
+  Returns:
+    A list of (case, measure, baseline value, value, regressed) tuples for
+    the measures found in both, for cases of the same source.
+  """
+  rows = []
+  for name, case in results['cases'].items():
+    base = baseline.get('cases', {}).get(name)
+    if base is None or base.get('lines') != case['lines']:
+      continue
+    for stage, seconds in case['seconds'].items():
+      baseSeconds = base['seconds'].get(stage)
+      if baseSeconds is None:
+        continue
+      regressed = seconds > baseSeconds * (1 + threshold) \
+        and seconds - baseSeconds > min_seconds
+      rows.append((name, stage, baseSeconds, seconds, regressed))
+    if 'peak_memory' in base:
+      regressed = case['peak_memory'] > base['peak_memory'] * (1 + threshold)
+      rows.append((name, 'peak_memory', base['peak_memory'],
+                   case['peak_memory'], regressed))
+  return rows
+
+
+def _Format(measure, value):
+  if measure == 'peak_memory':
+    return '%.1f MiB' % (value / 1024.0 / 1024.0)
+  return '%.4f s' % value
+
+
+def _PrintResults(results):
+  for name, case in results['cases'].items():
+    print('%s (%d lines)' % (name, case['lines']))
+    for stage, seconds in case['seconds'].items():
+      print('  %-22s %12s' % (stage, _Format(stage, seconds)))
+    print('  %-22s %12s' % ('peak_memory',
+                            _Format('peak_memory', case['peak_memory'])))
+    if name in BATCH_CASES:
+      seconds = case['seconds']
+      print('  %-22s %+11.1f%%' % (
+          'batch margin',
+          (1 - seconds['formatCodeBatch'] / seconds['formatCode']) * 100))
+
+
+def _PrintComparison(rows):
+  for name, measure, base, value, regressed in rows:
+    change = (float(value) / base - 1) * 100 if base else 0.0
+    print('%-18s %-22s %12s %12s %+7.1f%%%s' % (
+        name, measure, _Format(measure, base), _Format(measure, value), change,
+        '  REGRESSION' if regressed else ''))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+      description=__doc__.split('\n')[0],
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--lines', type=int, default=20000,
+                      help='number of lines of each source (default: 20000)')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='seed of the source generator')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of runs to take the best time of')
+  parser.add_argument('--case', action='append',
+                      choices=list(CASES) + list(BATCH_CASES),
+                      help='case to run; may be repeated (default: all)')
+  parser.add_argument('-o', '--output', metavar='FILE',
+                      help='write the results as JSON to FILE')
+  parser.add_argument('-b', '--baseline', metavar='FILE',
+                      help='compare the results against FILE')
+  parser.add_argument('--threshold', type=float, default=0.1,
+                      help='allowed relative slowdown against the baseline '
+                      '(default: 0.1)')
+  args = parser.parse_args(argv[1:])
+
+  results = collections.OrderedDict([
+      ('fortress', fortress.__version__),
+      ('python', platform.python_version()),
+      ('seed', args.seed),
+      ('repeat', args.repeat),
+      ('cases', collections.OrderedDict()),
+  ])
+  for name in args.case or list(CASES) + list(BATCH_CASES):
+    results['cases'][name] = RunCase(name, args.lines, args.seed, args.repeat)
+
+  if args.output:
+    with open(args.output, 'w') as fd:
+      json.dump(results, fd, indent=2)
+      fd.write('\n')
+
+  if not args.baseline:
+    _PrintResults(results)
+    return 0
+
+  with open(args.baseline) as fd:
+    baseline = json.load(fd)
+  if baseline.get('seed') != args.seed:
+    print('warning: baseline was generated with seed %s'
+          % baseline.get('seed'), file=sys.stderr)
+  rows = Compare(results, baseline, args.threshold)
+  _PrintComparison(rows)
+  regressions = [row for row in rows if row[-1]]
+  if regressions:
+    print('%d regression(s) above %.0f%%'
+          % (len(regressions), args.threshold * 100), file=sys.stderr)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
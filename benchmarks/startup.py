@@ -0,0 +1,127 @@
+"""Startup benchmark: time spent importing modules by a 'fortress' call.
+
+Formats a small file the way an editor-on-save or pre-commit hook would, in
+a fresh interpreter started with 'python -X importtime', and adds up the
+import times it reports for the modules that a bare interpreter does not
+import. The best of a few runs is compared against a budget in milliseconds,
+and the run fails if a module that only some paths need is imported by a
+plain formatting run:
+
+  python benchmarks/startup.py [--budget MS] [--repeat N] [--top N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Modules a plain formatting run must not import.
+FORBIDDEN = ['lib2to3', 'difflib', 'logging', 'textwrap', 'tempfile',
+             'socket', 'fortress.lib.fortress_linter',
+             'fortress.lib.format_client', 'fortress.lib.format_server']
+
+# Milliseconds of imports allowed; generous, as it depends on the machine.
+DEFAULT_BUDGET = 100.0
+
+_SOURCE = """\
+program startup
+if(n>0)then
+x=1
+endif
+end program
+"""
+
+# 'import time: <self us> | <cumulative us> | <indented name>'
+_IMPORT_TIME = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \| (\s*)(\S+)')
+
+
+def MeasureImports(args, ignore=()):
+  """Run python with args in a fresh interpreter, tracing its imports.
+
+  Arguments:
+    args   : (list of str) The arguments to the interpreter.
+    ignore : (container of str) Modules whose imports are not counted.
+
+  Returns:
+    A tuple of the total seconds spent importing modules imported directly,
+    not by other modules, and a dict of the cumulative seconds of every
+    module imported.
+  """
+  env = dict(os.environ, PYTHONPATH=_ROOT)
+  process = subprocess.Popen([sys.executable, '-X', 'importtime'] + args,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=env)
+  _, stderr = process.communicate()
+  total = 0.0
+  modules = {}
+  for line in stderr.decode('utf-8', 'replace').splitlines():
+    match = _IMPORT_TIME.match(line)
+    if not match:
+      continue
+    name = match.group(4)
+    cumulative = int(match.group(2)) / 1e6
+    modules[name] = cumulative
+    if not match.group(3) and name not in ignore:
+      total += cumulative
+  return total, modules
+
+
+def ForbiddenImports(modules):
+  """Return the names of the FORBIDDEN modules (or their submodules) found."""
+  return sorted(name for name in modules
+                if any(name == forbidden or name.startswith(forbidden + '.')
+                       for forbidden in FORBIDDEN))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                      help='allowed milliseconds of imports (default: %.0f)'
+                      % DEFAULT_BUDGET)
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='number of runs to take the best time of')
+  parser.add_argument('--top', type=int, default=10,
+                      help='number of slowest fortress modules to list')
+  args = parser.parse_args(argv[1:])
+
+  fd, filename = tempfile.mkstemp(suffix='.f90')
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      fp.write(_SOURCE)
+    _, bare = MeasureImports(['-c', 'pass'])
+    best = None
+    for _ in range(args.repeat):
+      total, modules = MeasureImports(['-m', 'fortress', '--no-cache',
+                                       filename], ignore=bare)
+      if best is None or total < best[0]:
+        best = total, modules
+  finally:
+    os.remove(filename)
+
+  total, modules = best
+  print('imports:  %8.1f ms (budget %.1f ms)' % (total * 1e3, args.budget))
+  own = sorted(((seconds, name) for name, seconds in modules.items()
+                if name.startswith('fortress')), reverse=True)
+  for seconds, name in own[:args.top]:
+    print('  %-32s %8.1f ms' % (name, seconds * 1e3))
+
+  status = 0
+  forbidden = ForbiddenImports(modules)
+  if forbidden:
+    print('imported but not needed: %s' % ', '.join(forbidden),
+          file=sys.stderr)
+    status = 1
+  if total * 1e3 > args.budget:
+    print('imports take longer than the budget', file=sys.stderr)
+    status = 1
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -6,16 +6,11 @@ Many ideas are borrowed from Google's Python Code Formatter YAPF.
 
 If no input file is specified, FORTRESS reads the code from STDIN.
 """
-import argparse
-import logging
+import collections
+import io
+import itertools
 import os
 import sys
-import textwrap
-
-from fortress.lib import fortress_api
-from fortress.lib import file_resources
-from fortress.lib import py3compat
-from fortress.lib import fortress_style
 
 __version__ = '0.2'
 __authors__ = [
@@ -23,6 +18,15 @@ __authors__ = [
     "Florian Zwicke <z@zwicke.org>"
     ]
 
+_DESCRIPTION = """\
+FORTRESS is a formatter/modernizer of legacy FORTRAN code.
+----------------------------------------------------------
+
+  By default it prints the reformatted code
+  to STDOUT. For other options see below.
+"""
+
+
 def main(argv):
   """Main program.
 
@@ -34,14 +38,19 @@ def main(argv):
   Returns:
     0 if there were no changes, non-zero otherwise.
   """
-  parser = argparse.ArgumentParser(formatter_class = argparse.RawDescriptionHelpFormatter,
-                                   description = textwrap.dedent('''\
-                                   FORTRESS is a formatter/modernizer of legacy FORTRAN code.
-                                   ----------------------------------------------------------
+  if argv[1:2] == ['merge-reports']:
+    return mergeReports(argv[2:])
+
+  # Not imported with the package, so that 'python -m' can run the client
+  # without them, and only the modules a run needs are imported.
+  import argparse
 
-                                     By default it prints the reformatted code
-                                     to STDOUT. For other options see below.
-                                   '''))
+  from fortress.lib import fortress_metrics
+  from fortress.lib import fortress_style
+  from fortress.lib import result_cache
+
+  parser = argparse.ArgumentParser(formatter_class = argparse.RawDescriptionHelpFormatter,
+                                   description = _DESCRIPTION)
 
 # TODO: line-wrapping instead of single-string
 # Arguments:
@@ -50,7 +59,7 @@ def main(argv):
                       action='store_true',
                       help='show version')
 
-# Either diff or in-place
+# Either diff, in-place or check
   diff_inplace_group = parser.add_mutually_exclusive_group()
   diff_inplace_group.add_argument('-d',
                                   '--diff',
@@ -60,6 +69,20 @@ def main(argv):
                                   '--in-place',
                                   action='store_true',
                                   help='make changes to files in place')
+  diff_inplace_group.add_argument('--check',
+                                  action='store_true',
+                                  help='only check whether files would '
+                                       'change, stopping at the first '
+                                       'change in each file')
+
+  parser.add_argument('--fail-fast',
+                      action='store_true',
+                      help='with --check, stop at the first file that would '
+                           'change')
+  parser.add_argument('--list-changed',
+                      action='store_true',
+                      help='with --check, print the path of every file that '
+                           'would change')
 
 # Either recursive or linespecific (single file)
   lines_recursive_group = parser.add_mutually_exclusive_group()
@@ -74,6 +97,41 @@ def main(argv):
                                      default=None,
                                      help='range of lines to reformat; 1-based')
 
+  parser.add_argument('--changed-since',
+                      metavar='REF',
+                      default=None,
+                      help='format the files changed against the git commit '
+                           'REF instead of the files given, which only limit '
+                           'them')
+  parser.add_argument('--staged',
+                      action='store_true',
+                      help='format the files staged in the git index, '
+                           'against HEAD or the --changed-since REF')
+  parser.add_argument('--changed-lines',
+                      action='store_true',
+                      help='with --changed-since or --staged, format only '
+                           'the lines that changed')
+
+  parser.add_argument('--files-from',
+                      metavar='FILE',
+                      default=None,
+                      help='also format the files listed in FILE, one per '
+                           'line or separated by NUL characters; "-" reads '
+                           'the list from stdin')
+  parser.add_argument('--shard',
+                      metavar='I/N',
+                      type=getShard,
+                      default=None,
+                      help='format only the I-th of N shards of the files, '
+                           'of about the same number of bytes each; see '
+                           '"fortress merge-reports -h"')
+  parser.add_argument('--report',
+                      metavar='FILE',
+                      default=None,
+                      help='write the files changed, their diffs with '
+                           '--diff, and the exit status as JSON to FILE, to '
+                           'be merged by "fortress merge-reports"')
+
   parser.add_argument('-e',
                       '--exclude',
                       metavar='PATTERN',
@@ -92,10 +150,82 @@ def main(argv):
                       action='store_true',
                       help='applies all available formatting options / style.ini will be ignored')
 
+  parser.add_argument('--form',
+                      choices=['auto', 'fixed', 'free'],
+                      default=None,
+                      help='source form of the files; by default detected '
+                           'per file, unless the style sets SOURCE_FORM')
+
   parser.add_argument('-t',
                       '--lint',
                       action='store_true',
-                      help='lint files')
+                      help='lint files with the compiler instead of '
+                           'formatting them')
+  parser.add_argument('--compiler',
+                      metavar='PATH',
+                      default=None,
+                      help='compiler to lint with (default: gfortran)')
+  parser.add_argument('--lint-flags',
+                      metavar='FLAGS',
+                      default=None,
+                      help='flags to pass to the compiler when linting '
+                           '(default: "-fsyntax-only -Wall -Wextra")')
+  parser.add_argument('--lint-format',
+                      choices=['text', 'json', 'jsonl'],
+                      default='text',
+                      help='print the diagnostics as lines like those of '
+                           'the compiler, as a JSON list, or as JSON lines')
+
+  parser.add_argument('-j',
+                      '--jobs',
+                      metavar='N',
+                      type=getJobs,
+                      default=1,
+                      help='number of files to format or lint in parallel, '
+                           'or "auto" for one per CPU')
+
+  cache_group = parser.add_mutually_exclusive_group()
+  cache_group.add_argument('--no-cache',
+                           action='store_true',
+                           help='do not skip files that are known to be '
+                                'formatted already')
+  cache_group.add_argument('--cache-dir',
+                           metavar='DIR',
+                           default=None,
+                           help='directory of the cache of formatted files '
+                                'and diagnostics (default: %s)'
+                                % result_cache.DefaultCacheDir())
+
+  parser.add_argument('--stats',
+                      metavar='FILE',
+                      nargs='?',
+                      const='-',
+                      default=None,
+                      help='write the sizes, timings per stage and peak memory '
+                           'of every file as JSON lines to FILE (default: '
+                           'stderr), followed by a summary of the run')
+  parser.add_argument('--profile',
+                      metavar='FILE',
+                      default=None,
+                      help='write a cProfile profile of the run to FILE, to '
+                           'be read with pstats')
+
+  parser.add_argument('--serve',
+                      action='store_true',
+                      help='serve format requests of fortress-client on a '
+                           'socket instead of formatting files')
+  parser.add_argument('--socket',
+                      metavar='PATH',
+                      default=None,
+                      help='socket to serve on (default: fortress-UID.sock '
+                           'in $XDG_RUNTIME_DIR, or fortress-UID/server.sock '
+                           'in the temporary directory)')
+  parser.add_argument('--idle-timeout',
+                      metavar='SECONDS',
+                      type=float,
+                      default=None,
+                      help='stop serving after SECONDS without requests '
+                           '(default: 15 minutes)')
 
   parser.add_argument('files', nargs='*')
 
@@ -107,12 +237,49 @@ def main(argv):
     print('fortress {}'.format(__version__))
     return 0
 
+# --serve: Daemon for fortress-client
+  if args.serve:
+    if args.files:
+      parser.error('cannot format files with --serve')
+    from fortress.lib import format_server
+    if args.idle_timeout is None:
+      args.idle_timeout = format_server.DEFAULT_IDLE_TIMEOUT
+    format_server.Serve(args.socket, args.idle_timeout)
+    return 0
+
 # -l: Range of lines (begging w/ 1)
   if args.lines and len(args.files) > 1:
     parser.error('cannot use -l/--lines with more than one file')
 
   lines = getLines(args.lines) if args.lines is not None else None
 
+  if (args.fail_fast or args.list_changed) and not args.check:
+    parser.error('--fail-fast and --list-changed need --check')
+
+  from_git = bool(args.changed_since or args.staged)
+  if args.changed_lines and not from_git:
+    parser.error('--changed-lines needs --changed-since or --staged')
+  if args.changed_lines and lines:
+    parser.error('cannot use -l/--lines with --changed-lines')
+  if args.files_from and from_git:
+    parser.error('cannot use --files-from with --changed-since or --staged')
+
+  has_files = bool(args.files or args.files_from or from_git)
+  if (args.shard or args.report) and not has_files:
+    parser.error('cannot use --shard or --report when reading from stdin')
+  if (args.shard or args.report) and args.lint:
+    parser.error('cannot use --shard or --report with --lint')
+
+  if args.lint:
+    if args.in_place or args.diff or args.check:
+      parser.error('cannot use --in-place, --diff or --check with --lint')
+    if lines or args.changed_lines:
+      parser.error('cannot use -l/--lines or --changed-lines with --lint')
+    if not has_files:
+      parser.error('cannot lint code read from stdin')
+  elif args.compiler or args.lint_flags:
+    parser.error('--compiler and --lint-flags need --lint')
+
 # -s: Style file provided
   if args.strict:
     fortress_style.SetGlobalStyle(fortress_style.CreateStrictStyle())
@@ -121,42 +288,125 @@ def main(argv):
       fortress_style.SetGlobalStyle(fortress_style.CreateStyleFromConfig(args.style))
     else:
       fortress_style.SetGlobalStyle(fortress_style.CreateFortran2003Style())
+  if args.form:
+    style = fortress_style.GetGlobalStyle()
+    style['SOURCE_FORM'] = args.form
+    fortress_style.SetGlobalStyle(style)
 
 
+# --stats, --profile: Record the run
+  metrics = None
+  if args.stats or args.profile:
+    metrics = fortress_metrics.Metrics(trace_memory=bool(args.stats),
+                                       profile=bool(args.profile))
+    metrics.StartProfile()
+
 # Lines case:
-  if not args.files:
+  if not has_files:
     if args.in_place or args.diff:
       parser.error('cannot use --in-place or --diff flags when reading '
                    'from stdin')
-    original_source = []
-
-    while True:
-      try:
-        # Use 'raw_input' instead of 'sys.stdin.read', because otherwise the
-        # user will need to hit 'Ctrl-D' more than once if they're inputting
-        # the program by hand.
-        original_source.append(py3compat.raw_input())
-      except EOFError:
-        break
-
-    reformatted_source, changed = fortress_api.FormatCode(
-          py3compat.unicode('\n'.join(original_source) + '\n'),
-          filename='<stdin>',
-          lines=lines)
-
-    # STDOUT:
-    sys.stdout.write(reformatted_source)
-
-    return 2 if changed else 0
+    from fortress.lib import fortress_api
+    # Read in large chunks rather than line by line, and only split at '\n'
+    # like the file code path does.
+    in_fp = io.TextIOWrapper(sys.stdin.buffer,
+                             encoding=sys.stdin.encoding,
+                             errors=sys.stdin.errors,
+                             newline='\n')
+    try:
+      if args.check:
+        changed = fortress_api.CheckStream(in_fp, lines=lines)
+        if changed and args.list_changed:
+          print('<stdin>')
+      else:
+        changed = fortress_api.FormatStream(in_fp, sys.stdout, lines=lines,
+                                            filename='<stdin>',
+                                            metrics=metrics)
+    finally:
+      in_fp.detach()
 
 # Recursive or file list case:
-  files = file_resources.GetCommandLineFiles(args.files,
-                                             args.recursive,
-                                             args.exclude)
-  changed = FormatFiles(files,
-                        lines,
-                        in_place=args.in_place,
-                        print_diff=args.diff)
+  else:
+    from fortress.lib import file_resources
+    if from_git:
+      from fortress.lib import git_changes
+      try:
+        changes = git_changes.ChangedLines(args.changed_since, args.staged,
+                                           args.files)
+      except git_changes.GitError as err:
+        sys.stderr.write('fortress: %s\n' % err)
+        return 1
+      files = list(file_resources.FilterFortranFiles(changes, args.exclude))
+      if args.changed_lines:
+        # Files with lines removed only are left as they are.
+        files = [filename for filename in files if changes[filename]]
+        lines = dict((filename, changes[filename]) for filename in files)
+    else:
+      # The files are formatted as they are found, unless the time it takes
+      # to find them is recorded.
+      files = file_resources.IterCommandLineFiles(args.files,
+                                                  args.recursive,
+                                                  args.exclude)
+    listed = None
+    if args.files_from:
+      try:
+        listed = (sys.stdin.buffer if args.files_from == '-'
+                  else open(args.files_from, 'rb'))
+      except IOError as err:
+        sys.stderr.write('fortress: %s\n' % err)
+        return 1
+      files = itertools.chain(files,
+                              file_resources.IterFilesFrom(listed,
+                                                           args.recursive,
+                                                           args.exclude))
+    if args.shard:
+      # All files are needed to tell those of the shard.
+      from fortress.lib import sharding
+      files = sharding.Shard(files, *args.shard)
+    if metrics is not None:
+      with metrics.Stage('discover'):
+        files = list(files)
+    report = None
+    if args.report:
+      from fortress.lib import sharding
+      report = sharding.Report(args.shard or (1, 1))
+    cache = None
+    if not args.no_cache:
+      cache = result_cache.ResultCache(args.cache_dir)
+    if args.lint:
+      from fortress.lib import fortress_linter
+      try:
+        changed = LintFiles(files,
+                            compiler=args.compiler,
+                            flags=args.lint_flags,
+                            jobs=args.jobs,
+                            cache=cache,
+                            output_format=args.lint_format)
+      except fortress_linter.LintError as err:
+        sys.stderr.write('fortress: %s\n' % err)
+        return 1
+    else:
+      changed = FormatFiles(files,
+                            lines,
+                            in_place=args.in_place,
+                            print_diff=args.diff,
+                            jobs=args.jobs,
+                            cache=cache,
+                            metrics=metrics,
+                            check=args.check,
+                            fail_fast=args.fail_fast,
+                            list_changed=args.list_changed,
+                            report=report)
+    if listed is not None and listed is not sys.stdin.buffer:
+      listed.close()
+    if cache is not None:
+      cache.Prune()
+    if report is not None:
+      report.status = 2 if changed else 0
+      report.Write(args.report)
+
+  if metrics is not None:
+    writeMetrics(metrics, args.stats, args.profile)
   return 2 if changed else 0
 
 
@@ -185,47 +435,293 @@ def getLines(line_strings):
   return lines
 
 
+def getJobs(jobs_string):
+  """Parses the number of parallel jobs from a string like '8' or 'auto'.
+
+  Arguments:
+    jobs_string: (string) A positive integer or 'auto'.
+
+  Returns:
+    The number of jobs as an int; 'auto' gives the number of usable CPUs.
+
+  Raises:
+    argparse.ArgumentTypeError: If the string is neither 'auto' nor a positive
+      integer.
+  """
+  import argparse
+
+  if jobs_string == 'auto':
+    if hasattr(os, 'sched_getaffinity'):
+      return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+  try:
+    jobs = int(jobs_string)
+  except ValueError:
+    jobs = 0
+  if jobs < 1:
+    raise argparse.ArgumentTypeError(
+        'expected a positive integer or "auto": %r' % jobs_string)
+  return jobs
+
+
+def getShard(shard_string):
+  """Parses the shard to format from a string like '2/8'.
+
+  Arguments:
+    shard_string: (string) 'I/N', the I-th of N shards, 1-based.
+
+  Returns:
+    A tuple of I and N.
+
+  Raises:
+    argparse.ArgumentTypeError: If the string is not of that form, or I is
+      not between 1 and N.
+  """
+  import argparse
+
+  try:
+    index, count = map(int, shard_string.split('/'))
+  except ValueError:
+    index = count = 0
+  if not 1 <= index <= count:
+    raise argparse.ArgumentTypeError(
+        'expected I/N with 1 <= I <= N: %r' % shard_string)
+  return index, count
+
+
+def mergeReports(argv):
+  """Merge the reports of shards: 'fortress merge-reports'.
+
+  Arguments:
+    argv: the command-line arguments after 'merge-reports'.
+
+  Returns:
+    0 if no file changed in any shard, 2 if some did, and 1 if a shard failed
+    or reports are missing.
+  """
+  import argparse
+
+  from fortress.lib import sharding
+
+  parser = argparse.ArgumentParser(
+      prog='fortress merge-reports',
+      description='Merge the reports that the N shards of a run, '
+                  '"fortress --shard I/N --report FILE", wrote: print the '
+                  'diffs of all shards in the order of the files and exit '
+                  'with the status of the whole run.')
+  parser.add_argument('--list-changed',
+                      action='store_true',
+                      help='print the path of every file that changed')
+  parser.add_argument('reports', metavar='REPORT', nargs='+')
+  args = parser.parse_args(argv)
+
+  try:
+    merged = sharding.MergeReports([sharding.Report.Read(filename)
+                                    for filename in args.reports])
+  except sharding.ReportError as err:
+    sys.stderr.write('fortress: %s\n' % err)
+    return 1
+
+  out = getattr(sys.stdout, 'buffer', sys.stdout)
+  for filename in sorted(merged.diffs):
+    out.write(merged.diffs[filename].encode('utf-8', 'surrogateescape'))
+  out.flush()
+  if args.list_changed:
+    for filename in merged.changed:
+      print(filename)
+  return merged.status
+
+
 def FormatFiles(filenames,
                 lines,
                 in_place=False,
-                print_diff=False):
+                print_diff=False,
+                jobs=1,
+                cache=None,
+                metrics=None,
+                check=False,
+                fail_fast=False,
+                list_changed=False,
+                report=None):
   """Format a list of files.
 
   Arguments:
-    filenames: (list of unicode) A list of files to reformat.
+    filenames: (iterable of unicode) The files to reformat. They may be
+      generated as they are found; see fortress_api.IterFormatFiles().
 
     lines: (list of tuples of integers) A list of tuples of lines, [start, end],
       that we want to format. The lines are 1-based indexed. This argument
       overrides the 'args.lines'. It can be used by third-party code (e.g.,
-      IDEs) when reformatting a snippet of code.
+      IDEs) when reformatting a snippet of code. A dict of such lists by
+      filename gives the lines of every file.
 
     in_place: (bool) Modify the files in place.
 
     print_diff: (bool) Instead of returning the reformatted source, return a
       diff that turns the formatted source into reformatter source.
 
+    jobs: (int) Number of worker processes to format the files with. The
+      output is written in the order of filenames, whatever the order the
+      workers finish in.
+
+    cache: (result_cache.ResultCache) Cache of files known to be formatted,
+      or None to reformat every file.
+
+    metrics: (fortress_metrics.Metrics) A collector to record timings and
+      counters in, or None.
+
+    check: (bool) Only check whether the files would change, printing
+      nothing but what list_changed asks for.
+
+    fail_fast: (bool) Stop at the first file that changes, in the order the
+      files finish in, without further output.
+
+    list_changed: (bool) Print the path of every file that changed.
+
+    report: (sharding.Report) A report to add every file to, with its diff
+      if print_diff, or None.
+
+  Returns:
     True if the source code changed in any of the files being formatted.
   """
+  from fortress.lib import file_resources
+  from fortress.lib import fortress_api
+  from fortress.lib import fortress_metrics
+
+  # Files may finish out of order, so results are held back until all files
+  # before them have been written.
+  positions = collections.defaultdict(collections.deque)
+
+  def numbered(filenames):
+    for position, filename in enumerate(filenames):
+      positions[filename].append(position)
+      yield filename
+
+  finished = {}
+  next_position = 0
+
   changed = False
-  for filename in filenames:
-    logging.info('Reformatting %s', filename)
-    try:
-      reformatted_code, encoding, has_change = fortress_api.FormatFile(
-          filename,
-          in_place=in_place,
-          lines=lines,
-          print_diff=print_diff,
-          logger=logging.warning)
-      changed |= has_change
-    except SyntaxError as e:
-      e.filename = filename
-      raise
-    if reformatted_code is not None:
-      file_resources.WriteReformattedCode(filename, reformatted_code, in_place,
-                                          encoding)
+  results = fortress_api.IterFormatFiles(numbered(filenames),
+                                         lines=lines,
+                                         print_diff=print_diff,
+                                         in_place=in_place,
+                                         jobs=jobs,
+                                         logger=_LogWarning,
+                                         cache=cache,
+                                         metrics=metrics,
+                                         check=check)
+  output_metrics = metrics or fortress_metrics.NULL_METRICS
+  try:
+    for filename, result in results:
+      if fail_fast and result[2]:
+        # Stop right away; what is held back for the order is not output.
+        if list_changed:
+          print(filename)
+        return True
+      finished[positions[filename].popleft()] = (filename, result)
+      while next_position in finished:
+        filename, (reformatted_code, encoding, has_change) = finished.pop(
+            next_position)
+        next_position += 1
+        changed |= has_change
+        if report is not None:
+          report.Add(filename, has_change,
+                     reformatted_code if print_diff else None)
+        if has_change and list_changed:
+          print(filename)
+        if reformatted_code is not None:
+          with output_metrics.Stage('output'):
+            file_resources.WriteReformattedCode(filename, reformatted_code,
+                                                in_place, encoding)
+  except SyntaxError as e:
+    e.filename = filename
+    raise
+  finally:
+    results.close()
   return changed
 
 
+def LintFiles(filenames,
+              compiler=None,
+              flags=None,
+              jobs=1,
+              cache=None,
+              output_format='text'):
+  """Lint a list of files and print their diagnostics.
+
+  Arguments:
+    filenames: (iterable of unicode) The files to lint.
+
+    compiler: (unicode) The name or path of the compiler, or None for
+      gfortran.
+
+    flags: (unicode) The flags to pass to the compiler, split like a shell
+      command line, or None for the default flags.
+
+    jobs: (int) Number of compilers to run at a time. The files are linted
+      after those providing the modules they use, and their diagnostics
+      printed in that order.
+
+    cache: (result_cache.ResultCache) Cache of the diagnostics of files, or
+      None to lint every file.
+
+    output_format: (string) 'text' for lines like those of the compiler,
+      'json' for a JSON list or 'jsonl' for a JSON object per line.
+
+  Returns:
+    True if there were any diagnostics.
+  """
+  import json
+  import shlex
+
+  from fortress.lib import fortress_linter
+
+  linter = fortress_linter.FortranLinter(
+      compiler=compiler or fortress_linter.DEFAULT_COMPILER,
+      flags=(fortress_linter.DEFAULT_FLAGS if flags is None
+             else shlex.split(flags)),
+      jobs=jobs,
+      cache=cache)
+  found = False
+  collected = []
+  for _, diagnostics in linter.IterLintWaves(filenames):
+    found |= bool(diagnostics)
+    for diagnostic in diagnostics:
+      if output_format == 'json':
+        collected.append(diagnostic._asdict())
+      elif output_format == 'jsonl':
+        print(json.dumps(diagnostic._asdict()))
+      else:
+        print(fortress_linter.FormatDiagnostic(diagnostic))
+  if output_format == 'json':
+    print(json.dumps(collected, indent=2))
+  return found
+
+
+def _LogWarning(message):
+  """Log a warning; the logging module is only imported when there is one."""
+  import logging
+  logging.warning(message)
+
+
+def writeMetrics(metrics, stats_filename, profile_filename):
+  """Write what metrics recorded as requested by --stats and --profile.
+
+  Arguments:
+    metrics: (fortress_metrics.Metrics) The recorded run.
+    stats_filename: (string) The file to write the JSON lines of --stats to,
+      '-' for stderr, or None.
+    profile_filename: (string) The file to write the profile to, or None.
+  """
+  if profile_filename:
+    metrics.DumpProfile(profile_filename)
+  if stats_filename == '-':
+    metrics.WriteJsonLines(sys.stderr)
+  elif stats_filename:
+    with open(stats_filename, 'w') as fd:
+      metrics.WriteJsonLines(fd)
+
+
 # TODO: Error handling
 def run_main():
     sys.exit(main(sys.argv))
@@ -0,0 +1,140 @@
+"""Index of the block structure of Fortran source.
+
+The index is built in one pass over the tokenized lines of a file, while the
+indentation is fixed or on its own, and answers without another pass:
+
+  * the nesting depth of every line, which is its indentation level,
+  * the innermost block enclosing every line, and its kind ('do', 'if',
+    'subroutine', ... as UnwrappedLine.identifyIndentation() names them),
+  * the line opening and the line closing every block,
+  * the blocks never closed and the lines closing no block.
+
+Lines are numbered from 1, in the order they were added. A line like 'else'
+or 'case' closes one block and opens the next.
+"""
+
+import array
+import bisect
+import collections
+
+# A block of lines: its kind, the line that opens it and the line that closes
+# it, or None if it is never closed.
+Block = collections.namedtuple('Block', 'kind open close')
+
+# Stands for no block in the arrays of block numbers.
+_NO_BLOCK = -1
+
+
+class BlockIndex(object):
+  """The block structure of the lines added to it.
+
+  Per line, only the depth and the number of the enclosing block are stored,
+  in arrays of integers; the blocks themselves are kept once each.
+  """
+
+  def __init__(self):
+    self._depths = array.array('i')
+    self._enclosing = array.array('i')
+    self._kinds = []
+    self._opens = array.array('i')
+    self._closes = array.array('i')
+    self._openAt = {}
+    self._closeAt = {}
+    self._unopened = []
+    # the numbers of the blocks open, innermost last
+    self._stack = []
+    # the kinds of the blocks open, with their counts
+    self._openKinds = {}
+
+  @classmethod
+  def FromCodeLines(cls, codeLines):
+    """Return the index of codeLines, with their continuations identified."""
+    index = cls()
+    for codeLine in codeLines:
+      index.Add(codeLine)
+    return index
+
+  def Add(self, codeLine):
+    """Add the next line.
+
+    Returns:
+      The depth of the line.
+    """
+    lineno = len(self._depths) + 1
+    if codeLine.decreasesIndentBefore():
+      if self._stack:
+        block = self._stack.pop()
+        self._closes[block] = lineno
+        self._closeAt[lineno] = block
+        kind = self._kinds[block]
+        self._openKinds[kind] -= 1
+        if not self._openKinds[kind]:
+          del self._openKinds[kind]
+      else:
+        self._unopened.append(lineno)
+
+    depth = len(self._stack)
+    self._depths.append(depth)
+    self._enclosing.append(self._stack[-1] if self._stack else _NO_BLOCK)
+
+    kind = codeLine.identifyIndentation(self._openKinds)
+    if kind:
+      block = len(self._kinds)
+      self._kinds.append(kind)
+      self._opens.append(lineno)
+      self._closes.append(0)
+      self._openAt[lineno] = block
+      self._stack.append(block)
+      self._openKinds[kind] = self._openKinds.get(kind, 0) + 1
+    return depth
+
+  def __len__(self):
+    """Return the number of lines."""
+    return len(self._depths)
+
+  def Depth(self, lineno):
+    """Return the nesting depth of a line."""
+    return self._depths[lineno - 1]
+
+  def Depths(self, start=1, end=None):
+    """Return the nesting depths of the lines from start to end, inclusive."""
+    return self._depths[start - 1:end].tolist()
+
+  def Enclosing(self, lineno):
+    """Return the innermost Block enclosing a line, or None at the top."""
+    return self._Block(self._enclosing[lineno - 1])
+
+  def Match(self, lineno):
+    """Return the Block a line opens, or else the one it closes, or None."""
+    block = self._openAt.get(lineno)
+    if block is None:
+      block = self._closeAt.get(lineno, _NO_BLOCK)
+    return self._Block(block)
+
+  def Blocks(self):
+    """Return all Blocks, in the order they are opened."""
+    return [self._Block(block) for block in range(len(self._kinds))]
+
+  def Unclosed(self):
+    """Return the Blocks never closed, outermost first."""
+    return [self._Block(block) for block in self._stack]
+
+  def Unopened(self):
+    """Return the numbers of the lines that close a block none is open for."""
+    return list(self._unopened)
+
+  def ClosesNothing(self, lineno):
+    """Return True if the line closes a block none is open for."""
+    position = bisect.bisect_left(self._unopened, lineno)
+    return position < len(self._unopened) \
+        and self._unopened[position] == lineno
+
+  def IsBalanced(self):
+    """Return True if every block is closed and every close has a block."""
+    return not self._stack and not self._unopened
+
+  def _Block(self, block):
+    if block == _NO_BLOCK:
+      return None
+    close = self._closes[block]
+    return Block(self._kinds[block], self._opens[block], close or None)
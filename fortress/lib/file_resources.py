@@ -7,12 +7,34 @@ This module provides functions for interfacing with files:
 
 """
 
+import codecs
 import fnmatch
+import io
 import os
 import re
+import stat
+import sys
 
-from lib2to3.pgen2 import tokenize
-from fortress.lib import py3compat
+
+# An encoding declaration in one of the first two lines, as in PEP 263.
+_CODING_COOKIE = re.compile(br'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)')
+
+# A line that may be followed by the encoding declaration.
+_BLANK_LINE = re.compile(br'^[ \t\f]*(?:[#\r\n]|$)')
+
+# Files of at least this size are mapped into memory rather than read.
+_MMAP_THRESHOLD = 1 << 16
+
+# Encodings that encode ASCII text as it is, so that ASCII content needs no
+# codec; as DetectEncoding() names them.
+_ASCII_COMPATIBLE = frozenset(['utf-8', 'iso-8859-1', 'ascii'])
+
+# How much of a list of files IterFilesFrom() reads at a time.
+_LIST_BLOCK_SIZE = 1 << 16
+
+# Extensions of the files IsFortranOrHeaderFile() accepts.
+_FORTRAN_EXTENSIONS = frozenset(['.F', '.F90', '.f', '.f90'])
+_FORTRAN_OR_HEADER_EXTENSIONS = _FORTRAN_EXTENSIONS | frozenset(['.h'])
 
 
 def WriteReformattedCode(filename, reformatted_code, in_place, encoding):
@@ -23,79 +45,479 @@ def WriteReformattedCode(filename, reformatted_code, in_place, encoding):
 
   Arguments:
     filename         : (unicode) The name of the unformatted file.
-    reformatted_code : (unicode) The reformatted code.
+    reformatted_code : (unicode) The reformatted code, or (bytes) the code
+                       encoded already.
     in_place         : (bool) If True, then write the reformatted code to the file.
     encoding         : (unicode) The encoding of the file.
   """
+  data = EncodeSource(reformatted_code, encoding)
   if in_place:
-    with py3compat.open_with_encoding(filename,
-                                      mode='w',
-                                      encoding=encoding) as fd:
-      fd.write(reformatted_code)
+    with InPlaceWriter() as writer:
+      writer.Write(filename, data, encoding)
   else:
-    py3compat.EncodeAndWriteToStdout(reformatted_code, encoding)
+    getattr(sys.stdout, 'buffer', sys.stdout).write(data)
+
+
+def ReadSource(filename):
+  """Read a file of source code and decode it, opening the file once.
+
+  The encoding is detected from the bytes read. Large files are mapped into
+  memory and decoded from there, and ASCII content, the most common by far,
+  is decoded without the codec of the encoding. The operating system is
+  told that the file is read sequentially, so that it reads ahead on network
+  and parallel file systems.
+
+  Arguments:
+    filename : (unicode) The name of the file.
+
+  Returns:
+    A tuple of the source, its encoding and the os.stat_result of the file as
+    it was opened.
+
+  Raises:
+    IOError: If the file cannot be read.
+    SyntaxError: If the encoding declaration is invalid; see DetectEncoding().
+    UnicodeDecodeError: If the file is not in its encoding.
+  """
+  fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+  try:
+    stat_result = os.fstat(fd)
+    if hasattr(os, 'posix_fadvise'):
+      try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+      except OSError:
+        pass  # only a hint
+    if stat_result.st_size >= _MMAP_THRESHOLD:
+      import mmap
+      data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+      try:
+        encoding = DetectEncoding(data.readline)
+        return DecodeSource(data, encoding), encoding, stat_result
+      finally:
+        data.close()
+    # One read of the size of the file.
+    data = io.FileIO(fd, closefd=False).readall()
+  finally:
+    os.close(fd)
+  encoding = DetectEncoding(io.BytesIO(data).readline)
+  return DecodeSource(data, encoding), encoding, stat_result
+
+
+def DecodeSource(data, encoding):
+  """Return bytes of source code decoded, without a codec if they are ASCII."""
+  if encoding in _ASCII_COMPATIBLE:
+    try:
+      return codecs.decode(data, 'ascii')
+    except UnicodeDecodeError:
+      pass
+  return codecs.decode(data, encoding)
+
+
+def EncodeSource(code, encoding):
+  """Return source code encoded, without a codec if it is ASCII.
+
+  Code that is encoded already is returned as it is.
+  """
+  if isinstance(code, bytes):
+    return code
+  if encoding in _ASCII_COMPATIBLE and _IsAscii(code):
+    return code.encode('ascii')
+  return codecs.encode(code, encoding)
+
+
+def _IsAscii(text):
+  """Return True if text is ASCII; constant time where str.isascii() is."""
+  isascii = getattr(text, 'isascii', None)
+  return isascii() if isascii else False
+
+
+class InPlaceWriter(object):
+  """Replaces files atomically, committing the writes in batches.
+
+  Every file is written to a temporary file in its directory first, with the
+  permissions of the file, so a crash leaves either the old or the new
+  contents behind, never a truncated file. The writes are committed batch by
+  batch: the temporary files are synced, renamed over the files, and then
+  every directory they are in is synced once, instead of syncing a directory
+  for every file.
+
+  Used as a context manager, what is staged is committed on leaving, or
+  discarded if an exception is raised.
+
+  Attributes:
+    batch_size : (int) The number of staged writes that are committed at once,
+                 or 0 to commit only when Commit() is called.
+    sync       : (bool) Whether the files and directories are synced to disk.
+  """
+
+  def __init__(self, batch_size=256, sync=True):
+    self.batch_size = batch_size
+    self.sync = sync
+    self._staged = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.Commit()
+    else:
+      self.Discard()
+
+  def Write(self, filename, code, encoding):
+    """Replace the contents of filename with code, in a later commit.
+
+    The code is either text to encode in encoding or bytes.
+    """
+    self.Add(self.Stage(filename, code, encoding))
+
+  def Stage(self, filename, code, encoding):
+    """Write code to a temporary file next to filename.
+
+    The temporary file is not added to the writes to commit, so that it can
+    be staged in one process and committed in another.
+
+    Returns:
+      The staged write, to be passed on to Add().
+    """
+    import tempfile
+
+    # Replace the file a link points to, not the link.
+    target = os.path.realpath(filename)
+    directory, name = os.path.split(target)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + name + '.',
+                                    suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(EncodeSource(code, encoding))
+      original = os.stat(target)
+      os.chmod(tmp_path, stat.S_IMODE(original.st_mode))
+      if hasattr(os, 'chown'):
+        try:
+          os.chown(tmp_path, original.st_uid, original.st_gid)
+        except OSError:
+          pass  # only the owner of the file may have changed
+    except BaseException:
+      _RemoveQuietly(tmp_path)
+      raise
+    return tmp_path, target
+
+  def Add(self, staged):
+    """Add a write returned by Stage() to those to commit."""
+    self._staged.append(staged)
+    if self.batch_size and len(self._staged) >= self.batch_size:
+      self.Commit()
+
+  def Commit(self):
+    """Replace the files of all staged writes."""
+    staged, self._staged = self._staged, []
+    renamed = 0
+    try:
+      if self.sync:
+        for tmp_path, _ in staged:
+          _SyncPath(tmp_path, os.O_RDONLY)
+      for tmp_path, target in staged:
+        os.replace(tmp_path, target)
+        renamed += 1
+    finally:
+      for tmp_path, _ in staged[renamed:]:
+        _RemoveQuietly(tmp_path)
+    # Directories cannot be opened for syncing everywhere.
+    if self.sync and hasattr(os, 'O_DIRECTORY'):
+      for directory in sorted(set(os.path.dirname(target)
+                                  for _, target in staged)):
+        _SyncPath(directory, os.O_RDONLY | os.O_DIRECTORY)
+
+  def Detach(self):
+    """Return the staged writes, for another writer to Add() and commit."""
+    staged, self._staged = self._staged, []
+    return staged
+
+  def Discard(self):
+    """Remove the temporary files of all staged writes."""
+    staged, self._staged = self._staged, []
+    for tmp_path, _ in staged:
+      _RemoveQuietly(tmp_path)
+
+
+def _SyncPath(path, flags):
+  """Flush what was written to path to the disk."""
+  fd = os.open(path, flags)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def _RemoveQuietly(path):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+
+def DetectEncoding(readline):
+  """Detect the encoding of a file from its first two lines.
+
+  This is what lib2to3's tokenize.detect_encoding() did, without importing
+  lib2to3: a UTF-8 byte order mark or an encoding declaration in one of the
+  first two lines decides, and the encoding defaults to UTF-8.
+
+  Arguments:
+    readline : (function) Returns the next line of the file as bytes.
+
+  Returns:
+    The name of the encoding.
+
+  Raises:
+    SyntaxError: If the declaration is invalid or names an unknown encoding,
+      or contradicts the byte order mark.
+  """
+  first = readline()
+  bom = first.startswith(codecs.BOM_UTF8)
+  if bom:
+    first = first[len(codecs.BOM_UTF8):]
+  default = 'utf-8-sig' if bom else 'utf-8'
+
+  encoding = _FindCodingCookie(first, bom)
+  if encoding is None and _BLANK_LINE.match(first):
+    encoding = _FindCodingCookie(readline(), bom)
+  return encoding or default
+
+
+def _FindCodingCookie(line, bom):
+  """Return the encoding declared in a line of bytes, or None."""
+  try:
+    line.decode('ascii')
+  except UnicodeDecodeError:
+    return None
+  match = _CODING_COOKIE.match(line)
+  if not match:
+    return None
+  encoding = _NormalEncodingName(match.group(1).decode('ascii'))
+  try:
+    codecs.lookup(encoding)
+  except LookupError:
+    raise SyntaxError('unknown encoding: ' + encoding)
+  if bom:
+    if encoding != 'utf-8':
+      raise SyntaxError('encoding problem: utf-8')
+    encoding += '-sig'
+  return encoding
+
+
+def _NormalEncodingName(name):
+  """Return the usual name of the UTF-8 and Latin-1 encodings."""
+  normal = name[:12].lower().replace('_', '-')
+  if normal == 'utf-8' or normal.startswith('utf-8-'):
+    return 'utf-8'
+  if normal in ('latin-1', 'iso-8859-1', 'iso-latin-1') \
+      or normal.startswith(('latin-1-', 'iso-8859-1-', 'iso-latin-1-')):
+    return 'iso-8859-1'
+  return name
 
 
 def GetCommandLineFiles(command_line_file_list, recursive, exclude):
   """Return the list of files specified on the command line."""
+  return list(IterCommandLineFiles(command_line_file_list, recursive, exclude))
+
+
+def IterCommandLineFiles(command_line_file_list, recursive, exclude):
+  """Generate the files specified on the command line as they are found.
+
+  The arguments are checked before anything is generated, so an error in
+  them is raised by this function rather than half-way through a run.
+
+  Raises:
+    Exception: If a directory is given without recursive.
+  """
+  for filename in command_line_file_list:
+    if not recursive and os.path.isdir(filename):
+      raise Exception(
+          "directory specified without '--recursive' flag: %s" % filename)
   return _FindFortranFiles(command_line_file_list, recursive, exclude)
 
 
+def IterFilesFrom(fp, recursive, exclude):
+  """Generate the files listed in a file, as IterCommandLineFiles() does for
+  those given on the command line.
+
+  The list is read as the files are generated, so it may be of any length.
+  The names are separated by NUL characters if there is one in the first
+  block read, otherwise by line breaks.
+
+  Arguments:
+    fp : (file object) The list, opened in binary mode.
+
+  Raises:
+    Exception: If a directory is listed without recursive, once it is read.
+  """
+  return _FindFortranFiles(_CheckListedPaths(_IterListedPaths(fp), recursive),
+                           recursive, exclude)
+
+
+def _IterListedPaths(fp):
+  separator = None
+  rest = b''
+  while True:
+    block = fp.read(_LIST_BLOCK_SIZE)
+    if separator is None:
+      separator = b'\0' if b'\0' in block else b'\n'
+    if not block:
+      break
+    names = (rest + block).split(separator)
+    rest = names.pop()
+    for name in names:
+      if separator == b'\n':
+        name = name.rstrip(b'\r')
+      if name:
+        yield os.fsdecode(name)
+  # the last name, if not followed by a separator
+  if separator == b'\n':
+    rest = rest.rstrip(b'\r')
+  if rest:
+    yield os.fsdecode(rest)
+
+
+def _CheckListedPaths(paths, recursive):
+  for path in paths:
+    if not recursive and os.path.isdir(path):
+      raise Exception(
+          "directory listed without '--recursive' flag: %s" % path)
+    yield path
+
+
+def FilterFortranFiles(filenames, exclude):
+  """Generate the files with a Fortran or header extension not excluded.
+
+  This is the filter applied to the files found in directories, for lists of
+  files that come from elsewhere, like version control.
+  """
+  matcher = _ExcludeMatcher(exclude)
+  for filename in filenames:
+    if os.path.splitext(filename)[1] in _FORTRAN_OR_HEADER_EXTENSIONS \
+        and not matcher.Excludes(filename):
+      yield filename
+
+
 def IsFortranOrHeaderFile(filename, headers_too=True):
   """Return True if filename is a Fortran file."""
   if headers_too:
-    if os.path.splitext(filename)[1] in ['.F','.F90','.f','.f90','.h']: # TODO: This can be dangerous. Esp. when it's a C-header.
+    if os.path.splitext(filename)[1] in _FORTRAN_OR_HEADER_EXTENSIONS: # TODO: This can be dangerous. Esp. when it's a C-header.
       return True
-  elif os.path.splitext(filename)[1] in ['.F','.F90','.f','.f90']:
+  elif os.path.splitext(filename)[1] in _FORTRAN_EXTENSIONS:
     return True
 
-  try:
-    with open(filename, 'rb') as fd:
-      encoding = tokenize.detect_encoding(fd.readline)[0]
-
-    # Check for correctness of encoding.
-    with py3compat.open_with_encoding(filename, encoding=encoding) as fd:
-      fd.read()
-  except UnicodeDecodeError:
-    encoding = 'latin-1'
-  except (IOError, SyntaxError):
-    # If we fail to detect encoding (or the encoding cookie is incorrect - which
-    # will make detect_encoding raise SyntaxError), assume it's not a Fortran
-    # file.
-    return False
-
-  try:
-    with py3compat.open_with_encoding(filename,
-                                      mode='r',
-                                      encoding=encoding) as fd:
-      first_line = fd.readlines()[0]
-  except (IOError, IndexError):
-    return False
-
-  # In all other cases assume everything is worse.
+  # Files of other extensions are not looked into.
   return False
 
 
 def _FindFortranFiles(filenames, recursive, exclude):
-  """Find all Fortran files."""
-  fortran_files = []
+  """Generate all Fortran files.
+
+  Files given explicitly are generated whatever their extension; those found
+  in directories are generated if they have a Fortran or header extension,
+  as IsFortranOrHeaderFile() accepts no other files. A file found through
+  several links is generated once.
+  """
+  matcher = _ExcludeMatcher(exclude)
+  seen = set()
   for filename in filenames:
     if os.path.isdir(filename):
-      if recursive:
-        fortran_files.extend(
-            os.path.join(dirpath, f)
-            for dirpath, _, filelist in os.walk(filename) for f in filelist
-            if IsFortranOrHeaderFile(os.path.join(dirpath, f)))
-      else:
-        raise Exception(
-            "directory specified without '--recursive' flag: %s" % filename)
+      for path in _WalkFortranFiles(filename, matcher, seen):
+        yield path
     elif os.path.isfile(filename):
       # Assuming user knows what s/he does
-      fortran_files.append(filename)
+      if not matcher.Excludes(filename):
+        yield filename
+
 
-  if exclude:
-    return [f
-            for f in fortran_files
-            if not any(fnmatch.fnmatch(f, p) for p in exclude)]
+def _WalkFortranFiles(top, matcher, seen):
+  """Generate the Fortran files below top, like os.walk() would find them.
 
-  return fortran_files
+  Only the names of the files are looked at before they are known to be
+  Fortran files, and excluded directories are not entered. Links to
+  directories are not followed.
+
+  Arguments:
+    top     : (unicode) The directory to walk.
+    matcher : (_ExcludeMatcher) The files and directories to leave out.
+    seen    : (set) The (device, inode) of the files generated so far; the
+              files generated are added.
+  """
+  # directories left to walk, the next one last
+  pending = [top]
+  while pending:
+    dirpath = pending.pop()
+    try:
+      entries = list(os.scandir(dirpath))
+    except OSError:
+      continue  # os.walk() ignores these too
+
+    subdirs = []
+    for entry in entries:
+      try:
+        isDir = entry.is_dir()
+      except OSError:
+        isDir = False
+      if isDir:
+        if not entry.is_symlink() and not matcher.ExcludesDir(entry.path):
+          subdirs.append(entry.path)
+        continue
+      if os.path.splitext(entry.name)[1] not in _FORTRAN_OR_HEADER_EXTENSIONS \
+          or matcher.Excludes(entry.path):
+        continue
+      # the files are read anyway, so stat'ing them costs little more
+      try:
+        stat = entry.stat()
+        key = (stat.st_dev, stat.st_ino)
+      except OSError:
+        key = None  # a dangling link; reading it will tell
+      if key is not None:
+        if key in seen:
+          continue
+        seen.add(key)
+      yield entry.path
+
+    pending.extend(reversed(subdirs))
+
+
+class _ExcludeMatcher(object):
+  """Matches paths against all exclude patterns at once.
+
+  The fnmatch patterns are compiled into one regular expression. A directory
+  is excluded if its path matches a pattern, or if every path below it does:
+  that is, if its path with a trailing separator matches a pattern ending in
+  '*'.
+  """
+
+  def __init__(self, patterns):
+    patterns = list(patterns or ())
+    self._match = _CompilePatterns(patterns)
+    self._matchDir = _CompilePatterns([p for p in patterns
+                                       if p.endswith('*')])
+
+  def Excludes(self, path):
+    """Return True if the file at path is excluded."""
+    return self._match is not None \
+        and self._match(os.path.normcase(path)) is not None
+
+  def ExcludesDir(self, path):
+    """Return True if the directory at path and all below it are excluded."""
+    if self._match is None:
+      return False
+    path = os.path.normcase(path)
+    return self._match(path) is not None or (
+        self._matchDir is not None
+        and self._matchDir(path + os.sep) is not None)
+
+
+def _CompilePatterns(patterns):
+  """Return the match method of a regex matching any of the fnmatch patterns.
+
+  Returns None if there are no patterns.
+  """
+  if not patterns:
+    return None
+  return re.compile('|'.join(fnmatch.translate(os.path.normcase(p))
+                             for p in patterns)).match
@@ -0,0 +1,174 @@
+"""Formatting of files from asyncio code; see fortress_api.FormatFileAsync().
+
+On slow or remote filesystems the time spent reading and writing files can
+exceed the time spent formatting them, and blocking on either stalls an event
+loop. Here the reads and writes run in a pool of threads, and the formatting
+runs in a pool of its own, of threads or of processes, so that while one file
+is formatted others are read and written.
+
+FormatFilesAsync() keeps at most a bounded number of files in flight, from
+the read to the write, and only takes more files once the results of the
+finished ones were consumed; a slow consumer thus holds up the reading rather
+than filling memory with results. Closing or cancelling it cancels the files
+not yet started; files being read, formatted or written in a pool are let
+finish, and their results are dropped. Files are written in place atomically,
+so a cancelled run leaves no file half written.
+
+A file takes the same steps as in FormatFile(), with the same cache. As a
+Metrics collector records one file at a time, what a file takes is recorded
+in a collector of its own and then added to the one passed; peak memory is
+not traced, as files are formatted at the same time.
+"""
+
+import asyncio
+import concurrent.futures
+
+from fortress.lib import file_resources
+from fortress.lib import fortress_api
+from fortress.lib import fortress_metrics
+from fortress.lib import fortress_style
+
+
+async def FormatFileAsync(filename, lines=None, print_diff=False,
+                          in_place=False, logger=None, check=False,
+                          io_executor=None, format_executor=None, cache=None,
+                          metrics=None):
+  """Format a single Fortran file; see fortress_api.FormatFileAsync()."""
+  fortress_api._CheckPythonVersion()
+  if in_place + print_diff + check > 1:
+    raise ValueError('Cannot pass more than one of in_place, print_diff and '
+                     'check.')
+  if lines:
+    cache = None
+  if metrics is None:
+    return await _FormatFile(filename, lines, print_diff, in_place, logger,
+                             check, io_executor, format_executor, cache, None,
+                             None)
+
+  fileMetrics = fortress_metrics.Metrics()
+  with fileMetrics.File(filename) as record:
+    result = await _FormatFile(filename, lines, print_diff, in_place, logger,
+                               check, io_executor, format_executor, cache,
+                               fileMetrics, record)
+    fileMetrics.Count(changed=result[2])
+  metrics.AddFiles(fileMetrics.files)
+  return result
+
+
+async def _FormatFile(filename, lines, print_diff, in_place, logger, check,
+                      io_executor, format_executor, cache, metrics, record):
+  """Format a single Fortran file; see FormatFileAsync().
+
+  What it takes is recorded in metrics, a collector of this file alone, and
+  record, the record of the file in it; both are None if not recording.
+  """
+  loop = asyncio.get_running_loop()
+  if cache is not None:
+    result = await loop.run_in_executor(
+        io_executor, fortress_api.LookupCachedFile, filename, cache,
+        print_diff, in_place, check, metrics)
+    if result is not None:
+      return result
+
+  source, encoding, stat = await loop.run_in_executor(
+      io_executor, fortress_api.ReadSourceFile, filename, logger, metrics)
+  (reformatted_source, changed), formatted = await loop.run_in_executor(
+      format_executor or io_executor, _FormatSource, source, filename,
+      encoding, stat, lines, print_diff, check, cache, metrics is not None)
+  if formatted is not None:
+    _AddRecord(record, formatted)
+
+  if check:
+    return None, encoding, changed
+  if in_place:
+    # Unchanged files keep their modification time.
+    if changed:
+      await loop.run_in_executor(
+          io_executor, _WriteFile, filename, reformatted_source, encoding,
+          metrics)
+    return None, encoding, changed
+  return reformatted_source, encoding, changed
+
+
+async def FormatFilesAsync(filenames, lines=None, print_diff=False,
+                           in_place=False, logger=None, check=False,
+                           concurrency=8, processes=0, cache=None,
+                           metrics=None):
+  """Format several Fortran files; see fortress_api.FormatFilesAsync()."""
+  if concurrency < 1:
+    raise ValueError('concurrency must be at least 1')
+  linesOf = lines.get if isinstance(lines, dict) else lambda _: lines
+
+  io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+  format_executor = None
+  if processes > 0:
+    format_executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=fortress_style.SetGlobalStyle,
+        initargs=(fortress_style.GetGlobalStyle(),))
+
+  filenames = iter(filenames)
+  pending = {}
+  try:
+    while True:
+      for filename in filenames:
+        task = asyncio.ensure_future(FormatFileAsync(
+            filename, lines=linesOf(filename), print_diff=print_diff,
+            in_place=in_place, logger=logger, check=check,
+            io_executor=io_executor, format_executor=format_executor,
+            cache=cache, metrics=metrics))
+        pending[task] = filename
+        if len(pending) >= concurrency:
+          break
+      if not pending:
+        return
+
+      done, _ = await asyncio.wait(pending,
+                                   return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        filename = pending.pop(task)
+        # The first failure ends the run, as in IterFormatFiles().
+        yield filename, task.result()
+  finally:
+    for task in pending:
+      task.cancel()
+    if pending:
+      await asyncio.wait(pending)
+    # Whatever runs in the pools still is let finish in the background.
+    io_executor.shutdown(wait=False)
+    if format_executor is not None:
+      format_executor.shutdown(wait=False)
+
+
+def _FormatSource(source, filename, encoding, stat, lines, print_diff, check,
+                  cache, record):
+  """Run fortress_api.FormatSource() in a pool, of threads or processes.
+
+  Returns:
+    Tuple of (result, record): the result of FormatSource(), and what it took
+    if record is True, else None.
+  """
+  if not record:
+    return fortress_api.FormatSource(source, filename, encoding, stat, lines,
+                                     print_diff, check, cache), None
+  metrics = fortress_metrics.Metrics()
+  with metrics.File(filename):
+    result = fortress_api.FormatSource(source, filename, encoding, stat,
+                                       lines, print_diff, check, cache,
+                                       metrics)
+  return result, metrics.files[0]
+
+
+def _WriteFile(filename, reformatted_source, encoding, metrics):
+  with (metrics or fortress_metrics.NULL_METRICS).Stage('write'):
+    file_resources.WriteReformattedCode(filename, reformatted_source, True,
+                                        encoding)
+
+
+def _AddRecord(record, other):
+  """Add what the formatting of a file took to the record of the file."""
+  for stage, seconds in other.get('seconds', {}).items():
+    record['seconds'][stage] = record['seconds'].get(stage, 0.0) + seconds
+  for name, value in other.items():
+    if name not in ('file', 'seconds', 'total_seconds'):
+      record[name] = value
@@ -0,0 +1,328 @@
+"""Thin client of the FORTRESS format server.
+
+Editors format small buffers often, and starting a new FORTRESS process for
+each of them costs more than the formatting itself. The client sends the code
+to a daemon started by 'fortress --serve' instead (see format_server), and
+falls back to formatting in-process like the 'fortress' command if there is
+no daemon to talk to:
+
+  fortress-client [-l START-END] [-s STYLE] [--strict] < code > formatted
+
+It takes the code from stdin, writes the formatted code to stdout and exits
+like 'fortress' does, with 2 if the code changed. With --spawn, a daemon is
+started in the background for the next call if none is running.
+
+The socket is in $XDG_RUNTIME_DIR or else in a directory of the user's own in
+the temporary directory, which nobody else may enter. Client and server only
+talk to a peer of the same user: the socket must be owned by the user, and
+where the system tells the user of the peer (SO_PEERCRED), it must be the
+same one.
+
+The messages exchanged are JSON objects, each preceded by its length in bytes
+as a 4-byte big-endian integer. This module only imports what it needs to
+talk to the server, to start up fast.
+"""
+
+import argparse
+import errno
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+# Messages larger than this are refused rather than read into memory.
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+_HEADER = struct.Struct('>I')
+
+# struct ucred: pid, uid and gid
+_CREDENTIALS = struct.Struct('3i')
+
+
+class ProtocolError(Exception):
+  """Raised if the peer sends something that is not a valid message."""
+
+
+def DefaultSocketPath():
+  """Return the path of the server's socket for the current user.
+
+  Its directory is only made by the server; see MakePrivateDirectory().
+  """
+  directory = os.environ.get('XDG_RUNTIME_DIR')
+  if directory and os.path.isdir(directory):
+    return os.path.join(directory, 'fortress-%d.sock' % os.getuid())
+  import tempfile
+  return os.path.join(tempfile.gettempdir(), 'fortress-%d' % os.getuid(),
+                      'server.sock')
+
+
+def MakePrivateDirectory(directory):
+  """Make directory, readable only by the current user, unless it exists.
+
+  Raises:
+    socket.error: If it cannot be made, or is not private to the user.
+  """
+  try:
+    os.mkdir(directory, 0o700)
+  except OSError as err:
+    if err.errno != errno.EEXIST:
+      raise
+  CheckOwner(directory, private=True)
+
+
+def CheckOwner(path, private=False):
+  """Check that path is owned by the current user, and not a symlink.
+
+  Arguments:
+    path    : (unicode) A socket, or with private, a directory.
+    private : (bool) Check that path is a directory nobody else may access.
+
+  Raises:
+    socket.error: If path does not exist or is not as expected.
+  """
+  info = os.lstat(path)
+  if info.st_uid != os.getuid():
+    raise socket.error(errno.EPERM, '%s is owned by another user' % path)
+  if private:
+    if not stat.S_ISDIR(info.st_mode) or info.st_mode & 0o077:
+      raise socket.error(errno.EPERM,
+                         '%s is not a directory private to the user' % path)
+  elif not stat.S_ISSOCK(info.st_mode):
+    raise socket.error(errno.ENOTSOCK, '%s is not a socket' % path)
+
+
+def PeerUid(sock):
+  """Return the user id of the peer of a Unix domain socket, or None where
+  the system does not tell."""
+  if not hasattr(socket, 'SO_PEERCRED'):
+    return None
+  credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                _CREDENTIALS.size)
+  _, uid, _ = _CREDENTIALS.unpack(credentials)
+  return uid
+
+
+def SendMessage(sock, message):
+  """Send a JSON-serializable message over sock."""
+  data = json.dumps(message).encode('utf-8')
+  sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def ReceiveMessage(sock):
+  """Receive a message from sock.
+
+  Returns:
+    The message, or None if the peer closed the connection before sending one.
+
+  Raises:
+    ProtocolError: If the message is cut off, too large or not a JSON object.
+  """
+  header = _ReceiveExactly(sock, _HEADER.size)
+  if not header:
+    return None
+  size, = _HEADER.unpack(header)
+  if size > MAX_MESSAGE_SIZE:
+    raise ProtocolError('message of %d bytes is too large' % size)
+  data = _ReceiveExactly(sock, size)
+  if len(data) < size:
+    raise ProtocolError('connection closed within a message')
+  try:
+    message = json.loads(data.decode('utf-8'))
+  except ValueError as err:
+    raise ProtocolError('invalid message: %s' % err)
+  if not isinstance(message, dict):
+    raise ProtocolError('message is not an object')
+  return message
+
+
+def Request(message, socket_path=None, timeout=None):
+  """Send a request to the server and return its response.
+
+  Arguments:
+    message     : (dict) The request.
+    socket_path : (unicode) The path of the server's socket.
+    timeout     : (float) Seconds to wait for the server, or None.
+
+  Returns:
+    The response of the server.
+
+  Raises:
+    socket.error  : If the server cannot be reached, or is not one of the
+                    current user.
+    ProtocolError : If the server's response is invalid.
+  """
+  if socket_path is None:
+    socket_path = DefaultSocketPath()
+    CheckOwner(os.path.dirname(socket_path), private=True)
+  CheckOwner(socket_path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.settimeout(timeout)
+    sock.connect(socket_path)
+    uid = PeerUid(sock)
+    if uid is not None and uid != os.getuid():
+      raise socket.error(errno.EPERM,
+                         'the server on %s runs as another user' % socket_path)
+    SendMessage(sock, message)
+    response = ReceiveMessage(sock)
+  finally:
+    sock.close()
+  if response is None:
+    raise ProtocolError('connection closed without a response')
+  return response
+
+
+def FormatCode(source, lines=None, style=None, strict=False,
+               socket_path=None, timeout=None):
+  """Format a string of code with the server.
+
+  Arguments:
+    source      : (unicode) The code to format.
+    lines       : (list of tuples of integers) Lines to reformat, 1-based.
+    style       : (unicode) The path of a style.ini, or None for the default
+                  style.
+    strict      : (bool) Format with the strict style; style is ignored.
+    socket_path : (unicode) The path of the server's socket.
+    timeout     : (float) Seconds to wait for the server, or None.
+
+  Returns:
+    Tuple of (reformatted_source, changed), as fortress_api.FormatCode().
+
+  Raises:
+    socket.error  : If the server cannot be reached.
+    ProtocolError : If the server's response is invalid.
+    ValueError    : If the server failed to format the code.
+  """
+  response = Request({'command': 'format',
+                      'source': source,
+                      'lines': lines,
+                      'style': os.path.abspath(style) if style else None,
+                      'strict': strict},
+                     socket_path=socket_path,
+                     timeout=timeout)
+  if 'error' in response:
+    raise ValueError(response['error'])
+  return response['formatted'], response['changed']
+
+
+def main(argv):
+  """Format stdin with the server, or in-process without one.
+
+  Returns:
+    0 if there were no changes, 2 if there were, 1 on errors.
+  """
+  parser = argparse.ArgumentParser(
+      prog='fortress-client',
+      description='Format Fortran code from stdin with a FORTRESS server.')
+  parser.add_argument('-l', '--lines', metavar='START-END', action='append',
+                      default=None, help='range of lines to reformat; 1-based')
+  parser.add_argument('-s', '--style', default=None,
+                      help='specify formatting style via local style.ini')
+  parser.add_argument('--strict', action='store_true',
+                      help='applies all available formatting options / '
+                           'style.ini will be ignored')
+  parser.add_argument('--socket', metavar='PATH', default=None,
+                      help='socket of the server (default: %s)'
+                           % DefaultSocketPath())
+  parser.add_argument('--spawn', action='store_true',
+                      help='start a server for later calls if none is '
+                           'running')
+  parser.add_argument('--stop', action='store_true',
+                      help='stop the server and exit')
+  args = parser.parse_args(argv[1:])
+
+  if args.stop:
+    try:
+      Request({'command': 'stop'}, socket_path=args.socket)
+    except (socket.error, ProtocolError):
+      return 1
+    return 0
+
+  source = _ReadStdin()
+  lines = None
+  if args.lines:
+    lines = [list(map(int, line.split('-', 1))) for line in args.lines]
+
+  try:
+    formatted, changed = FormatCode(source, lines=lines, style=args.style,
+                                    strict=args.strict,
+                                    socket_path=args.socket)
+  except (socket.error, ProtocolError):
+    if args.spawn:
+      _SpawnServer(args.socket)
+    return _FormatInProcess(args, source)
+  except ValueError as err:
+    sys.stderr.write('fortress-client: %s\n' % err)
+    return 1
+
+  _WriteStdout(formatted)
+  return 2 if changed else 0
+
+
+def _ReceiveExactly(sock, size):
+  """Receive size bytes from sock, or less if the connection is closed."""
+  chunks = []
+  while size > 0:
+    chunk = sock.recv(min(size, 1024 * 1024))
+    if not chunk:
+      break
+    chunks.append(chunk)
+    size -= len(chunk)
+  return b''.join(chunks)
+
+
+def _ReadStdin():
+  return sys.stdin.buffer.read().decode(sys.stdin.encoding or 'utf-8',
+                                        'surrogateescape')
+
+
+def _WriteStdout(text):
+  sys.stdout.buffer.write(text.encode(sys.stdout.encoding or 'utf-8',
+                                      'surrogateescape'))
+  sys.stdout.flush()
+
+
+def _FormatInProcess(args, source):
+  """Format source like the 'fortress' command would."""
+  import io
+
+  import fortress
+
+  fortress_argv = ['fortress']
+  for line_range in args.lines or ():
+    fortress_argv += ['--lines', line_range]
+  if args.style:
+    fortress_argv += ['--style', args.style]
+  if args.strict:
+    fortress_argv.append('--strict')
+
+  stdin = sys.stdin
+  sys.stdin = io.TextIOWrapper(io.BytesIO(source.encode('utf-8',
+                                                        'surrogateescape')),
+                               encoding='utf-8', errors='surrogateescape')
+  try:
+    return fortress.main(fortress_argv)
+  finally:
+    sys.stdin = stdin
+
+
+def _SpawnServer(socket_path):
+  """Start 'fortress --serve' in the background."""
+  import subprocess
+
+  command = [sys.executable, '-m', 'fortress', '--serve']
+  if socket_path:
+    command += ['--socket', socket_path]
+  with open(os.devnull, 'r+b') as devnull:
+    subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull,
+                     close_fds=True, start_new_session=True)
+
+
+def run_main():
+  sys.exit(main(sys.argv))
+
+
+if __name__ == '__main__':
+  run_main()
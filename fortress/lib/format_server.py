@@ -0,0 +1,226 @@
+"""Long-running FORTRESS server for editor integrations.
+
+'fortress --serve' keeps a process with everything imported, the patterns
+compiled and the styles loaded, and formats code sent to it over a Unix
+domain socket. Editors then pay for a connection instead of starting Python
+for every format command. The client side, and the framing of the messages,
+is in format_client.
+
+Every request is a JSON object with a 'command':
+
+  format : formats 'source' like fortress_api.FormatCode(). Optional are
+           'lines', a list of [start, end] ranges, 'style', the absolute path
+           of a style.ini, and 'strict', to use the strict style. The
+           response has the 'formatted' code and whether it 'changed'.
+  ping   : responds with the FORTRESS 'version'.
+  stop   : stops the server.
+
+Failed requests get a response with an 'error' message instead. Clients are
+served concurrently; the server exits once no client connected for its idle
+timeout. Only clients of the same user are served, as far as the system
+tells the user of a client; see format_client.
+"""
+
+import errno
+import logging
+import os
+import socket
+import socketserver
+import threading
+import timeit
+
+from fortress.lib import format_client
+from fortress.lib import fortress_style
+from fortress.lib import reformatter
+
+# Seconds without requests after which the server exits.
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+
+_clock = timeit.default_timer
+
+
+def Serve(socket_path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+  """Serve format requests on a Unix domain socket until idle or stopped.
+
+  Arguments:
+    socket_path  : (unicode) The path of the socket, by default
+                   format_client.DefaultSocketPath().
+    idle_timeout : (float) Seconds without requests after which to exit.
+
+  Raises:
+    socket.error: If another server already listens on socket_path, or the
+      socket cannot be created.
+  """
+  if socket_path is None:
+    socket_path = format_client.DefaultSocketPath()
+    format_client.MakePrivateDirectory(os.path.dirname(socket_path))
+  _RemoveStaleSocket(socket_path)
+
+  # Only the user may connect.
+  umask = os.umask(0o077)
+  try:
+    server = _Server(socket_path, idle_timeout)
+  finally:
+    os.umask(umask)
+
+  logging.info('Serving on %s', socket_path)
+  try:
+    while not server.IsDone():
+      server.handle_request()
+  finally:
+    server.server_close()
+    try:
+      os.remove(socket_path)
+    except OSError:
+      pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  """Unix stream server that knows when it has been idle for long enough."""
+
+  daemon_threads = True
+
+  def __init__(self, socket_path, idle_timeout):
+    socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+    self.idle_timeout = idle_timeout
+    # handle_request() returns at least this often to check for idleness
+    self.timeout = min(idle_timeout, 5.0)
+    self.stopped = False
+    self._active = 0
+    self._last_active = _clock()
+    self._lock = threading.Lock()
+    self._plans = {}
+
+  def verify_request(self, request, client_address):
+    uid = format_client.PeerUid(request)
+    if uid is not None and uid != os.getuid():
+      logging.warning('Refused a client of user %d', uid)
+      return False
+    return True
+
+  def IsDone(self):
+    with self._lock:
+      return self.stopped or (not self._active and
+                              _clock() - self._last_active > self.idle_timeout)
+
+  def Stop(self):
+    with self._lock:
+      self.stopped = True
+
+  def Enter(self):
+    with self._lock:
+      self._active += 1
+
+  def Leave(self):
+    with self._lock:
+      self._active -= 1
+      self._last_active = _clock()
+
+  def GetPlan(self, path, strict):
+    """Return the compiled style for a request, loading and compiling every
+    style only once."""
+    if strict:
+      key = ('strict',)
+    elif not path:
+      key = ('default',)
+    else:
+      try:
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+      except OSError:
+        key = (path, None, None)
+    with self._lock:
+      plan = self._plans.get(key)
+    if plan is None:
+      if strict:
+        style = fortress_style.CreateStrictStyle()
+      elif not path:
+        style = fortress_style.CreateFortran2003Style()
+      else:
+        style = fortress_style.CreateStyleFromConfig(path)
+        if style is None:
+          raise ValueError('%s has no [style] section' % path)
+      plan = reformatter.CompileStyle(style)
+      with self._lock:
+        self._plans[key] = plan
+    return plan
+
+  def Format(self, request):
+    """Format the code of a request, as fortress_api.FormatCode() does but
+    with the plan of its style rather than the global style, so that
+    requests are formatted concurrently."""
+    source = request.get('source')
+    if not isinstance(source, str):
+      raise ValueError("'source' must be a string")
+    lines = request.get('lines')
+    if lines:
+      lines = [tuple(line) for line in lines]
+    plan = self.GetPlan(request.get('style'), request.get('strict'))
+
+    if not source.endswith('\n'):
+      source += '\n'
+    reform = reformatter.Reformatter(lines=lines, plan=plan)
+    formatted = reform.formatLines(reformatter.SplitLines(source))
+    return {'formatted': formatted, 'changed': bool(reform.changedLines)}
+
+
+class _Handler(socketserver.BaseRequestHandler):
+  """Answers the requests of one connection until it is closed."""
+
+  def handle(self):
+    self.server.Enter()
+    try:
+      while True:
+        try:
+          request = format_client.ReceiveMessage(self.request)
+        except format_client.ProtocolError as err:
+          format_client.SendMessage(self.request, {'error': str(err)})
+          return
+        if request is None:
+          return
+        format_client.SendMessage(self.request, self._Respond(request))
+    except socket.error as err:
+      logging.warning('Lost client: %s', err)
+    finally:
+      self.server.Leave()
+
+  def _Respond(self, request):
+    import fortress
+
+    command = request.get('command', 'format')
+    try:
+      if command == 'format':
+        return self.server.Format(request)
+      elif command == 'ping':
+        return {'version': fortress.__version__}
+      elif command == 'stop':
+        self.server.Stop()
+        return {}
+      return {'error': 'unknown command %r' % command}
+    except Exception as err:  # pylint: disable=broad-except
+      logging.exception('Failed request')
+      return {'error': '%s: %s' % (type(err).__name__, err)}
+
+
+def _RemoveStaleSocket(socket_path):
+  """Remove the socket of a server that is gone.
+
+  Raises:
+    socket.error: If a server still listens on socket_path, or something not
+      a socket of the current user is there.
+  """
+  if not os.path.lexists(socket_path):
+    return
+  format_client.CheckOwner(socket_path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except socket.error as err:
+    if err.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+      raise
+    os.remove(socket_path)
+  else:
+    raise socket.error(errno.EADDRINUSE,
+                       'a server is listening on %s already' % socket_path)
+  finally:
+    sock.close()
@@ -4,6 +4,20 @@ The main APIs that FORTRESS exposes to drive the reformatting.
 
   FormatFile(): reformat a file.
   FormatCode(): reformat a string of code.
+  FormatStream(): reformat code read from a file object, writing it out as it
+    goes.
+  CheckCode(), CheckStream(): tell whether code would change, without
+    reformatting more of it than it takes to find the first change.
+  IterFormatFiles(): reformat many files, possibly in parallel, yielding the
+    results as they become available.
+  FormatFileAsync(), FormatFilesAsync(): reformat files from asyncio code,
+    reading and writing them in threads so as not to block the event loop.
+  LookupCachedFile(), ReadSourceFile(), FormatSource(): the steps of
+    FormatFile() apart, for callers that run them in pools of their own.
+  FormatCodeBatch(): reformat many strings of code with the same style,
+    sharing the work common to all of them.
+  IndexBlocks(): index the block structure of a string of code, for the
+    depth, enclosing block and matching line of any line.
 
 These APIs have some common arguments:
 
@@ -14,74 +28,475 @@ These APIs have some common arguments:
 
   print_diff: (bool) Instead of returning the reformatted source, return a
     diff that turns the formatted source into reformatter source.
+
+  check: (bool) Instead of returning the reformatted source, return None and
+    only tell whether the source would change, as CheckCode() does.
+
+  metrics: (fortress_metrics.Metrics) A collector to record timings and
+    counters of the files formatted in, or None.
 """
 
-import difflib
+import os
 import re
 import sys
 
 from fortress.lib import file_resources # Writing and reading files
 from fortress.lib import reformatter    # Doing the real work
-from fortress.lib import py3compat
 from fortress.lib import fortress_style
-
-from lib2to3.pgen2 import tokenize      # For encoding in ReadFile - alt: chardet
+from fortress.lib import fortress_metrics
 
 def FormatFile(filename,
                lines=None,
                print_diff=False,
                in_place=False,
-               logger=None):
+               logger=None,
+               cache=None,
+               metrics=None,
+               writer=None,
+               check=False):
   """Format a single Fortran file and return the formatted code.
 
   Arguments:
     filename  : (unicode) The file to reformat.
     lines     : (tuple) Lines to reformat
     in_place  : (bool) If True, write the reformatted code back to the file.
+                Files that did not change are not written to.
     logger    : (io streamer) A stream to output logging.
+    cache     : (result_cache.ResultCache) Cache of files known to be
+                formatted. A file found in it is reported as unchanged
+                without being reformatted. Not used together with lines.
+    writer    : (file_resources.InPlaceWriter) The writer to replace the file
+                with, if in_place; the file is then replaced when the writer
+                commits. By default it is replaced before returning.
     remaining : see comment at the top of this module.
 
   Returns:
     Tuple of (reformatted_code, encoding, changed). reformatted_code is None if
-    the file is sucessfully written to (having used in_place). reformatted_code
-    is a diff if print_diff is True.
+    the file is sucessfully written to (having used in_place) or if check is
+    True. reformatted_code is a diff if print_diff is True.
 
   Raises:
     IOError    : raised if there was an error reading the file.
-    ValueError : raised if in_place and print_diff are both specified.
+    ValueError : raised if more than one of in_place, print_diff and check
+                 are specified.
   """
   _CheckPythonVersion()
 
-  if in_place and print_diff:
-    raise ValueError('Cannot pass both in_place and print_diff.')
-
-  original_source, encoding = ReadFile(filename, logger)
+  if in_place + print_diff + check > 1:
+    raise ValueError('Cannot pass more than one of in_place, print_diff and '
+                     'check.')
+
+  if lines:
+    cache = None
+  if metrics is None:
+    metrics = fortress_metrics.NULL_METRICS
+
+  with metrics.File(filename):
+    reformatted_code, encoding, changed = _FormatFile(filename, lines,
+                                                      print_diff, in_place,
+                                                      logger, cache, metrics,
+                                                      writer, check)
+    metrics.Count(changed=changed)
+  return reformatted_code, encoding, changed
+
+
+def _FormatFile(filename, lines, print_diff, in_place, logger, cache,
+                metrics, writer, check):
+  """Format a single Fortran file; see FormatFile()."""
+  result = LookupCachedFile(filename, cache, print_diff=print_diff,
+                            in_place=in_place, check=check, metrics=metrics)
+  if result is not None:
+    return result
+
+  original_source, encoding, stat = ReadSourceFile(filename, logger, metrics)
+  reformatted_source, changed = FormatSource(original_source,
+                                             filename=filename,
+                                             encoding=encoding,
+                                             stat=stat,
+                                             lines=lines,
+                                             print_diff=print_diff,
+                                             check=check,
+                                             cache=cache,
+                                             metrics=metrics)
+  if check:
+    return None, encoding, changed
 
-  # Reformat code:
-  reformatted_source, changed = FormatCode(original_source,
-                                           filename=filename,
-                                           lines=lines,
-                                           print_diff=print_diff)
   if in_place:
-    if original_source:
-      file_resources.WriteReformattedCode(filename, reformatted_source,
-                                          in_place, encoding)
+    # Unchanged files keep their modification time.
+    if changed:
+      with metrics.Stage('write'):
+        if writer is None:
+          file_resources.WriteReformattedCode(filename, reformatted_source,
+                                              in_place, encoding)
+        else:
+          writer.Write(filename, reformatted_source, encoding)
     return None, encoding, changed
 
   return reformatted_source, encoding, changed
 
 
+def LookupCachedFile(filename, cache, print_diff=False, in_place=False,
+                     check=False, metrics=None):
+  """The first step of FormatFile(): look the file up in the cache.
+
+  A file untouched since it was found formatted need not even be read, unless
+  the code is to be returned.
+
+  Arguments:
+    filename  : (unicode) The file to reformat.
+    cache     : (result_cache.ResultCache) See FormatFile(), or None.
+    remaining : see comment at the top of this module.
+
+  Returns:
+    What FormatFile() returns for the file if the cache tells, else None.
+  """
+  if cache is None or not (in_place or print_diff or check):
+    return None
+  encoding = cache.LookupFile(filename)
+  if encoding is None:
+    return None
+  (metrics or fortress_metrics.NULL_METRICS).Count(cached=True)
+  return ('' if print_diff else None), encoding, False
+
+
+def ReadSourceFile(filename, logger=None, metrics=None):
+  """The second step of FormatFile(): read the file.
+
+  Arguments:
+    filename  : (unicode) The file to reformat.
+    logger    : (function) A function or lambda that takes a string and emits
+                it; see ReadFile().
+    remaining : see comment at the top of this module.
+
+  Returns:
+    Tuple of (source, encoding, stat), stat being that of the file as it was
+    read, for result_cache.ResultCache.Record().
+
+  Raises:
+    IOError: raised if there was an error reading the file.
+  """
+  if metrics is None:
+    metrics = fortress_metrics.NULL_METRICS
+  with metrics.Stage('read'):
+    source, encoding, stat = _ReadFile(filename, logger)
+  if metrics.enabled:
+    metrics.Count(bytes=stat.st_size, lines=source.count('\n'))
+  return source, encoding, stat
+
+
+def FormatSource(source,
+                 filename='<unknown>',
+                 encoding=None,
+                 stat=None,
+                 lines=None,
+                 print_diff=False,
+                 check=False,
+                 cache=None,
+                 metrics=None):
+  """The third step of FormatFile(): format the code read from the file.
+
+  Code the cache knows to be formatted is not formatted again, and code found
+  unchanged is recorded in the cache, under the encoding and stat it was read
+  with. The code is not written back; that is left to the caller.
+
+  Arguments:
+    source    : (unicode) The code read by ReadSourceFile().
+    filename  : (unicode) The file the code was read from.
+    encoding  : (unicode) The encoding of the file.
+    stat      : (os.stat_result) The stat of the file as it was read.
+    cache     : (result_cache.ResultCache) See FormatFile(), or None.
+    remaining : see comment at the top of this module.
+
+  Returns:
+    Tuple of (reformatted_source, changed); reformatted_source is None if
+    check is True and a diff if print_diff is True.
+  """
+  if metrics is None:
+    metrics = fortress_metrics.NULL_METRICS
+  if cache is not None and cache.LookupSource(source, filename):
+    reformatted_source = '' if print_diff else source
+    changed = False
+    metrics.Count(cached=True)
+  elif check:
+    reformatted_source = None
+    changed = CheckCode(source, lines=lines, metrics=metrics,
+                        filename=filename)
+  else:
+    reformatted_source, changed = FormatCode(source,
+                                             filename=filename,
+                                             lines=lines,
+                                             print_diff=print_diff,
+                                             metrics=metrics)
+  if cache is not None and not changed:
+    cache.Record(filename, source, encoding, stat)
+  if check:
+    reformatted_source = None
+  return reformatted_source, changed
+
+
+def IterFormatFiles(filenames,
+                    lines=None,
+                    print_diff=False,
+                    in_place=False,
+                    jobs=1,
+                    logger=None,
+                    cache=None,
+                    metrics=None,
+                    check=False):
+  """Format several Fortran files and yield the results one by one.
+
+  With jobs > 1 the files are handed to a pool of worker processes, largest
+  files first, so that a single huge file does not hold up the end of the run;
+  all filenames are collected for that first. Otherwise each file is formatted
+  as soon as filenames generates it.
+  The results are yielded in the order in which the files finish, not in the
+  order of filenames. The current global style is passed on to the workers,
+  and what the workers record is merged into metrics.
+
+  Arguments:
+    filenames : (iterable of unicode) The files to reformat.
+    lines     : (list or dict) The lines to reformat in every file, or a dict
+                of the lines to reformat by filename.
+    jobs      : (int) Number of worker processes; 1 formats in this process.
+    logger    : (io streamer) A stream to output logging.
+    cache     : (result_cache.ResultCache) See FormatFile().
+    remaining : see comment at the top of this module.
+
+  Yields:
+    Tuples of (filename, result), where result is the tuple returned by
+    FormatFile() for that file.
+
+  Raises:
+    Whatever FormatFile() raises for the first failing file.
+  """
+  # The files are replaced in batches, the last one once all files are done
+  # or the first one failed.
+  writer = file_resources.InPlaceWriter() if in_place else None
+  try:
+    for result in _IterFormatFiles(filenames, lines, print_diff, in_place,
+                                   jobs, logger, cache, metrics, writer,
+                                   check):
+      yield result
+  finally:
+    if writer is not None:
+      writer.Commit()
+
+
+def _IterFormatFiles(filenames, lines, print_diff, in_place, jobs, logger,
+                     cache, metrics, writer, check):
+  """Format several Fortran files; see IterFormatFiles()."""
+  if jobs > 1:
+    filenames = list(filenames)
+  linesOf = lines.get if isinstance(lines, dict) else lambda _: lines
+  if jobs <= 1 or len(filenames) <= 1:
+    for filename in filenames:
+      _LogInfo('Reformatting %s', filename)
+      yield filename, FormatFile(filename,
+                                 lines=linesOf(filename),
+                                 print_diff=print_diff,
+                                 in_place=in_place,
+                                 logger=logger,
+                                 cache=cache,
+                                 metrics=metrics,
+                                 writer=writer,
+                                 check=check)
+    return
+
+  from concurrent import futures
+
+  executor = futures.ProcessPoolExecutor(
+      max_workers=min(jobs, len(filenames)),
+      initializer=fortress_style.SetGlobalStyle,
+      initargs=(fortress_style.GetGlobalStyle(),))
+  pending = {}
+  try:
+    for filename in sorted(filenames, key=_FileSizeOrZero, reverse=True):
+      kwargs = dict(lines=linesOf(filename),
+                    print_diff=print_diff,
+                    in_place=in_place,
+                    cache=cache,
+                    check=check)
+      if metrics is None:
+        future = executor.submit(_FormatFileInWorker, filename, **kwargs)
+      else:
+        future = executor.submit(_FormatFileInWorker, filename,
+                                 record=True,
+                                 trace_memory=metrics.trace_memory,
+                                 profile=metrics.profile,
+                                 **kwargs)
+      pending[future] = filename
+
+    for future in futures.as_completed(pending):
+      filename = pending.pop(future)
+      _LogInfo('Reformatted %s', filename)
+      try:
+        result, staged, records, profile_stats = future.result()
+      except IOError as err:
+        if logger:
+          logger(err)
+        raise
+      for write in staged:
+        writer.Add(write)
+      if metrics is not None:
+        metrics.AddFiles(records)
+        metrics.AddProfile(profile_stats)
+      yield filename, result
+  finally:
+    for future in pending:
+      future.cancel()
+    executor.shutdown(wait=True)
+    # The files of results not yielded are left as they are.
+    leftover = file_resources.InPlaceWriter(batch_size=0)
+    for future in pending:
+      if not future.cancelled() and future.exception() is None:
+        for write in future.result()[1]:
+          leftover.Add(write)
+    leftover.Discard()
+
+
+def _FormatFileInWorker(filename, record=False, trace_memory=False,
+                        profile=False, **kwargs):
+  """Run FormatFile() in a worker process.
+
+  A file written in place is only staged, to be committed by the parent
+  process along with the files of the other workers.
+
+  Arguments:
+    record       : (bool) Whether to record what FormatFile() does.
+    trace_memory : (bool) See fortress_metrics.Metrics.
+    profile      : (bool) See fortress_metrics.Metrics.
+
+  Returns:
+    Tuple of (result, staged, records, profile_stats): the result of
+    FormatFile(), the writes staged, and the records of the file and the raw
+    profile statistics if recording, otherwise None.
+  """
+  writer = file_resources.InPlaceWriter(batch_size=0)
+  if not record:
+    result = FormatFile(filename, writer=writer, **kwargs)
+    return result, writer.Detach(), None, None
+
+  metrics = fortress_metrics.Metrics(trace_memory=trace_memory,
+                                     profile=profile)
+  metrics.StartProfile()
+  try:
+    result = FormatFile(filename, metrics=metrics, writer=writer, **kwargs)
+  finally:
+    profile_stats = metrics.StopProfile()
+  return result, writer.Detach(), metrics.files, profile_stats
+
+
+def FormatFileAsync(filename,
+                    lines=None,
+                    print_diff=False,
+                    in_place=False,
+                    logger=None,
+                    check=False,
+                    io_executor=None,
+                    format_executor=None,
+                    cache=None,
+                    metrics=None):
+  """Format a single Fortran file without blocking the event loop.
+
+  Like FormatFile(), taking the same steps with the same cache, but a
+  coroutine: the file is read and written in io_executor and formatted in
+  format_executor. What it takes is added to metrics once it is done.
+
+  Arguments:
+    filename        : (unicode) The file to reformat.
+    lines           : (tuple) Lines to reformat
+    in_place        : (bool) If True, write the reformatted code back to the
+                      file. Files that did not change are not written to.
+    logger          : (io streamer) A stream to output logging.
+    cache           : (result_cache.ResultCache) See FormatFile().
+    io_executor     : (concurrent.futures.Executor) The pool of threads to
+                      read and write in; by default that of the event loop.
+    format_executor : (concurrent.futures.Executor) The pool to format in,
+                      by default io_executor. A pool of processes has to set
+                      the global style of its processes, as IterFormatFiles()
+                      does.
+    remaining       : see comment at the top of this module.
+
+  Returns:
+    A coroutine returning what FormatFile() returns.
+  """
+  from fortress.lib import format_async
+  return format_async.FormatFileAsync(filename,
+                                      lines=lines,
+                                      print_diff=print_diff,
+                                      in_place=in_place,
+                                      logger=logger,
+                                      check=check,
+                                      io_executor=io_executor,
+                                      format_executor=format_executor,
+                                      cache=cache,
+                                      metrics=metrics)
+
+
+def FormatFilesAsync(filenames,
+                     lines=None,
+                     print_diff=False,
+                     in_place=False,
+                     logger=None,
+                     check=False,
+                     concurrency=8,
+                     processes=0,
+                     cache=None,
+                     metrics=None):
+  """Format several Fortran files without blocking the event loop.
+
+  Like IterFormatFiles(), but an asynchronous iterator, to be used with
+  'async for'. Files are read and written in a pool of concurrency threads,
+  and formatted in the same pool or, with processes > 0, in a pool of as many
+  processes. No more than concurrency files are in flight at a time, and more
+  are only started as the results are consumed. Breaking out of the loop or
+  cancelling it cancels the files not started yet; see format_async.
+
+  Arguments:
+    filenames   : (iterable of unicode) The files to reformat.
+    lines       : (list or dict) The lines to reformat in every file, or a
+                  dict of the lines to reformat by filename.
+    logger      : (io streamer) A stream to output logging.
+    cache       : (result_cache.ResultCache) See FormatFile().
+    concurrency : (int) The most files to read, format and write at a time.
+    processes   : (int) Number of worker processes to format in; 0 formats
+                  in the threads.
+    remaining   : see comment at the top of this module.
+
+  Yields:
+    Tuples of (filename, result) in the order in which the files finish,
+    where result is the tuple returned by FormatFile() for that file.
+
+  Raises:
+    Whatever FormatFile() raises for the first failing file.
+  """
+  from fortress.lib import format_async
+  return format_async.FormatFilesAsync(filenames,
+                                       lines=lines,
+                                       print_diff=print_diff,
+                                       in_place=in_place,
+                                       logger=logger,
+                                       check=check,
+                                       concurrency=concurrency,
+                                       processes=processes,
+                                       cache=cache,
+                                       metrics=metrics)
+
+
 def FormatCode(unformatted_source,
                filename='<unknown>',
                lines=None,
-               print_diff=False):
+               print_diff=False,
+               metrics=None):
   """Format a string of Fortran code.
 
   This provides an alternative entry point to FORTRESS.
 
   Arguments:
     unformatted_source  : (unicode) The code to format.
-    filename            : (unicode) The name of the file being reformatted.
+    filename            : (unicode) The name of the file being reformatted;
+                          its extension tells the form of the code if the
+                          code itself does not.
     remaining arguments : see comment at the top of this module.
 
   Returns:
@@ -90,26 +505,220 @@ def FormatCode(unformatted_source,
   """
   _CheckPythonVersion()
 
+  if metrics is None:
+    metrics = fortress_metrics.NULL_METRICS
+
   if not unformatted_source.endswith('\n'):
     unformatted_source += '\n'
 
-  # Reformat:
-  Reform = reformatter.Reformatter(unformatted_source, lines)
-  Reform.reformat()
-  reformatted_source = Reform.generateCodeLines()
+  # Reformat, tokenizing and generating the code in the same pass; given
+  # lines, only the lines the ranges depend on are tokenized and reformatted.
+  with metrics.Stage('reformat'):
+    Reform = reformatter.Reformatter(lines=lines, filename=filename)
+    reformatted_source = Reform.formatLines(
+        reformatter.SplitLines(unformatted_source))
 
-  if unformatted_source == reformatted_source:
+  # The lines are compared as they are rendered, not the whole strings.
+  if not Reform.changedLines:
+    metrics.Count(lines_changed=0)
     return '' if print_diff else reformatted_source, False
 
+  metrics.Count(lines_changed=len(Reform.changedLines))
+
+  if not print_diff:
+    return reformatted_source, True
+
   # Diff:
-  code_diff = _GetUnifiedDiff(unformatted_source,
-                              reformatted_source,
-                              filename=filename)
+  with metrics.Stage('diff'):
+    code_diff = _GetUnifiedDiff(Reform, filename=filename)
+  return code_diff, True
+
 
-  if print_diff:
-    return code_diff, code_diff != ''
+def FormatCodeBatch(sources, style=None, lines=None, filename='<unknown>'):
+  """Format many strings of Fortran code with the same style.
 
-  return reformatted_source, True
+  This is for formatting many small pieces of code, like the hunks of a diff,
+  where the work FormatCode() does for every call would add up: the
+  environment is checked and the style compiled once for the batch, and all
+  sources are formatted in turn by the same Reformatter. No diff is made
+  unless one is asked for.
+
+  Arguments:
+    sources             : (iterable of unicode) The pieces of code to format.
+    style               : (dict) The style to format with; by default the
+                          global style.
+    lines               : (list of tuples) The ranges of lines to format, in
+                          every source.
+    filename            : (unicode) The name the sources go by in diffs, and
+                          which tells their form as for FormatCode().
+
+  Returns:
+    A list of a FormatResult for every source, in the order of sources.
+  """
+  _CheckPythonVersion()
+
+  reform = reformatter.Reformatter(lines=lines,
+                                   plan=reformatter.CompileStyle(style),
+                                   filename=filename)
+  results = []
+  for source in sources:
+    if not source.endswith('\n'):
+      source += '\n'
+    output = reform.formatLines(reformatter.SplitLines(source))
+    results.append(FormatResult(output, reform.sourceLines,
+                                reform.changedLines, filename))
+  return results
+
+
+class FormatResult(object):
+  """The result of formatting one piece of code by FormatCodeBatch().
+
+  Attributes:
+    output  : (unicode) The reformatted code.
+    changed : (bool) Whether the code changed.
+  """
+
+  __slots__ = ('output', 'changed', '_sourceLines', '_changedLines',
+               '_filename', '_diff')
+
+  def __init__(self, output, sourceLines, changedLines, filename):
+    self.output = output
+    self.changed = bool(changedLines)
+    # Only what a diff is made of is kept, and only for changed code.
+    self._sourceLines = sourceLines if changedLines else None
+    self._changedLines = changedLines
+    self._filename = filename
+    self._diff = None
+
+  @property
+  def diff(self):
+    """The unified diff of the changes, made when first asked for; '' if the
+    code did not change."""
+    if self._diff is None:
+      self._diff = _UnifiedDiff(self._sourceLines, self._changedLines,
+                                self._filename, 3)
+      self._sourceLines = self._changedLines = None
+    return self._diff
+
+
+def FormatStream(in_fp, out_fp, lines=None, filename='<unknown>',
+                 metrics=None):
+  """Format Fortran code read from one file object into another.
+
+  The code is read and written line by line, and only a small window of lines
+  is held in memory, so the size of the code does not matter.
+
+  Arguments:
+    in_fp               : (file) A text file object to read the code from.
+    out_fp              : (file) A text file object to write the reformatted
+                          code to.
+    filename            : (unicode) The name the code is recorded under in
+                          metrics, and which tells its form as for
+                          FormatCode().
+    remaining arguments : see comment at the top of this module.
+
+  Returns:
+    True if the code changed.
+  """
+  _CheckPythonVersion()
+
+  if metrics is None:
+    metrics = fortress_metrics.NULL_METRICS
+
+  # The stages are interleaved line by line, so only the totals are recorded.
+  with metrics.File(filename):
+    reform = reformatter.Reformatter(lines=lines, filename=filename)
+    num_lines = 0
+    lines_changed = 0
+    for line, reformatted_line in reform.iterRenderedLines(
+        _IterLines(in_fp)):
+      num_lines += 1
+      if reformatted_line[:-1] != line:
+        lines_changed += 1
+      out_fp.write(reformatted_line)
+    metrics.Count(lines=num_lines, lines_changed=lines_changed,
+                  changed=lines_changed > 0)
+  return lines_changed > 0
+
+
+def CheckCode(unformatted_source, lines=None, metrics=None, filename=None):
+  """Tell whether formatting a string of Fortran code would change it.
+
+  The lines are reformatted one by one and compared to the original ones, and
+  no more lines are reformatted than it takes to find the first one that
+  changes. Neither the reformatted code nor a diff is built.
+
+  Arguments:
+    unformatted_source  : (unicode) The code to check.
+    filename            : (unicode) The name of the file of the code, which
+                          tells its form if the code does not.
+    remaining arguments : see comment at the top of this module.
+
+  Returns:
+    True if FormatCode() would change the code.
+  """
+  _CheckPythonVersion()
+
+  if metrics is None:
+    metrics = fortress_metrics.NULL_METRICS
+
+  with metrics.Stage('check'):
+    return _CheckLines(reformatter.SplitLines(unformatted_source), lines,
+                       filename)
+
+
+def CheckStream(in_fp, lines=None, filename=None):
+  """Tell whether formatting code read from a file object would change it.
+
+  See CheckCode(). The code is read line by line, and no further than to the first line that
+  changes.
+
+  Arguments:
+    in_fp               : (file) A text file object to read the code from.
+    filename            : (unicode) As for CheckCode().
+    remaining arguments : see comment at the top of this module.
+
+  Returns:
+    True if the code would change.
+  """
+  _CheckPythonVersion()
+
+  return _CheckLines(_IterLines(in_fp), lines, filename)
+
+
+def _CheckLines(sourceLines, lines, filename):
+  """Return True if any of the lines of source code changes."""
+  reform = reformatter.Reformatter(lines=lines, filename=filename)
+  renderedLines = reform.iterRenderedLines(sourceLines)
+  try:
+    for line, text in renderedLines:
+      if text[:-1] != line:
+        return True
+  finally:
+    renderedLines.close()
+  return False
+
+
+def IndexBlocks(unformatted_source):
+  """Index the block structure of a string of Fortran code.
+
+  The code is tokenized line by line, as it is for reformatting, but nothing
+  is reformatted.
+
+  Arguments:
+    unformatted_source : (unicode) The code to index.
+
+  Returns:
+    A block_index.BlockIndex of the lines of the code.
+  """
+  _CheckPythonVersion()
+
+  from fortress.lib import block_index
+
+  reform = reformatter.Reformatter()
+  sourceLines = reform.detectForm(reformatter.SplitLines(unformatted_source))
+  return block_index.BlockIndex.FromCodeLines(reform.iterContinuations(
+      reform.iterTokenize(sourceLines)))
 
 
 def ReadFile(filename, logger=None):
@@ -124,58 +733,128 @@ def ReadFile(filename, logger=None):
     logger:  (function) A function or lambda that takes a string and emits it.
 
   Returns:
-    The contents of filename.
+    A tuple of the contents of filename and its encoding.
 
   Raises:
     IOError: raised if there was an error reading the file.
   """
-  try:
-    with open(filename, 'rb') as fd:
-      encoding = tokenize.detect_encoding(fd.readline)[0]
-  except IOError as err:
-    if logger:
-      logger(err)
-    raise
+  return ReadSourceFile(filename, logger)[:2]
 
+
+def _ReadFile(filename, logger):
+  """Read a file as ReadFile(), also returning its stat as it was read."""
   try:
-    with py3compat.open_with_encoding(filename,
-                                      mode='r',
-                                      encoding=encoding) as fd:
-      source = fd.read()
-    return source, encoding
+    return file_resources.ReadSource(filename)
   except IOError as err:
     if logger:
       logger(err)
     raise
 
 
-def _GetUnifiedDiff(before, after, filename='code'):
-  """Get a unified diff of the changes.
+def _IterLines(fp):
+  """Generate the lines of a file object without their line breaks."""
+  for line in fp:
+    if line[-1:] == '\n':
+      line = line[:-1]
+    yield line
+
+
+def _GetUnifiedDiff(reform, filename='code', context=3):
+  """Get a unified diff of the changes a Reformatter made.
+
+  The hunks are built straight from reform.changedLines, as every line is
+  rebuilt from one original line, so this takes time linear in the number of
+  changed lines rather than comparing the whole code. A rebuilt line may have
+  remarks below it, so it may replace its original line with several.
 
   Arguments:
-    before   : (unicode) The original source code.
-    after    : (unicode) The reformatted source code.
+    reform   : (reformatter.Reformatter) The Reformatter, after its
+               generateCodeLines() or formatLines() was called.
     filename : (unicode) The code's filename.
+    context  : (int) The number of unchanged lines around each change.
 
   Returns:
-    The unified diff text.
-  """
-  before = before.splitlines()
-  after = after.splitlines()
-  return '\n'.join(difflib.unified_diff(before,
-                                        after,
-                                        filename,
-                                        filename,
-                                        '(original)',
-                                        '(reformatted)',
-                                        lineterm='')) + '\n'
+    The unified diff text, or '' if nothing changed.
+  """
+  return _UnifiedDiff(reform.sourceLines, reform.changedLines, filename,
+                      context)
+
+
+def _UnifiedDiff(sourceLines, changedLines, filename, context):
+  """Get a unified diff of the changedLines of sourceLines; see above."""
+  if not changedLines:
+    return ''
+
+  # group the changes whose context lines touch or overlap
+  groups = []
+  for index in sorted(changedLines):
+    if groups and index - groups[-1][-1] - 1 <= 2 * context:
+      groups[-1].append(index)
+    else:
+      groups.append([index])
+
+  output = ['--- %s\t(original)' % filename,
+            '+++ %s\t(reformatted)' % filename]
+  offset = 0  # lines added by remarks before the current hunk
+  for group in groups:
+    start = max(0, group[0] - context)
+    end = min(len(sourceLines), group[-1] + 1 + context)
+    hunk = []
+    removed = []
+    added = []
+    for index in range(start, end):
+      text = changedLines.get(index)
+      if text is None:
+        hunk.extend(removed)
+        hunk.extend(added)
+        removed = []
+        added = []
+        hunk.append(' ' + sourceLines[index])
+      else:
+        removed.append('-' + sourceLines[index])
+        added.extend('+' + line for line in text[:-1].split('\n'))
+    hunk.extend(removed)
+    hunk.extend(added)
+
+    numAdded = end - start + sum(changedLines[index].count('\n') - 1
+                                 for index in group)
+    output.append('@@ -%s +%s @@' % (
+        _FormatRange(start, end - start),
+        _FormatRange(start + offset, numAdded)))
+    output.extend(hunk)
+    offset += numAdded - (end - start)
+  return '\n'.join(output) + '\n'
+
+
+def _FormatRange(start, length):
+  """Format a range of lines for a hunk header, as difflib does."""
+  if length == 1:
+    return '%d' % (start + 1)
+  if not length:
+    return '%d,0' % start
+  return '%d,%d' % (start + 1, length)
+
+
+def _LogInfo(msg, *args):
+  """Log an info message, unless the logging module was never imported.
+
+  Nothing can have been configured to show the message then, so importing the
+  module for it would only slow down the start.
+  """
+  logging = sys.modules.get('logging')
+  if logging is not None:
+    logging.info(msg, *args)
+
+
+def _FileSizeOrZero(filename):
+  """Return the size of filename in bytes, or 0 if it cannot be determined."""
+  try:
+    return os.path.getsize(filename)
+  except OSError:
+    return 0
+
 
 def _CheckPythonVersion():
-  errmsg = 'FORTRESS is only supported by Python 2.6 or 3.4+'
-  if sys.version_info[0] == 2:
-    if sys.version_info[1] < 6:
-      raise RuntimeError(errmsg)
-  elif sys.version_info[0] == 3:
-    if sys.version_info[1] < 4:
-      raise RuntimeError(errmsg)
+  if sys.version_info < (3, 7):
+    raise RuntimeError('FORTRESS is only supported by Python 3.7+')
 
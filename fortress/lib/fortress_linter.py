@@ -1,37 +1,317 @@
+"""Lint Fortran files with gfortran.
+
+The compiler is run with -fsyntax-only on every file, on as many files at a
+time as there are jobs, and what it reports on stderr is parsed into
+Diagnostic records. The output is parsed line by line, each line matched by
+anchored patterns, so the time taken is linear in the length of the output.
+Both layouts of gfortran are understood: the location on a line of its own,
+followed by an excerpt of the code and then the message, and the location
+and message on one line as with -fdiagnostics-plain-output.
+
+The diagnostics of a file can be cached, keyed by the contents and path of
+the file, the compiler and its flags. Linting with IterLintWaves() orders
+the files by the modules they use, see module_deps, and keys the diagnostics
+of every file with the contents of the files providing its modules as well,
+so that a change to one file invalidates those of the files depending on it.
+Diagnostics that depend on other files, like included ones, are not
+invalidated by changes to them.
+"""
+
 __date__    = "$Date: 2016/02/17 $"
 __license__ = "MIT"
 __author__ = "Roland Siegbert <r@rscircus.org>"
 
-import subprocess
+import collections
+import hashlib
+import json
+import os
 import re
+import subprocess
+
+DEFAULT_COMPILER = 'gfortran'
+
+DEFAULT_FLAGS = ('-fsyntax-only',  # perform syntax checks only
+                 '-Wall',          # print all warnings
+                 '-Wextra')
+
+# A message of the compiler. filename, line and column are those of the
+# location reported, line and column are None if there is none. severity is
+# 'error', 'fatal error', 'warning' or 'note', and option the warning option
+# the message is due to, like '-Wunused-variable', or None.
+Diagnostic = collections.namedtuple(
+    'Diagnostic', 'filename line column severity message option')
+
+# The location of a message, 'file:line:column:' or 'file:line.column:' in
+# older versions, possibly followed by the message.
+_LOCATION = re.compile(
+    r'^(?P<filename>.*?):(?P<line>\d+)[:.](?P<column>\d+)(?:-\d+)?:'
+    r'(?:\s*$| (?P<rest>.*)$)')
+
+# A message, possibly after the name of the program reporting it, like
+# 'f951: Fatal Error: ...'.
+_MESSAGE = re.compile(
+    r'^(?:[\w.+-]+: )?(?P<severity>(?i:fatal error|error|warning|note)): ?'
+    r'(?P<message>.*)$')
+
+# The option that enabled a warning, at the end of its message.
+_OPTION = re.compile(r' \[(-W[^\]\s]+)\]$')
+
+# Changes to the parser or the records invalidate the cached diagnostics.
+_CACHE_FORMAT = 2
+
+
+class LintError(Exception):
+  """Raised if the compiler cannot be run."""
+
+
+class FortranLinter(object):
+  """Use gfortran as linter."""
+
+  def __init__(self, compiler=DEFAULT_COMPILER, flags=DEFAULT_FLAGS, jobs=1,
+               cache=None):
+    """Lint with compiler and flags.
+
+    Arguments:
+      compiler : (unicode) The name or path of the compiler.
+      flags    : (sequence of unicode) The flags to pass to it.
+      jobs     : (int) The number of compilers to run at a time.
+      cache    : (result_cache.ResultCache) The cache to keep the diagnostics
+                 of files in, or None.
+    """
+    self.compiler = compiler
+    self.flags = tuple(flags)
+    self.jobs = jobs
+    self.cache = cache
+    self._compilerSignature = None
+
+  def Lint(self, filename, digest=None, refresh=False):
+    """Return the list of Diagnostics of the file filename.
+
+    Arguments:
+      filename : (unicode) The file to lint.
+      digest   : (unicode) What the diagnostics are cached by in place of the
+                 contents of the file, like the keys of
+                 module_deps.DependencyGraph.
+      refresh  : (bool) Run the compiler even if the diagnostics are cached,
+                 for the module files it writes.
+
+    Raises:
+      LintError: If the compiler cannot be run.
+    """
+    if self.cache is None:
+      return self._Compile(filename)
+
+    if digest is None:
+      try:
+        with open(filename, 'rb') as fd:
+          digest = hashlib.sha256(fd.read()).hexdigest()
+      except (IOError, OSError):
+        # the compiler reports it
+        return self._Compile(filename)
+    key = self._Key(filename, digest)
+    records = None if refresh else self.cache.LookupDiagnostics(key)
+    if records is not None:
+      return [Diagnostic(*record) for record in records]
+    diagnostics = self._Compile(filename)
+    self.cache.RecordDiagnostics(key, [list(d) for d in diagnostics])
+    return diagnostics
+
+  def IterLint(self, filenames):
+    """Lint files, jobs at a time.
+
+    Yields:
+      Tuples of (filename, diagnostics) in the order of filenames.
+
+    Raises:
+      LintError: If the compiler cannot be run.
+    """
+    if self.jobs <= 1:
+      for filename in filenames:
+        yield filename, self.Lint(filename)
+      return
+
+    # Compilers run in processes of their own; threads wait for them.
+    from concurrent import futures
+
+    filenames = list(filenames)
+    with futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      results = executor.map(self.Lint, filenames)
+      try:
+        for filename, diagnostics in zip(filenames, results):
+          yield filename, diagnostics
+      finally:
+        results.close()
+
+  def IterLintWaves(self, filenames):
+    """Lint files after the files providing the modules they use.
+
+    The files are linted in the waves of module_deps.DependencyGraph, jobs at
+    a time within a wave. With a cache, only the files changed and those
+    depending on them are linted again; files they depend on are only
+    compiled again if the module files they provide are gone.
+
+    Yields:
+      Tuples of (filename, diagnostics), wave after wave and in the order of
+      filenames within a wave.
+
+    Raises:
+      LintError: If the compiler cannot be run.
+    """
+    from fortress.lib import module_deps
+
+    graph = module_deps.DependencyGraph.FromFiles(filenames, jobs=self.jobs)
+    waves = graph.Waves()
+    keys = graph.Keys(waves)
+    refresh = self._Refresh(graph, keys) if self.cache is not None else ()
+
+    executor = None
+    if self.jobs > 1 and max(map(len, waves or [[]])) > 1:
+      from concurrent import futures
+      executor = futures.ThreadPoolExecutor(max_workers=self.jobs)
+    lint = lambda filename: self.Lint(filename, keys[filename],
+                                      filename in refresh)
+    try:
+      for wave in waves:
+        results = map(lint, wave) if executor is None or len(wave) == 1 \
+            else executor.map(lint, wave)
+        # the wave is done before any of the next starts
+        for filename, diagnostics in zip(wave, list(results)):
+          yield filename, diagnostics
+    finally:
+      if executor is not None:
+        executor.shutdown(wait=True)
+
+  def _Refresh(self, graph, keys):
+    """Return the files to compile for their module files, though their
+    diagnostics are cached: those providing modules that files to be linted
+    need, where the module files are gone."""
+    moduleDir = _ModuleDir(self.flags)
+    stale = [filename for filename in graph.files
+             if self.cache.LookupDiagnostics(
+                 self._Key(filename, keys[filename])) is None]
+    refresh = set()
+    seen = set(stale)
+    while stale:
+      filename = stale.pop()
+      for required in graph.scans[filename].requires:
+        provider = graph.providers.get(required)
+        if provider is None or provider in seen \
+            or os.path.exists(os.path.join(moduleDir, required)):
+          continue
+        seen.add(provider)
+        refresh.add(provider)
+        stale.append(provider)
+    return refresh
+
+  def _Compile(self, filename):
+    """Run the compiler on filename and parse what it reports."""
+    try:
+      process = subprocess.Popen([self.compiler] + list(self.flags)
+                                 + [filename],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+    except OSError as err:
+      raise LintError('cannot run %s: %s' % (self.compiler, err))
+    _, stderr = process.communicate()
+    return ParseDiagnostics(stderr.decode('utf-8', 'replace'), filename)
+
+  def _Key(self, filename, digest):
+    """Hash the digest of a file with what its diagnostics depend on."""
+    import fortress
+
+    if self._compilerSignature is None:
+      self._compilerSignature = _CompilerSignature(self.compiler)
+    key = hashlib.sha256()
+    key.update(json.dumps(['lint', _CACHE_FORMAT, fortress.__version__,
+                           self._compilerSignature, self.flags,
+                           os.getcwd(), os.path.abspath(filename)]
+                          ).encode('utf-8', 'surrogateescape'))
+    key.update(digest.encode('ascii'))
+    return key.hexdigest()
+
+
+def ParseDiagnostics(output, filename=None):
+  """Parse the diagnostics gfortran writes to stderr.
+
+  Arguments:
+    output   : (unicode) What the compiler wrote.
+    filename : (unicode) The file the messages without a location are about.
+
+  Returns:
+    A list of Diagnostics, in the order of output.
+  """
+  diagnostics = []
+  location = None
+  for line in output.splitlines():
+    match = _LOCATION.match(line)
+    if match:
+      rest = match.group('rest')
+      message = _MESSAGE.match(rest) if rest else None
+      if message:
+        diagnostics.append(_Diagnostic(match.group('filename'),
+                                       int(match.group('line')),
+                                       int(match.group('column')), message))
+      elif location is None:
+        # A message referring to more than one location follows all of
+        # them, the first one being the location of (1).
+        location = (match.group('filename'), int(match.group('line')),
+                    int(match.group('column')))
+      continue
+
+    message = _MESSAGE.match(line)
+    if message:
+      if location is None:
+        location = (filename, None, None)
+      diagnostics.append(_Diagnostic(location[0], location[1], location[2],
+                                     message))
+      location = None
+  return diagnostics
+
+
+def _Diagnostic(filename, line, column, message):
+  text = message.group('message')
+  option = _OPTION.search(text)
+  if option:
+    text = text[:option.start()]
+  return Diagnostic(filename, line, column,
+                    message.group('severity').lower(), text,
+                    option.group(1) if option else None)
+
+
+def FormatDiagnostic(diagnostic):
+  """Return a diagnostic as a line like those of gcc, without line break."""
+  if diagnostic.line is None:
+    location = diagnostic.filename
+  else:
+    location = '%s:%d:%d' % (diagnostic.filename, diagnostic.line,
+                             diagnostic.column)
+  text = '%s: %s: %s' % (location, diagnostic.severity, diagnostic.message)
+  if diagnostic.option:
+    text += ' [%s]' % diagnostic.option
+  return text
+
+
+def _ModuleDir(flags):
+  """Return the directory the compiler writes module files to, given flags."""
+  for i, flag in enumerate(flags):
+    if flag == '-J' and i + 1 < len(flags):
+      return flags[i + 1]
+    if flag.startswith('-J') and len(flag) > 2:
+      return flag[2:]
+  return os.getcwd()
+
+
+def _CompilerSignature(compiler):
+  """Return what identifies the installed compiler: its path, mtime and
+  size, or just its name if it is not found."""
+  import shutil
 
-class FortranLinter:
-  """Use gfortran as linter"""
-  def __init__(self, fileName):
-
-    self.linter = "gfortran"
-    self.fileName = fileName
-
-  def lint(self):
-    p = subprocess.Popen([self.linter,
-                          '-fsyntax-only',  # perform syntax checks only
-                          '-Wall',          # print all warnings
-                          '-Wextra',
-                          self.fileName],
-                          stdout = subprocess.PIPE,
-                          stderr = subprocess.PIPE,
-                          stdin  = subprocess.PIPE)
-
-    # adding group names in Python style here => better identification
-    catchRe = "(.+):(?P<line>\\d+):(?P<col>\\d+):((.|\\n)*)(?P<type>(Error|Warning|Note)):\\s*(?P<message>.*)"
-
-    # execute linter:
-    stdOut, stdErr = p.communicate()
-    caughtIter = re.finditer(catchRe, stdErr)
-
-    # print errors:
-    for el in caughtIter:
-      print "Line:      " + el.group('line')
-      print "Column:    " + el.group('col')
-      print "Errortype: " + el.group('type')
-      print "Message:   " + el.group('message')
+  path = shutil.which(compiler)
+  try:
+    stat = os.stat(path)
+  except (OSError, TypeError):
+    # not found; the compiler cannot run then
+    return [compiler]
+  return [os.path.abspath(path), getattr(stat, 'st_mtime_ns', stat.st_mtime),
+          stat.st_size]
@@ -0,0 +1,209 @@
+"""Timings and counters of a FORTRESS run.
+
+A Metrics collector can be handed to the fortress_api functions to record,
+for every file formatted:
+
+  * its size in bytes and lines, and the number of lines changed,
+  * the seconds spent in each stage: read, reformat (which tokenizes and
+    generates the code in the same pass), diff, check and write,
+  * the peak memory allocated while formatting it, if memory is traced,
+
+and, for the whole run, the time of stages not tied to a file (like finding
+the files) plus a cProfile profile if profiling is enabled. Files formatted in
+worker processes are recorded there and merged into the collector.
+
+The records are plain dicts, so they can be dumped as JSON lines by
+WriteJsonLines(), followed by a Summary() of the run.
+"""
+
+import contextlib
+import timeit
+
+_clock = timeit.default_timer
+
+# The stages of formatting a file, in order.
+STAGES = ('read', 'reformat', 'diff', 'check', 'write')
+
+
+class Metrics(object):
+  """Collects per-file and per-run timings and counters.
+
+  Attributes:
+    files        : (list of dict) A record for every file formatted.
+    stages       : (dict) Seconds spent in stages outside of any file.
+    trace_memory : (bool) Whether the peak memory of every file is recorded.
+                   Tracing memory slows formatting down considerably.
+    profile      : (bool) Whether the run is profiled with cProfile.
+  """
+
+  enabled = True
+
+  def __init__(self, trace_memory=False, profile=False):
+    self.files = []
+    self.stages = {}
+    self.trace_memory = trace_memory
+    self.profile = profile
+    self._current = None
+    self._profiler = None
+    self._profile_stats = []
+    self._start_time = _clock()
+
+  @contextlib.contextmanager
+  def File(self, filename):
+    """Record the formatting of filename within the block.
+
+    Yields:
+      The record of the file, to which counters may be added.
+    """
+    record = {'file': filename, 'seconds': {}}
+    outer, self._current = self._current, record
+    tracemalloc = None
+    if self.trace_memory:
+      import tracemalloc
+      if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+      else:
+        tracemalloc.stop()
+        tracemalloc.start()
+    start = _clock()
+    try:
+      yield record
+    finally:
+      record['total_seconds'] = _clock() - start
+      if tracemalloc is not None:
+        record['peak_memory'] = tracemalloc.get_traced_memory()[1]
+      self._current = outer
+      self.files.append(record)
+
+  @contextlib.contextmanager
+  def Stage(self, name):
+    """Add the time spent within the block to the stage name.
+
+    The time is added to the file being recorded, if any, or to the run.
+    """
+    seconds = self._current['seconds'] if self._current else self.stages
+    start = _clock()
+    try:
+      yield
+    finally:
+      seconds[name] = seconds.get(name, 0.0) + _clock() - start
+
+  def Count(self, **counters):
+    """Set counters of the file being recorded, like lines=10."""
+    if self._current is not None:
+      self._current.update(counters)
+
+  def AddFiles(self, records):
+    """Add records of files formatted elsewhere, like in a worker."""
+    self.files.extend(records)
+
+  def StartProfile(self):
+    """Start profiling with cProfile, if profiling is enabled."""
+    if self.profile and self._profiler is None:
+      import cProfile
+      self._profiler = cProfile.Profile()
+      self._profiler.enable()
+
+  def StopProfile(self):
+    """Stop profiling.
+
+    Returns:
+      The raw profile statistics gathered since StartProfile(), as used by
+      pstats; None if not profiling.
+    """
+    if self._profiler is None:
+      return None
+    self._profiler.disable()
+    self._profiler.create_stats()
+    stats = self._profiler.stats
+    self._profiler = None
+    self._profile_stats.append(stats)
+    return stats
+
+  def AddProfile(self, stats):
+    """Add raw profile statistics gathered elsewhere, like in a worker."""
+    if stats:
+      self._profile_stats.append(stats)
+
+  def DumpProfile(self, filename):
+    """Write the profile of the run to filename in the format of pstats."""
+    import pstats
+
+    self.StopProfile()
+    profile = pstats.Stats(_ProfileStats(self._profile_stats[0]))
+    for stats in self._profile_stats[1:]:
+      profile.add(_ProfileStats(stats))
+    profile.dump_stats(filename)
+
+  def Summary(self):
+    """Return a dict summarizing the run."""
+    latencies = sorted(record['total_seconds'] for record in self.files)
+    stage_seconds = dict(self.stages)
+    for record in self.files:
+      for stage, seconds in record['seconds'].items():
+        stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+
+    summary = {
+        'files': len(self.files),
+        'changed_files': sum(1 for record in self.files
+                             if record.get('changed')),
+        'bytes': sum(record.get('bytes', 0) for record in self.files),
+        'lines': sum(record.get('lines', 0) for record in self.files),
+        'lines_changed': sum(record.get('lines_changed', 0)
+                             for record in self.files),
+        'wall_seconds': _clock() - self._start_time,
+        'stage_seconds': stage_seconds,
+        'latency_p50': _Percentile(latencies, 50),
+        'latency_p95': _Percentile(latencies, 95),
+        'latency_max': latencies[-1] if latencies else None,
+    }
+    if self.trace_memory:
+      summary['peak_memory'] = max([record.get('peak_memory', 0)
+                                    for record in self.files] or [0])
+    return summary
+
+  def WriteJsonLines(self, fp):
+    """Write a JSON line per file, followed by one with the summary."""
+    import json
+    for record in self.files:
+      fp.write(json.dumps(record, sort_keys=True) + '\n')
+    fp.write(json.dumps({'summary': self.Summary()}, sort_keys=True) + '\n')
+
+
+class _NullMetrics(object):
+  """A Metrics collector that records nothing."""
+
+  enabled = False
+  profile = False
+
+  @contextlib.contextmanager
+  def File(self, filename):
+    yield None
+
+  @contextlib.contextmanager
+  def Stage(self, name):
+    yield
+
+  def Count(self, **counters):
+    pass
+
+
+NULL_METRICS = _NullMetrics()
+
+
+class _ProfileStats(object):
+  """Raw profile statistics in the shape pstats.Stats() loads them from."""
+
+  def __init__(self, stats):
+    self.stats = stats
+
+  def create_stats(self):
+    pass
+
+
+def _Percentile(values, percent):
+  """Return the percentile of sorted values by the nearest rank."""
+  if not values:
+    return None
+  rank = max(1, int(-(-len(values) * percent // 100)))
+  return values[rank - 1]
@@ -2,15 +2,19 @@
 
 import os
 import re
-import textwrap
 
 #from fortress.lib import errors
 from fortress.lib import py3compat
+from fortress.lib import source_form
 
 def Get(setting_name):
   """Get a style setting."""
   return _style[setting_name]
 
+def GetGlobalStyle():
+  """Return a copy of the global style dict."""
+  return dict(_style)
+
 def SetGlobalStyle(style):
   """Set a style dict."""
   global _style
@@ -22,6 +26,7 @@ def CreateFortran2003Style():
     CONTI_INDENT_WIDTH=4,
     UNINDENT_PREPROCESSOR_DIRECTIVES=True,
     REPLACE_TABS_BY_SPACES=True,
+    SOURCE_FORM=source_form.AUTO,
     CONVERT_FIXED_TO_FREE=False,
     ADD_SPACES_AROUND_OPERATORS=False,
     FIX_LINE_ENDINGS=True,
@@ -35,6 +40,7 @@ def CreateStrictStyle():
     CONTI_INDENT_WIDTH=4,
     UNINDENT_PREPROCESSOR_DIRECTIVES=True,
     REPLACE_TABS_BY_SPACES=True,
+    SOURCE_FORM=source_form.AUTO,
     CONVERT_FIXED_TO_FREE=False,
     ADD_SPACES_AROUND_OPERATORS=True,
     FIX_LINE_ENDINGS=True,
@@ -85,11 +91,19 @@ def _BoolConverter(s):
   """Converter for booleans"""
   return py3compat.CONFIGPARSER_BOOLEAN_STATES[s.lower()]
 
+def _FormConverter(s):
+  """Converter for source forms: auto, fixed or free"""
+  if s.lower() not in source_form.FORMS:
+    raise ValueError('SOURCE_FORM must be one of %s'
+                     % ', '.join(source_form.FORMS))
+  return s.lower()
+
 _STYLE_CONVERTER = dict(
   INDENT_WIDTH=int,
   CONTI_INDENT_WIDTH=int,
   UNINDENT_PREPROCESSOR_DIRECTIVES=_BoolConverter,
   REPLACE_TABS_BY_SPACES=_BoolConverter,
+  SOURCE_FORM=_FormConverter,
   CONVERT_FIXED_TO_FREE=_BoolConverter,
   ADD_SPACES_AROUND_OPERATORS=_BoolConverter,
   FIX_LINE_ENDINGS=_BoolConverter,
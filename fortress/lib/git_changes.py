@@ -0,0 +1,112 @@
+"""Files and lines changed according to git.
+
+A pre-commit hook or a CI job only needs to format what a change touches.
+ChangedLines() asks the local git for the files changed against a commit or
+staged in the index, and for the lines changed in each of them, so the time
+taken depends on the size of the change rather than the size of the tree:
+
+  fortress --staged --changed-lines -i
+  fortress --changed-since origin/main --check
+"""
+
+import collections
+import os
+import re
+import subprocess
+
+# The header of a hunk with no context: '@@ -start[,count] +start[,count] @@'
+# The number of lines removed and the lines added are captured.
+_HUNK_HEADER = re.compile(r'^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+class GitError(Exception):
+  """Raised if git cannot tell what changed, e.g. outside of a repository."""
+
+
+def ChangedLines(ref=None, staged=False, paths=None):
+  """Return the files changed and the lines changed in them.
+
+  Files that were deleted are left out. The lines of a file are those added
+  or modified; a file of which lines were only removed has no lines.
+
+  Arguments:
+    ref    : (unicode) The commit to compare against; HEAD if staged.
+    staged : (bool) Compare the index rather than the working tree.
+    paths  : (list of unicode) Limit the files to these paths, as git
+             pathspecs.
+
+  Returns:
+    An OrderedDict of the list of line ranges, (start, end) and 1-based, by
+    the path of the file relative to the current directory.
+
+  Raises:
+    GitError: If git fails.
+  """
+  top = _Git(['rev-parse', '--show-toplevel']).rstrip('\n')
+
+  command = ['-c', 'core.quotePath=false', 'diff', '--no-color',
+             '--no-ext-diff', '--no-renames', '--unified=0',
+             '--diff-filter=ACMRT', '--src-prefix=a/', '--dst-prefix=b/']
+  if staged:
+    command.append('--cached')
+  if ref:
+    command.append(ref)
+  command.append('--')
+  command.extend(paths or ())
+
+  changes = collections.OrderedDict()
+  ranges = None
+  hunkLines = 0  # lines of the current hunk still to skip
+  for line in _Git(command).split('\n'):
+    if hunkLines:
+      # added or removed text, which may look like anything
+      if line[:1] in ('+', '-'):
+        hunkLines -= 1
+      continue
+    if line.startswith('+++ '):
+      # a path with blanks is followed by a tab
+      path = _Unquote(line[4:].rstrip('\t'))
+      if path.startswith('b/'):
+        path = os.path.relpath(os.path.join(top, path[2:]))
+        ranges = changes.setdefault(path, [])
+      else:
+        ranges = None  # /dev/null
+    elif line.startswith('@@ '):
+      match = _HUNK_HEADER.match(line)
+      if match:
+        removed = 1 if match.group(1) is None else int(match.group(1))
+        start = int(match.group(2))
+        added = 1 if match.group(3) is None else int(match.group(3))
+        hunkLines = removed + added
+        if added and ranges is not None:
+          ranges.append((start, start + added - 1))
+  return changes
+
+
+def _Git(args):
+  """Run git with args and return its output.
+
+  Raises:
+    GitError: If git cannot be run or fails.
+  """
+  try:
+    process = subprocess.Popen(['git'] + args,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+  except OSError as err:
+    raise GitError('cannot run git: %s' % err)
+  stdout, stderr = process.communicate()
+  if process.returncode:
+    raise GitError(stderr.decode('utf-8', 'replace').strip()
+                   or 'git %s failed' % args[0])
+  return stdout.decode('utf-8', 'surrogateescape')
+
+
+def _Unquote(path):
+  """Undo the C-style quoting git uses for unusual paths."""
+  if not path.startswith('"') or not path.endswith('"'):
+    return path
+  # The escapes are those of the bytes of the path.
+  raw = path[1:-1].encode('utf-8', 'surrogateescape')
+  return raw.decode('unicode_escape').encode('latin-1').decode(
+      'utf-8', 'surrogateescape')
@@ -0,0 +1,173 @@
+"""Single-pass lexer for Fortran source lines.
+
+The lexer breaks a line into a list of (kind, text) tokens in one scan, using
+patterns that are compiled once at import. UnwrappedLine fills its line parts
+from these tokens. The code itself is broken into names, string literals and
+other code by a second scan only when a later pass (indentation) needs it;
+those passes then read the tokens instead of matching the code text again.
+
+Token kinds:
+
+  PREPROCESSOR     : a whole preprocessor line
+  COMMENT_LINE     : a whole fixed-form comment line
+  LABEL            : a statement label, with its trailing blanks in free-form
+  CONTINUATION     : a leading continuation mark ('&' in free-form, columns
+                     1-6 in fixed-form)
+  CONTINUATION_END : a trailing '&' with its leading blanks (free-form only)
+  LEADING_SPACE    : blanks in front of the code
+  NAME             : keywords and names; Fortran has no reserved words
+  STRING           : a complete string literal
+  OPEN_STRING      : a string literal that is not closed on this line
+  CODE             : any other code, i.e. operators, brackets and blanks; as
+                     returned by Lex(), all of the code up to an open string
+  COMMENT_SPACE    : blanks in front of a '!' comment
+  COMMENT          : a '!' comment
+  TRAILING_SPACE   : trailing blanks
+
+Blanks in front of a fixed-form label are dropped.
+"""
+
+import re
+
+PREPROCESSOR = 'PREPROCESSOR'
+COMMENT_LINE = 'COMMENT_LINE'
+LABEL = 'LABEL'
+CONTINUATION = 'CONTINUATION'
+CONTINUATION_END = 'CONTINUATION_END'
+LEADING_SPACE = 'LEADING_SPACE'
+NAME = 'NAME'
+STRING = 'STRING'
+OPEN_STRING = 'OPEN_STRING'
+CODE = 'CODE'
+COMMENT_SPACE = 'COMMENT_SPACE'
+COMMENT = 'COMMENT'
+TRAILING_SPACE = 'TRAILING_SPACE'
+
+# Kinds that make up the code of a line.
+CODE_KINDS = frozenset([NAME, STRING, OPEN_STRING, CODE])
+
+# The parts of a free-form line without its trailing blanks. The code
+# alternatives consume everything but a '!' or a quote that is never closed,
+# so the match cannot fail and does not backtrack.
+_FREE_LINE = re.compile(r"""
+  (\s*)                                       # leading blanks
+  (\d+\s+(?![\s!]))?                          # label
+  (&(?:\s+(?![\s!]))?)?                       # leading '&'
+  ((?:[^!'"]+|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')*)   # code
+  (['"].*)?                                   # string literal left open
+  (!.*)?                                      # comment
+  """, re.VERBOSE | re.DOTALL)
+
+# Like _FREE_LINE, for the rest of a fixed-form line after columns 1-6.
+_FIXED_LINE = re.compile(r"""
+  (\s*)
+  ((?:[^!'"]+|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')*)
+  (['"].*)?
+  (!.*)?
+  """, re.VERBOSE | re.DOTALL)
+
+_FIXED_LABEL = re.compile(r"\s{0,4}(\d+)")
+
+_FIXED_COMMENT_CHARS = frozenset('cC*!')
+
+# The alternatives cover every character, so the matches are contiguous.
+_CODE = re.compile(r"""
+    (\w+)                                     # name or keyword
+  | ("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')     # string literal
+  | ([^\w'"]+)                                # operators, brackets, blanks
+  | (['"].*)                                  # string literal left open
+  """, re.VERBOSE | re.DOTALL)
+
+# Token kind by the index of the group that matched in _CODE.
+_CODE_KINDS = (None, NAME, STRING, CODE, OPEN_STRING)
+
+
+def Lex(line, isFreeForm):
+  """Break a line of source code into tokens.
+
+  The code is returned as one CODE token, followed by an OPEN_STRING token if
+  a string literal is left open. LexCode() breaks it up further.
+
+  Arguments:
+    line       : (unicode) The line without its line break; tabs should be
+                 replaced already.
+    isFreeForm : (bool) Whether the line is free-form code.
+
+  Returns:
+    The list of (kind, text) tokens of the line.
+  """
+  body = line.rstrip()
+  trailing = line[len(body):]
+  tokens = []
+
+  if not body:
+    pass
+  elif body[0] == '#':
+    tokens.append((PREPROCESSOR, body))
+  elif isFreeForm:
+    left, label, continuation, code, opening, comment = _FREE_LINE.match(
+        body).groups()
+    if left:
+      tokens.append((LEADING_SPACE, left))
+    if label:
+      tokens.append((LABEL, label))
+    if continuation:
+      tokens.append((CONTINUATION, continuation))
+    _AppendCode(tokens, code, opening, comment, True)
+  elif body[0] in _FIXED_COMMENT_CHARS:
+    tokens.append((COMMENT_LINE, body))
+  else:
+    match = _FIXED_LABEL.match(body)
+    if match:
+      tokens.append((LABEL, match.group(1)))
+      body = body[match.end():]
+    elif len(body) > 5 and body[5] == '&':
+      tokens.append((CONTINUATION, body[:6]))
+      body = body[6:]
+    left, code, opening, comment = _FIXED_LINE.match(body).groups()
+    if left:
+      tokens.append((LEADING_SPACE, left))
+    _AppendCode(tokens, code, opening, comment, False)
+
+  if trailing:
+    tokens.append((TRAILING_SPACE, trailing))
+  return tokens
+
+
+def LexCode(code):
+  """Break code into NAME, STRING, OPEN_STRING and CODE tokens."""
+  kinds = _CODE_KINDS
+  return [(kinds[m.lastindex], m.group()) for m in _CODE.finditer(code)]
+
+
+def _AppendCode(tokens, code, opening, comment, isFreeForm):
+  """Append the tokens of the code and comment of a line."""
+  commentSpace = None
+  if comment and not opening:
+    # The comment takes the blanks in front of it.
+    stripped = code.rstrip()
+    commentSpace = code[len(stripped):]
+    code = stripped
+
+  continuationEnd = None
+  if isFreeForm:
+    if opening:
+      if opening[-1] == '&':
+        stripped = opening[:-1].rstrip()
+        continuationEnd = opening[len(stripped):]
+        opening = stripped
+    elif code[-1:] == '&':
+      stripped = code[:-1].rstrip()
+      continuationEnd = code[len(stripped):]
+      code = stripped
+
+  if code:
+    tokens.append((CODE, code))
+  if opening:
+    tokens.append((OPEN_STRING, opening))
+  if continuationEnd:
+    tokens.append((CONTINUATION_END, continuationEnd))
+  if commentSpace:
+    tokens.append((COMMENT_SPACE, commentSpace))
+  if comment:
+    tokens.append((COMMENT, comment))
@@ -0,0 +1,200 @@
+"""Dependencies between Fortran files through the modules they use.
+
+A file that USEs a module can only be compiled, and so linted, once the file
+defining the module was compiled to a module file. The files of a tree are
+scanned for their MODULE, SUBMODULE and USE statements, which are matched
+over the raw bytes of each file with one pattern rather than tokenized, and
+a DependencyGraph of the files is built from them. Its Waves() are the
+files in topological order, each wave depending only on earlier ones, so
+that the files of a wave can be compiled in parallel.
+
+Dependencies are named by the module files compilers write, as gfortran
+names them:
+
+  MODULE m                    provides m.mod and m.smod
+  SUBMODULE (m) s             requires m.smod, provides m@s.smod
+  SUBMODULE (m:p) s           requires m@p.smod, provides m@s.smod
+  USE m                       requires m.mod
+
+Intrinsic modules, and modules no file provides, are left out.
+"""
+
+import collections
+import hashlib
+import re
+
+# The statements, one per line and in any case; a statement after a ';'
+# or split over lines before the module name is not seen. MODULE must be
+# followed by the name alone, which leaves out MODULE PROCEDURE and the
+# MODULE prefix of procedures.
+_STATEMENT = re.compile(
+    br'^[ \t]*(?:'
+    br'module[ \t]+(?P<module>\w+)[ \t]*(?:!.*)?\r?$'
+    br'|submodule[ \t]*\([ \t]*(?P<ancestor>\w+)[ \t]*'
+    br'(?::[ \t]*(?P<parent>\w+)[ \t]*)?\)[ \t]*(?P<submodule>\w+)'
+    br'|use\b(?P<nature>[ \t]*,[ \t]*(?:non_)?intrinsic)?[ \t]*(?:::)?[ \t]*'
+    br'(?P<use>\w+))',
+    re.IGNORECASE | re.MULTILINE)
+
+# A file scanned: the module files it provides and requires, and the
+# sha256 digest of its contents.
+Scan = collections.namedtuple('Scan', 'provides requires digest')
+
+
+def ScanSource(data):
+  """Return the module files the code provides and requires.
+
+  Arguments:
+    data : (bytes) The code, as it is in its file.
+
+  Returns:
+    Tuple of (provides, requires), frozensets of names of module files.
+  """
+  provides = set()
+  requires = set()
+  for match in _STATEMENT.finditer(data):
+    module = match.group('module')
+    if module:
+      name = module.decode('ascii').lower()
+      provides.add(name + '.mod')
+      provides.add(name + '.smod')
+      continue
+    submodule = match.group('submodule')
+    if submodule:
+      ancestor = match.group('ancestor').decode('ascii').lower()
+      parent = match.group('parent')
+      requires.add(ancestor + '@' + parent.decode('ascii').lower() + '.smod'
+                   if parent else ancestor + '.smod')
+      provides.add(ancestor + '@' + submodule.decode('ascii').lower()
+                   + '.smod')
+      continue
+    nature = match.group('nature')
+    if not nature or b'non_' in nature.lower():
+      requires.add(match.group('use').decode('ascii').lower() + '.mod')
+  # a module using itself, as far as the scan can tell, e.g. in a comment
+  return frozenset(provides), frozenset(requires - provides)
+
+
+def ScanFile(filename):
+  """Return the Scan of a file.
+
+  Raises:
+    IOError: If the file cannot be read.
+  """
+  with open(filename, 'rb') as fd:
+    data = fd.read()
+  provides, requires = ScanSource(data)
+  return Scan(provides, requires, hashlib.sha256(data).hexdigest())
+
+
+class DependencyGraph(object):
+  """The files of a tree and which of them depend on which.
+
+  Attributes:
+    files        : (list of unicode) The files, in the order given.
+    scans        : (dict) The Scan of every file.
+    dependencies : (dict) The files every file depends on, in the order of
+                   files.
+    dependents   : (dict) The files depending on every file, in the order of
+                   files.
+  """
+
+  def __init__(self, scans):
+    """Build the graph of the files of scans, an ordered dict of their Scans.
+
+    A module file provided by more than one file is taken from the first.
+    """
+    self.files = list(scans)
+    self.scans = scans
+    providers = {}
+    for filename in self.files:
+      for provided in scans[filename].provides:
+        providers.setdefault(provided, filename)
+    self.providers = providers
+
+    self.dependencies = dict((filename, []) for filename in self.files)
+    self.dependents = dict((filename, []) for filename in self.files)
+    for filename in self.files:
+      seen = set()
+      for required in sorted(scans[filename].requires):
+        provider = providers.get(required)
+        if provider is not None and provider != filename \
+            and provider not in seen:
+          seen.add(provider)
+          self.dependencies[filename].append(provider)
+          self.dependents[provider].append(filename)
+    self._order = dict((filename, i)
+                       for i, filename in enumerate(self.files))
+    for edges in (self.dependencies, self.dependents):
+      for filename in self.files:
+        edges[filename].sort(key=self._order.get)
+
+  @classmethod
+  def FromFiles(cls, filenames, jobs=1):
+    """Scan files, jobs at a time, and build their graph.
+
+    A file that cannot be read provides and requires nothing, and has an
+    empty digest; whoever reads it next gets to report why.
+    """
+    filenames = list(collections.OrderedDict.fromkeys(filenames))
+    if jobs <= 1 or len(filenames) <= 1:
+      scans = map(_ScanOrEmpty, filenames)
+    else:
+      from concurrent import futures
+      with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        scans = list(executor.map(_ScanOrEmpty, filenames))
+    return cls(collections.OrderedDict(zip(filenames, scans)))
+
+  def Waves(self):
+    """Return the files in waves, lists of files depending only on files of
+    earlier waves, in the order of files within a wave.
+
+    Files in a cycle of dependencies, and those depending on them, cannot be
+    ordered; they make up the last wave.
+    """
+    waiting = dict((filename, len(self.dependencies[filename]))
+                   for filename in self.files)
+    wave = [filename for filename in self.files if not waiting[filename]]
+    waves = []
+    ordered = 0
+    while wave:
+      waves.append(wave)
+      ordered += len(wave)
+      ready = set()
+      for filename in wave:
+        for dependent in self.dependents[filename]:
+          waiting[dependent] -= 1
+          if not waiting[dependent]:
+            ready.add(dependent)
+      wave = sorted(ready, key=self._order.get)
+    if ordered < len(self.files):
+      waves.append([filename for filename in self.files if waiting[filename]])
+    return waves
+
+  def Keys(self, waves=None):
+    """Return a digest of every file and all files it depends on.
+
+    The key of a file changes with its contents and with the key of any file
+    it depends on, so a change to one file changes the keys of that file and
+    of the files depending on it, directly or not, and of no other files.
+
+    Arguments:
+      waves : (list of lists) The Waves(), if at hand already.
+    """
+    keys = {}
+    for wave in waves or self.Waves():
+      for filename in wave:
+        key = hashlib.sha256(self.scans[filename].digest.encode('ascii'))
+        for dependency in self.dependencies[filename]:
+          # within a cycle, the keys of the files later in it are not known
+          key.update(keys.get(dependency, self.scans[dependency].digest)
+                     .encode('ascii'))
+        keys[filename] = key.hexdigest()
+    return keys
+
+
+def _ScanOrEmpty(filename):
+  try:
+    return ScanFile(filename)
+  except (IOError, OSError):
+    return Scan(frozenset(), frozenset(), '')
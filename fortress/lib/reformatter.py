@@ -1,8 +1,4 @@
 """ Reformat a FORMAT source file
-
-TODO:
-  Check for freeform vs. fixedform code
-  
 """
 
 __date__ = "$Date: 2016/02/17 $"
@@ -12,125 +8,631 @@ __authors__ = [
     "Roland Siegbert <r@rscircus.org>"
 ]
 
+import collections
+import itertools
+import operator
 import sys
 import re
 
+from fortress.lib import block_index
+from fortress.lib import line_lexer
+from fortress.lib import source_form
 from fortress.lib import unwrapped_line
 from fortress.lib import fortress_style
 
 
+_FIXED_COMMENT_CHARS = frozenset("cC*!")
+
+_DIGITS = re.compile(r"\d*")
+
+
+def SplitLines(source):
+    """Split source code into lines; the final line break ends the last one."""
+    sourceLines = source.split("\n")
+    if len(sourceLines) > 1 and not len(sourceLines[-1]):
+        sourceLines.pop()
+    return sourceLines
+
+
+def MergeRanges(lines):
+    """Return the line ranges sorted, with overlapping ones merged."""
+    merged = []
+    for start, end in sorted(lines):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# The line length above which a remark is added, if the style adds remarks.
+_ALLOWED_LINE_LENGTH = 100
+
+
+class StylePlan(collections.namedtuple('StylePlan', [
+        'isFreeForm', 'sourceForm', 'tabLength', 'unindentPreProc',
+        'fixLineEndings', 'linePasses', 'reindent', 'indentWidth',
+        'contiIndentWidth', 'allowedLength'])):
+    """A style compiled into what the passes need to know of it.
+
+    isFreeForm is the form the style implies, which sourceForm, one of
+    source_form.FORMS, may leave to detection. linePasses holds the names of
+    the methods each codeLine is passed through in turn, only those the style
+    enables; allowedLength is None if long lines are not marked.
+    """
+
+    __slots__ = ()
+
+
+def CompileStyle(style=None):
+    """Return the StylePlan of a style dict, by default the global style."""
+    get = style.__getitem__ if style is not None else fortress_style.Get
+    linePasses = []
+    if get('CONVERT_FIXED_TO_FREE'):
+        linePasses.append('convertFixedToFree')
+    if get('ADD_SPACES_AROUND_OPERATORS'):
+        linePasses.append('addSpacesInCode')
+    linePasses.append('addOptAmpersandToCont')
+    try:
+        sourceForm = get('SOURCE_FORM')
+    except KeyError:
+        # styles made before the setting existed
+        sourceForm = source_form.AUTO
+    return StylePlan(
+        isFreeForm=not get('CONVERT_FIXED_TO_FREE'),
+        sourceForm=sourceForm,
+        tabLength=get('INDENT_WIDTH') if get('REPLACE_TABS_BY_SPACES') else 0,
+        unindentPreProc=get('UNINDENT_PREPROCESSOR_DIRECTIVES'),
+        fixLineEndings=get('FIX_LINE_ENDINGS'),
+        linePasses=tuple(linePasses),
+        reindent=get('REINDENT'),
+        indentWidth=get('INDENT_WIDTH'),
+        contiIndentWidth=get('CONTI_INDENT_WIDTH'),
+        allowedLength=_ALLOWED_LINE_LENGTH if get('ADD_REMARKS') else None)
+
+
+def ResolveForm(head, filename=None, plan=None):
+    """Return the source_form.Form to read code in.
+
+    This is where the form is resolved for every entry point, and for the
+    result cache, so that they all agree on it.
+
+    Args:
+      head (unicode): the code, or at least its first source_form.HEAD_SIZE
+        characters
+      filename (unicode): the name of the file of the code, if any
+      plan (StylePlan): the compiled style, by default the global style
+    """
+    plan = plan or CompileStyle()
+    return source_form.Resolve(
+        head, filename, plan.sourceForm,
+        source_form.FREE if plan.isFreeForm else source_form.FIXED)
+
+
 class Reformatter:
-    """Class that represents a Fortran source code reformatting"""
+    """Class that represents a Fortran source code reformatting
+
+    The passes over the code lines are generators that look at one line at a
+    time, holding back only the few lines they still need. The methods working
+    on self.codeLines run them over the whole source, while iterCodeLines()
+    chains them to stream lines through with little memory.
+
+    The style is compiled into a StylePlan once, so that the passes it does
+    not enable are left out of the chain rather than skipped line by line.
+    Tokenizing and identifying continuations come first, as the continuations
+    of a fixed-form line are only known from the lines after it; the passes
+    over single lines and reindenting then run in one loop, and long lines
+    are marked while rendering, which builds every line once.
+
+    The form of the code is resolved by detectForm() from its first lines,
+    unless the style sets it. Fixed-form code is only reformatted if the style
+    converts it to free-form; otherwise it is passed through as it is, so that
+    neither tabs are replaced, nor preprocessor directives unindented, nor
+    the code reindented.
+
+    Given ranges of lines to format, iterRenderedLines() runs the passes
+    over each range from the indentation and continuation state a prescan
+    of the lines before it leaves, which only tokenizes the lines that may
+    change the state. Lines outside the ranges, but for the few around them
+    that carry the state into the ranges, are copied through as text.
+    """
 
-    def __init__(self, unwrapped_source=None, lines=None):
+    def __init__(self, unwrapped_source=None, lines=None, plan=None,
+                 filename=None):
         """Function to read the source code from a file."""
 
         # do initializations
+        self.plan = plan = plan or CompileStyle()
+        self.filename = filename
+        self.form = None
         self.codeLines = []
-        self.isFreeForm = not fortress_style.Get('CONVERT_FIXED_TO_FREE')
-
-        if fortress_style.Get('FIX_LINE_ENDINGS'):
+        self.sourceLines = []
+        self.changedLines = {}
+        self.blockIndex = None
+        # the plan the line passes were made for, and the passes
+        self._linePasses = (None, ())
+        self.lines = MergeRanges(lines) if lines else None
+        self.isFreeForm = plan.isFreeForm
+        self.tabLength = plan.tabLength
+        self.unindentPreProc = plan.unindentPreProc
+
+        if unwrapped_source is None:
+            return
+
+        if plan.fixLineEndings:
             unwrapped_source.replace(r"\r\n", r"\n") # Windows
             unwrapped_source.replace(r"\r", r"\n")   # Mac OS
 
-        lineno = 0
-        # tokenize and clean up already
-        for line in unwrapped_source.split("\n"):
-            lineno += 1
-
-            # Collect lines in containers
-            cLine = unwrapped_line.UnwrappedLine(line, self.isFreeForm)
-
-            # Handle line numbers
-            cLine.lineNo = lineno
-            if lines:
-                if (lineno < lines[0][0]) or (lines[0][1] < lineno):
-                    cLine.enabled = False
+        sourceLines = self.detectForm(SplitLines(unwrapped_source))
 
-            # Replace tabs with spaces (args: amount of spaces)
-            if fortress_style.Get('REPLACE_TABS_BY_SPACES'):
-                cLine.replaceTabsBySpaces(fortress_style.Get('INDENT_WIDTH'))
-            cLine.tokenize()
-
-            # Unindent #PREPROC
-            if fortress_style.Get('UNINDENT_PREPROCESSOR_DIRECTIVES'):
-                cLine.unindentPreProc()
-
-            self.codeLines.append(cLine)
+        # tokenize and clean up already
+        if self.passesThrough():
+            self.codeLines = list(self._iterSkimmedLines(sourceLines))
+        else:
+            self.codeLines = list(self.iterTokenize(sourceLines))
 
         self.identifyContinuations()
 
-    def reformat(self):
-        for codeLine in self.codeLines:
-            if fortress_style.Get('CONVERT_FIXED_TO_FREE'):
-                codeLine.convertFixedToFree()
-            if fortress_style.Get('ADD_SPACES_AROUND_OPERATORS'):
-                codeLine.addSpacesInCode()
-            codeLine.addOptAmpersandToCont()
+    def iterTokenize(self, sourceLines):
+        """Generate tokenized codeLines from lines of source code."""
+        lineno = 0
+        for line in sourceLines:
+            lineno += 1
+            yield self.tokenizeLine(line, lineno)
+
+    def tokenizeLine(self, line, lineno):
+        """Return the tokenized codeLine of a line of source code."""
+        # Collect lines in containers
+        cLine = unwrapped_line.UnwrappedLine(line, self.isFreeForm)
+
+        # Handle line numbers
+        cLine.lineNo = lineno
+        if self.lines and not self.inRanges(lineno):
+            cLine.enabled = False
+
+        # Replace tabs with spaces (args: amount of spaces)
+        if self.tabLength:
+            cLine.replaceTabsBySpaces(self.tabLength)
+        cLine.tokenize()
+
+        # Unindent #PREPROC
+        if self.unindentPreProc:
+            cLine.unindentPreProc()
+
+        return cLine
+
+    def inRanges(self, lineno):
+        """Return True if lineno is in one of the ranges to format."""
+        for start, end in self.lines:
+            if lineno < start:
+                return False
+            if lineno <= end:
+                return True
+        return False
+
+    def detectForm(self, sourceLines):
+        """Set self.form and self.isFreeForm from the first lines of code.
+
+        Only the first source_form.HEAD_SIZE characters or so are read, and
+        none if the style sets the form.
+
+        Returns:
+          An iterable of all lines of source code, those read included.
+        """
+        head = []
+        if self.plan.sourceForm == source_form.AUTO:
+            sourceLines = iter(sourceLines)
+            size = 0
+            for line in sourceLines:
+                head.append(line)
+                size += len(line) + 1
+                if size >= source_form.HEAD_SIZE:
+                    break
+        self.form = ResolveForm("\n".join(head), self.filename, self.plan)
+        self.isFreeForm = self.form.form == source_form.FREE
+        return itertools.chain(head, sourceLines)
+
+    def passesThrough(self):
+        """Return True if the code is left as it is, being fixed-form code
+        the style does not convert; see detectForm()."""
+        return not self.isFreeForm \
+            and "convertFixedToFree" not in self.plan.linePasses
+
+    def iterCodeLines(self, sourceLines):
+        """Generate the reformatted codeLines from lines of source code.
+
+        Only a small window of lines is held at any time: in fixed-form the
+        lines from one line with code to the next, otherwise a single line.
+        Lines outside the ranges to format are made codeLines as well, which
+        iterRenderedLines() avoids.
+        """
+        sourceLines = self.detectForm(sourceLines)
+        if self.passesThrough():
+            return self._iterSkimmedLines(sourceLines)
+        return self.iterReformat(
+            self.iterContinuations(self.iterTokenize(sourceLines)))
+
+    def iterRenderedLines(self, sourceLines):
+        """Generate the lines of source code with their reformatted text.
+
+        The passes are those of iterCodeLines(), but the lines outside the
+        ranges to format are copied through as text, so formatting a few
+        lines of a large file takes little more than reading it.
+
+        Returns:
+          An iterator of (line, text) pairs, text being the line as it is
+          rendered, with its line break.
+        """
+        sourceLines = self.detectForm(sourceLines)
+        if self.passesThrough():
+            return _iterCopiedLines(enumerate(sourceLines, 1))
+        if self.lines:
+            return self._iterRangeRenderedLines(sourceLines)
+        return self._iterRendered(self.iterReformat(
+            self.iterContinuations(self.iterTokenize(sourceLines))))
+
+    def _iterRendered(self, codeLines):
+        renderLine = self.renderLine
+        for codeLine in codeLines:
+            yield codeLine.origLine, renderLine(codeLine)
+
+    def _iterSkimmedLines(self, sourceLines):
+        for lineno, line in enumerate(sourceLines, 1):
+            yield _SkimmedLine(line, lineno, False)
+
+    def _iterRangeRenderedLines(self, sourceLines):
+        """Generate the rendered lines given ranges; see iterRenderedLines().
+
+        The passes run over one range at a time, from the state a prescan of
+        the lines before it leaves: the block index and, in free-form, the
+        continuation state. Only the lines of the range, and the few around
+        it that carry the state, are made codeLines.
+        """
+        numberedLines = enumerate(sourceLines, 1)
+        renderLine = self.renderLine
+        index = block_index.BlockIndex()
+        ranges = collections.deque(self.lines)
+        state = _NOT_IN_CONTINUATION
+        # the lines after a range read by its passes, to be prescanned
+        ahead = []
+        blockLines = {}
+        while ranges:
+            held = []
+            state = yield from self._iterPrescan(
+                itertools.chain(ahead, numberedLines), ranges[0][0], index,
+                state, held, blockLines)
+            ahead = []
+            for codeLine in self.iterReformat(self.iterContinuations(
+                    self._iterRangeTokenize(
+                        itertools.chain(held, numberedLines), ranges, ahead),
+                    state), index):
+                # the stand-in for the first line ahead
+                if ahead and codeLine.lineNo == ahead[0][0]:
+                    continue
+                if self.isFreeForm:
+                    state = _FollowContinuation(
+                        state, codeLine.hasCode(), codeLine.isContinued,
+                        codeLine.isTightContinued, codeLine.isStringContinued)
+                yield codeLine.origLine, renderLine(codeLine)
+        yield from _iterCopiedLines(itertools.chain(ahead, numberedLines))
+
+    def _iterPrescan(self, numberedLines, stop, index, state, held,
+                     blockLines):
+        """Return a generator of the lines before line stop, rendered as they
+        are, which returns the continuation state at the lines left in held.
+
+        The lines with code that may change the indentation are added to
+        index, as iterFixIndentation() would after the line passes; no other
+        line is tokenized. As the same lines open and close blocks over and
+        over, what a line adds to index is kept in blockLines, by the line
+        and the state it depends on, so that it is tokenized once. The line
+        stop is left in held, as a (lineno, line) pair, for the passes to
+        start from.
+
+        Args:
+          state: the continuation state at the first line, as
+            iterContinuations() takes it
+        """
+        if self.isFreeForm:
+            return self._iterFreePrescan(numberedLines, stop, index, state,
+                                         held, blockLines)
+        return self._iterFixedPrescan(numberedLines, stop, index, held,
+                                      blockLines)
+
+    def _iterFreePrescan(self, numberedLines, stop, index, state, held,
+                         blockLines):
+        """Prescan free-form lines; see _iterPrescan().
+
+        After a line with code but without '&' nothing is continued, so the
+        lines with '&' after it are only lexed once the state is needed.
+        """
+        reindent = self.plan.reindent
+        # the lines with '&' after state, not lexed yet
+        trail = []
+        for lineno, line in numberedLines:
+            if lineno >= stop:
+                held.append((lineno, line))
+                break
+            yield line, line.rstrip() + "\n"
+            if line[:1] == "#":
+                # a preprocessor directive, without code
+                continue
+            if not reindent or not unwrapped_line.MayChangeIndentation(line):
+                if "&" not in line:
+                    hasCode = self._skimHasCode(line)
+                elif "!" in line or line.rstrip()[-1:] == "&":
+                    # the line may be continued
+                    trail.append(line)
+                    continue
+                else:
+                    # something follows the last '&', which is code
+                    hasCode = True
+                if hasCode:
+                    state = _NOT_IN_CONTINUATION
+                    del trail[:]
+                continue
+
+            state = _FollowContinuations(state, trail)
+            del trail[:]
+            # the blanks around the code only count where tabs are replaced
+            key = (line if "\t" in line else line.strip(), state[0])
+            try:
+                hasCode, flags, blockLine = blockLines[key]
+            except KeyError:
+                codeLine = self.tokenizeLine(line, lineno)
+                hasCode = codeLine.hasCode()
+                if hasCode and state[0]:
+                    codeLine.isContinuation = True
+                flags = (codeLine.isContinued, codeLine.isTightContinued,
+                         codeLine.isStringContinued)
+                blockLine = self._blockLine(codeLine)
+                blockLines[key] = hasCode, flags, blockLine
+            state = _FollowContinuation(state, hasCode, *flags)
+            if blockLine is not None:
+                index.Add(blockLine)
+        return _FollowContinuations(state, trail)
+
+    def _iterFixedPrescan(self, numberedLines, stop, index, held, blockLines):
+        """Prescan fixed-form lines; see _iterPrescan().
+
+        Whether a line is continued is only known once the next line with
+        code is read, so the last line with code and the lines after it are
+        left in held as well. The prescan starts at the first line of the
+        code or at a line with code, so it has no state to start from.
+        """
+        reindent = self.plan.reindent
+        inConti = inTightConti = False
+        # the last line with code, if it may change the indentation
+        lastCodeLine = None
+        for lineno, line in numberedLines:
+            if lineno >= stop:
+                held.append((lineno, line))
+                break
+            if "&" in line:
+                if self.tabLength and "\t" in line:
+                    # tabs move the columns
+                    codeLine = self.tokenizeLine(line, lineno)
+                    hasCode = codeLine.hasCode()
+                    isContinuation = codeLine.isContinuation
+                    leftSpace = codeLine.leftSpace
+                else:
+                    hasCode, flags = _LexContinuation(line, False)
+                    isContinuation = flags[0]
+                    leftSpace = flags[4]
+                if isContinuation:
+                    inConti = True
+                    if not len(leftSpace):
+                        inTightConti = True
+            else:
+                hasCode = self._skimHasCode(line)
+                if hasCode is None:
+                    hasCode = self.tokenizeLine(line, lineno).hasCode()
+            if not hasCode:
+                if held:
+                    held.append((lineno, line))
+                else:
+                    yield line, line.rstrip() + "\n"
+                continue
+            # the last line with code is settled
+            if lastCodeLine is not None:
+                # tightness only changes the continuation marks
+                key = (lastCodeLine[1], inConti)
+                try:
+                    blockLine = blockLines[key]
+                except KeyError:
+                    codeLine = self.tokenizeLine(lastCodeLine[1],
+                                                 lastCodeLine[0])
+                    if inConti:
+                        self._markContinued(codeLine, inTightConti)
+                    blockLine = blockLines[key] = self._blockLine(codeLine)
+                if blockLine is not None:
+                    index.Add(blockLine)
+            for _, heldLine in held:
+                yield heldLine, heldLine.rstrip() + "\n"
+            del held[:]
+            held.append((lineno, line))
+            if reindent and unwrapped_line.MayChangeIndentation(line):
+                lastCodeLine = lineno, line
+            else:
+                lastCodeLine = None
+            inConti = inTightConti = False
+        return None
+
+    def _blockLine(self, codeLine):
+        """Return what index.Add() needs of a codeLine in the prescan.
+
+        The codeLine is passed through the line passes first. Unless it may
+        be a function statement, whose kind depends on the blocks around it,
+        it is stood in for by a _BlockLine, or by None if it changes nothing.
+        """
+        for name in self.plan.linePasses:
+            getattr(codeLine, name)()
+        if "function" in codeLine.code.lower():
+            return codeLine
+        decreases = codeLine.decreasesIndentBefore()
+        kind = codeLine.identifyIndentation(())
+        if decreases or kind:
+            return _BlockLine(decreases, kind)
+        return None
+
+    def _iterRangeTokenize(self, numberedLines, ranges, ahead):
+        """Generate the codeLines of the first of ranges, which is taken off.
+
+        The lines before the range are those the prescan held. After the
+        range, the lines up to the next line with code are needed still, as
+        in fixed-form they tell whether the last line of the range is
+        continued; if the next range starts before, it is taken off and
+        generated as well. The next line is then left in ahead, as a
+        (lineno, line) pair, for the next prescan, and a _SkimmedLine stands
+        in for it: it takes the remark on remaining indentation off the last
+        line formatted, and in fixed-form tells whether it is a
+        continuation.
+        """
+        start, end = ranges.popleft()
+        for lineno, line in numberedLines:
+            if ranges and lineno == ranges[0][0]:
+                start, end = ranges.popleft()
+            if lineno < start:
+                yield self._skimLine(line, lineno)
+            elif lineno <= end:
+                yield self.tokenizeLine(line, lineno)
+            elif self.isFreeForm:
+                ahead.append((lineno, line))
+                yield _SkimmedLine(line, lineno, False)
+                return
+            else:
+                codeLine = self._skimLine(line, lineno)
+                if not codeLine.hasCode():
+                    yield codeLine
+                    continue
+                ahead.append((lineno, line))
+                lookahead = _SkimmedLine(line, lineno, True)
+                lookahead.isContinuation = codeLine.isContinuation
+                lookahead.leftSpace = codeLine.leftSpace
+                yield lookahead
+                return
+
+    def _skimLine(self, line, lineno):
+        """Return the codeLine of a line outside of the ranges: tokenized if
+        it may change the state the passes carry, else skimmed."""
+        if "&" not in line \
+                and not unwrapped_line.MayChangeIndentation(line):
+            hasCode = self._skimHasCode(line)
+            if hasCode is not None:
+                return _SkimmedLine(line, lineno, hasCode)
+        return self.tokenizeLine(line, lineno)
+
+    def _skimHasCode(self, line):
+        """Tell whether a line without '&' has code, without tokenizing it.
+
+        Returns:
+          True or False, or None if the line has to be tokenized to tell.
+        """
+        stripped = line.strip()
+        if not stripped or line[0] == "#":
+            return False
+        if self.isFreeForm:
+            return stripped[0] != "!"
+        if line[0] in _FIXED_COMMENT_CHARS or stripped[0] == "!":
+            return False
+        if stripped[0].isdigit():
+            # code after the digits is code whether they are a label or not
+            rest = stripped[_DIGITS.match(stripped).end():].lstrip()
+            if not rest or rest[0] == "!":
+                return None
+        return True
 
+    def reformat(self):
+        for _ in self.iterReformat(self.codeLines):
+            pass
+
+    def iterReformat(self, codeLines, index=None):
+        """Generate the codeLines reformatted according to the style.
+
+        index is the block_index.BlockIndex of the lines before codeLines,
+        if any; see iterFixIndentation().
+        """
+        plan = self.plan
+        # made once for all sources formatted by the same plan
+        if self._linePasses[0] is not plan:
+            self._linePasses = (plan, tuple(operator.methodcaller(name)
+                                            for name in plan.linePasses))
+        linePasses = self._linePasses[1]
         # Reindents the code(block):
-        if fortress_style.Get('REINDENT'):
-            self.fixIndentation(fortress_style.Get('INDENT_WIDTH'), fortress_style.Get('CONTI_INDENT_WIDTH'))
-        if fortress_style.Get('ADD_REMARKS'):
-            self.markLongLines(100)
-
+        if plan.reindent:
+            return self.iterFixIndentation(
+                codeLines, plan.indentWidth, plan.contiIndentWidth, linePasses,
+                index)
+        return self._iterLinePasses(codeLines, linePasses)
+
+    def _iterLinePasses(self, codeLines, linePasses):
+        for codeLine in codeLines:
+            for linePass in linePasses:
+                linePass(codeLine)
+            yield codeLine
 
     def fixIndentation(self, indent, contiIndent):
+        """Change the indentation of all codeLines; see iterFixIndentation."""
+        for _ in self.iterFixIndentation(self.codeLines, indent, contiIndent):
+            pass
+
+    def iterFixIndentation(self, codeLines, indent, contiIndent,
+                           linePasses=(), index=None):
         """Change the indentation of a codeLine.
 
     Note:
-        This makes sense in free-form code only.
+        This makes sense in free-form code only. The last line is held back
+        until it is known to be the last one.
 
     Args:
       indent (int): new indent length
+      linePasses (tuple): functions to pass each codeLine through first
+      index (BlockIndex): the index of the lines before codeLines, to go on
+        from; by default codeLines are the first lines
 
     """
-        curIndent = 0
-        indents = []
-        for codeLine in self.codeLines:
-            if codeLine.decreasesIndentBefore():
-                curIndent -= 1
-                if len(indents) > 0:
-                    indents.pop()
-            if curIndent < 0:
+        if index is None:
+            index = block_index.BlockIndex()
+        self.blockIndex = index
+        lastLine = None
+        indentString = indent*" "
+        contiIndentString = contiIndent*" "
+        for codeLine in codeLines:
+            if lastLine is not None:
+                yield lastLine
+            lastLine = codeLine
+
+            for linePass in linePasses:
+                linePass(codeLine)
+            curIndent = index.Add(codeLine)
+            if index.ClosesNothing(len(index)):
                 codeLine.remarks.append("Negative indentation level reached.")
-                curIndent = 0
-
-            codeLine.setIndentation(curIndent, indent*" ")
-            codeLine.leftSpace += (contiIndent*" " if codeLine.isContinuation else "")
-
-            lineIndent = codeLine.identifyIndentation(indents)
-            if lineIndent != False:
-                curIndent += 1
-                indents += [lineIndent]
 
+            codeLine.setIndentation(curIndent, indentString, contiIndentString)
             codeLine.preserveCommentPosition()
 
-        # back at zero indentation?
-        if curIndent > 0:
-            self.codeLines[-1].remarks.append("Positive indentation level remaining.")
-
-    def markLongLines(self, allowedLength):
-        """Mark lines above allowedLength.
-
-    Note:
-      Has to be called at the end.
-
-    """
-        for codeLine in self.codeLines:
-            if codeLine.getLength() > allowedLength:
-                codeLine.remarks.append("Line above is longer than " + str(allowedLength) \
-                                        + " characters.")
+        # back at zero indentation? The blocks may be opened in lines that
+        # were prescanned only, if no line follows.
+        if lastLine is not None:
+            if index.Unclosed():
+                lastLine.remarks.append("Positive indentation level remaining.")
+            yield lastLine
 
     def identifyContinuations(self):
+        """Identify continuated lines; see iterContinuations."""
+        for _ in self.iterContinuations(self.codeLines):
+            pass
+
+    def iterContinuations(self, codeLines, state=None):
         """Identify continuated lines.
 
         In free-form, continued lines may not be marked as such.
         Therefore, we have to ensure that every 'continued' line
         is followed by a 'continuation'.
 
-        In fixed-form, we need to walk through the file backwards
-        to identify 'continued' lines.
+        In fixed-form, a line is continued if a continuation follows
+        before the next line with code. Lines are therefore held back
+        until the next line with code is read.
 
     Note:
       Call before stripping whitespace and indent fix.
@@ -138,13 +640,14 @@ class Reformatter:
     Definitions:
       isContinued means there exists an & at the end of a line
       isContinuation means there exists an & at the beginning of a line
+
+    In free-form, state may carry over whether the lines before codeLines
+    are continued, as (inConti, inTightConti, inStringConti).
     """
 
         if self.isFreeForm:
-            inConti = False
-            inTightConti = False
-            inStringConti = False
-            for codeLine in self.codeLines:
+            inConti, inTightConti, inStringConti = state or (False,) * 3
+            for codeLine in codeLines:
                 # is it a code line and is it after a continued line?
                 if codeLine.hasCode() and inConti:
                     codeLine.isContinuation = True
@@ -168,20 +671,15 @@ class Reformatter:
                     if codeLine.isStringContinued:
                         inStringConti = True
 
+                yield codeLine
+
         else: # fixed form
+          # the last line with code and the lines read after it
+          lastCodeLine = None
+          heldLines = []
           inConti = False
           inTightConti = False
-          for codeLine in reversed(self.codeLines):
-              # is it a code line and is it followed by continuation?
-              if codeLine.hasCode() and inConti:
-                  codeLine.isContinued = True
-                  # is it a 'tight' continuation?
-                  if inTightConti and not len(codeLine.commentSpace) \
-                          and len(codeLine.rightSpace) == 1:
-                      codeLine.isTightContinued = True
-                  inConti = False
-                  inTightConti = False
-
+          for codeLine in codeLines:
               # check if line is continuation
               if codeLine.isContinuation:
                   inConti = True
@@ -190,13 +688,211 @@ class Reformatter:
                       codeLine.isTightContinuation = True
                       inTightConti = True
 
+              # is it a code line, so the last one is settled?
+              if codeLine.hasCode():
+                  if lastCodeLine is not None and inConti:
+                      self._markContinued(lastCodeLine, inTightConti)
+                  for heldLine in heldLines:
+                      yield heldLine
+                  heldLines = []
+                  lastCodeLine = codeLine
+                  inConti = False
+                  inTightConti = False
+
+              heldLines.append(codeLine)
+
+          if lastCodeLine is not None and inConti:
+              self._markContinued(lastCodeLine, inTightConti)
+          for heldLine in heldLines:
+              yield heldLine
+
+    def _markContinued(self, codeLine, inTightConti):
+        """Mark a fixed-form line with code as followed by a continuation."""
+        codeLine.isContinued = True
+        # is it a 'tight' continuation?
+        if inTightConti and not len(codeLine.commentSpace) \
+                and len(codeLine.rightSpace) == 1:
+            codeLine.isTightContinued = True
+
+    def renderLine(self, cLine):
+        """Return the text of a codeLine, including its line break.
+
+        A line longer than the style allows is marked as it is rendered.
+        """
+        if cLine.enabled:
+            return cLine.rebuild(self.plan.allowedLength) + "\n"
+        else:
+            return cLine.origLine.rstrip() + "\n"
 
     def generateCodeLines(self):
-        """Generate a string from the codelines"""
-        output = ""
-        for cLine in self.codeLines:
-            if cLine.enabled:
-                output += cLine.rebuild().rstrip() + "\n"
-            else:
-                output += cLine.origLine.rstrip() +"\n"
-        return output
+        """Generate a string from the codelines
+
+        The original lines are kept in self.sourceLines, and those that
+        differ from their rendered text are recorded in self.changedLines,
+        which maps their indexes to the text, so that diffs need not compare
+        the whole code again.
+        """
+        return self._render(self._iterRendered(self.codeLines))
+
+    def formatLines(self, sourceLines):
+        """Return the code of lines of source code, reformatted.
+
+        Unlike reformat() and generateCodeLines(), this runs all passes in a
+        single traversal of the lines; self.sourceLines and self.changedLines
+        are filled as by generateCodeLines(), while self.codeLines is not.
+        """
+        return self._render(self.iterRenderedLines(sourceLines))
+
+    def _render(self, renderedLines):
+        changedLines = {}
+        self.sourceLines = sourceLines = []
+        output = []
+        index = 0
+        for line, text in renderedLines:
+            if text[:-1] != line:
+                changedLines[index] = text
+            output.append(text)
+            sourceLines.append(line)
+            index += 1
+        self.changedLines = changedLines
+        return "".join(output)
+
+
+# The free-form continuation state of iterContinuations() after a line with
+# code that is not continued.
+_NOT_IN_CONTINUATION = (False, False, False)
+
+
+def _FollowContinuation(state, hasCode, isContinued, isTightContinued,
+                        isStringContinued):
+    """Return the free-form continuation state after a line, given the
+    state before it, as iterContinuations() follows it."""
+    inConti, inTightConti, inStringConti = state
+    if hasCode and inConti:
+        inConti = inTightConti = inStringConti = False
+    if isContinued:
+        return True, inTightConti or isTightContinued, \
+            inStringConti or isStringContinued
+    return inConti, inTightConti, inStringConti
+
+
+def _FollowContinuations(state, lines):
+    """Return the free-form continuation state after lines with '&'; see
+    _FollowContinuation()."""
+    for line in lines:
+        hasCode, flags = _LexContinuation(line, True)
+        state = _FollowContinuation(state, hasCode, *flags[1:4])
+    return state
+
+
+def _iterCopiedLines(numberedLines):
+    """Generate (line, text) pairs of lines rendered as they are; see
+    Reformatter.renderLine()."""
+    for _, line in numberedLines:
+        yield line, line.rstrip() + "\n"
+
+
+def _LexContinuation(line, isFreeForm):
+    """Tell whether a line has code, and how it is continued, by lexing it.
+
+    This sets nothing up for the passes, so it is cheaper than tokenizing,
+    but reads the line as UnwrappedLine.tokenize() does; tabs must be
+    replaced already if they are replaced at all.
+
+    Returns:
+      Tuple of (hasCode, flags), flags being isContinuation, isContinued,
+      isTightContinued, isStringContinued and leftSpace.
+    """
+    hasCode = isContinuation = openString = False
+    continuationEnd = leftSpace = ""
+    for kind, text in line_lexer.Lex(line, isFreeForm):
+        if kind == line_lexer.CODE:
+            hasCode = True
+        elif kind == line_lexer.OPEN_STRING:
+            hasCode = openString = True
+        elif kind == line_lexer.CONTINUATION:
+            isContinuation = True
+        elif kind == line_lexer.CONTINUATION_END:
+            continuationEnd = text
+        elif kind == line_lexer.LEADING_SPACE:
+            leftSpace = text
+    isContinued = bool(continuationEnd)
+    return hasCode, (isContinuation, isContinued, len(continuationEnd) == 1,
+                     isContinued and openString, leftSpace)
+
+
+class _BlockLine(object):
+    """Stand-in for a line with code in the prescan, as the block index sees
+    it; see Reformatter._blockLine()."""
+
+    __slots__ = ("decreases", "kind")
+
+    def __init__(self, decreases, kind):
+        self.decreases = decreases
+        self.kind = kind
+
+    def decreasesIndentBefore(self):
+        return self.decreases
+
+    def identifyIndentation(self, indents):
+        return self.kind
+
+
+class _SkimmedLine(object):
+    """Stand-in for a line outside of the ranges to format.
+
+    It is only used for lines that neither change the indentation nor mark
+    continuations, so it takes part in the passes without being tokenized;
+    the passes may still mark it as continued or as a continuation. It is
+    rendered as it is.
+    """
+
+    __slots__ = ("origLine", "lineNo", "_hasCode", "leftSpace",
+                 "isContinued", "isContinuation",
+                 "isTightContinued", "isTightContinuation",
+                 "isStringContinued", "isStringContinuation")
+
+    enabled = False
+    isFreeForm = False
+    commentSpace = ""
+    rightSpace = ""
+
+    def __init__(self, line, lineNo, hasCode):
+        self.origLine = line
+        self.lineNo = lineNo
+        self._hasCode = hasCode
+        self.leftSpace = ""
+        self.isContinued = False
+        self.isContinuation = False
+        self.isTightContinued = False
+        self.isTightContinuation = False
+        self.isStringContinued = False
+        self.isStringContinuation = False
+
+    @property
+    def remarks(self):
+        return []
+
+    def hasCode(self):
+        return self._hasCode
+
+    def decreasesIndentBefore(self):
+        return False
+
+    def identifyIndentation(self, indents):
+        return False
+
+    def convertFixedToFree(self):
+        pass
+
+    def addSpacesInCode(self):
+        pass
+
+    def addOptAmpersandToCont(self):
+        pass
+
+    def setIndentation(self, level, indent, contiIndent=""):
+        pass
+
+    def preserveCommentPosition(self):
+        pass
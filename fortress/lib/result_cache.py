@@ -0,0 +1,229 @@
+"""Persistent cache of files that are known to be formatted.
+
+A file that FORTRESS left unchanged does not need to be read, tokenized and
+diffed again as long as neither the file, the style nor FORTRESS itself
+changed. This module remembers such files on disk:
+
+  * stat entries map a file's path to its (mtime, size, inode), so that an
+    untouched file is recognized without reading it at all.
+  * content entries map a hash of the source and of the form it is read in
+    to "already formatted", so that a file that was only touched (or copied)
+    is recognized without building a Reformatter. The same code may be
+    formatted in one form and not in the other, which the extension of the
+    file or the --form option may decide.
+
+Both kinds of entries are keyed together with the resolved style dict and the
+FORTRESS version, so changing either of them invalidates the cache. The
+diagnostics of the linter are kept alongside, keyed by the linter. Entries
+are written atomically and the least recently used ones are evicted once the
+cache grows above its size limit.
+"""
+
+import errno
+import hashlib
+import json
+import os
+
+from fortress.lib import fortress_style
+
+# Default upper limit for the size of all entries together.
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+
+
+def DefaultCacheDir():
+  """Return the per-user cache directory of FORTRESS."""
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+      os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'fortress')
+
+
+class ResultCache(object):
+  """On-disk cache of files that FORTRESS left unchanged.
+
+  The cache only holds plain attributes, so it can be handed to worker
+  processes.
+  """
+
+  def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+    self.cache_dir = cache_dir or DefaultCacheDir()
+    self.max_size = max_size
+
+  def LookupFile(self, filename):
+    """Check whether filename is unchanged since it was last found formatted.
+
+    Only the file's stat information is compared, the file is not read.
+
+    Arguments:
+      filename: (unicode) The name of the file.
+
+    Returns:
+      The encoding of the file if it is known to be formatted, None otherwise.
+    """
+    try:
+      stat = os.stat(filename)
+      entry = self._EntryPath('s', self._FileKey(filename))
+      with open(entry, 'r') as fd:
+        record = json.load(fd)
+    except (IOError, OSError, ValueError):
+      return None
+
+    if record.get('stat') != _StatSignature(stat):
+      return None
+    self._Touch(entry)
+    return record.get('encoding')
+
+  def LookupSource(self, source, filename=None):
+    """Return True if source is known to be formatted already.
+
+    Arguments:
+      source   : (unicode) The code.
+      filename : (unicode) The name of the file of the code, which may tell
+                 its form.
+    """
+    entry = self._EntryPath('c', self._SourceKey(source, filename))
+    if not os.path.exists(entry):
+      return False
+    self._Touch(entry)
+    return True
+
+  def Record(self, filename, source, encoding, stat=None):
+    """Remember that filename with the given source is formatted.
+
+    Arguments:
+      filename : (unicode) The name of the file.
+      source   : (unicode) The contents of the file.
+      encoding : (unicode) The encoding of the file.
+      stat     : (os.stat_result) The stat of the file taken before source was
+                 read. A file changing in between is then noticed next time.
+    """
+    try:
+      if stat is None:
+        stat = os.stat(filename)
+      self._Write(self._EntryPath('c', self._SourceKey(source, filename)), '')
+      self._Write(self._EntryPath('s', self._FileKey(filename)),
+                  json.dumps({'stat': _StatSignature(stat),
+                              'encoding': encoding}))
+    except (IOError, OSError):
+      # The cache is an optimization only; never fail formatting because of it.
+      pass
+
+  def LookupDiagnostics(self, key):
+    """Return the diagnostics recorded under key, or None.
+
+    Unlike the other entries, these are keyed by the linter; see
+    fortress_linter.
+    """
+    entry = self._EntryPath('l', key)
+    try:
+      with open(entry, 'r') as fd:
+        records = json.load(fd)
+    except (IOError, OSError, ValueError):
+      return None
+    self._Touch(entry)
+    return records
+
+  def RecordDiagnostics(self, key, records):
+    """Remember the diagnostics of a file, a list of JSON values, under key."""
+    try:
+      self._Write(self._EntryPath('l', key), json.dumps(records))
+    except (IOError, OSError):
+      pass
+
+  def Prune(self):
+    """Evict the least recently used entries above the size limit.
+
+    Returns:
+      The number of evicted entries.
+    """
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(self.cache_dir):
+      for name in filenames:
+        path = os.path.join(dirpath, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        # Empty entries still cost an inode, so count them a little.
+        size = max(stat.st_size, 64)
+        entries.append((stat.st_mtime, size, path))
+        total += size
+
+    evicted = 0
+    entries.sort()
+    for _, size, path in entries:
+      if total <= self.max_size:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total -= size
+      evicted += 1
+    return evicted
+
+  def _FileKey(self, filename):
+    return self._Key('file', os.path.abspath(filename).encode('utf-8',
+                                                              'surrogateescape'))
+
+  def _SourceKey(self, source, filename):
+    from fortress.lib import reformatter
+    from fortress.lib import source_form
+
+    # the head as Reformatter.detectForm() joins it
+    head = source[:source_form.HEAD_SIZE]
+    if len(source) <= source_form.HEAD_SIZE and source.endswith('\n'):
+      head = source[:-1]
+    form = reformatter.ResolveForm(head, filename)
+    return self._Key('source/' + form.form,
+                     source.encode('utf-8', 'surrogateescape'))
+
+  def _Key(self, kind, data):
+    """Hash data together with the style and version it is valid for."""
+    import fortress
+
+    key = hashlib.sha256()
+    key.update(json.dumps([kind,
+                           fortress.__version__,
+                           fortress_style.GetGlobalStyle()],
+                          sort_keys=True).encode('utf-8'))
+    key.update(data)
+    return key.hexdigest()
+
+  def _EntryPath(self, kind, key):
+    return os.path.join(self.cache_dir, kind + key[:2], key[2:])
+
+  def _Touch(self, path):
+    """Mark an entry as recently used."""
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+
+  def _Write(self, path, contents):
+    """Atomically create or replace the entry at path."""
+    directory = os.path.dirname(path)
+    try:
+      os.makedirs(directory)
+    except OSError as err:
+      if err.errno != errno.EEXIST:
+        raise
+
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as tmp:
+        tmp.write(contents)
+      os.replace(tmp_path, path)
+    except BaseException:
+      try:
+        os.remove(tmp_path)
+      except OSError:
+        pass
+      raise
+
+
+def _StatSignature(stat):
+  """Return what identifies an unmodified file: (mtime, size, inode)."""
+  return [getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size,
+          stat.st_ino]
@@ -0,0 +1,90 @@
+"""Rewrite rules for the code of Fortran lines.
+
+A rule is a pattern and the replacement of what it matches, as they would be
+given to re.sub(). RewriteRules compiles all rules into a single pattern of
+alternatives, so that the code is scanned once whatever the number of rules,
+and replaces each match as the rule whose alternative matched says.
+
+As within one re.sub(), the rules see the code as it was: text one rule put
+in is not rewritten by another, and where more than one rule matches at the
+same place, the one listed first is applied. The string literals in the code
+are left as they are; they are found in one scan of the code as well.
+"""
+
+import collections
+import re
+
+# A rule: its name, for the reader, and the pattern and replacement as for
+# re.sub(). The replacement may refer to the groups of the pattern by number.
+Rule = collections.namedtuple('Rule', 'name pattern replacement')
+
+# A reference to a group in a replacement, \1 or \g<1>.
+_GROUP_REFERENCE = re.compile(r"\\(?:(\d+)|g<(\d+)>)")
+
+# A string literal, up to its closing quote or to the end of the code, where
+# the line lexer would find it.
+_STRING = re.compile(r""""(?:[^"\\]|\\.?)*"?|'(?:[^'\\]|\\.?)*'?""")
+
+
+class RewriteRules(object):
+  """Rules compiled to be applied in a single scan of the code."""
+
+  def __init__(self, rules, flags=re.IGNORECASE):
+    """Compile rules, the patterns of which are matched with flags.
+
+    Raises:
+      ValueError: If a pattern has named groups or a replacement refers to a
+        group its pattern does not have.
+    """
+    self.rules = tuple(rules)
+    self._templates = {}
+    alternatives = []
+    groups = 0
+    for rule in self.rules:
+      regex = re.compile(rule.pattern, flags)
+      if regex.groupindex:
+        raise ValueError('rule %s: named groups are not supported' % rule.name)
+
+      # The alternative is a group of its own; the groups of the pattern
+      # follow it.
+      group = groups + 1
+      self._templates[group] = _Renumber(rule, regex.groups, group)
+      alternatives.append('(%s)' % rule.pattern)
+      groups = group + regex.groups
+    self._regex = re.compile('|'.join(alternatives) or r'(?!)', flags)
+
+  def Search(self, code):
+    """Return True if any rule matches code, strings included."""
+    return self._regex.search(code) is not None
+
+  def Sub(self, code):
+    """Return code with the rules applied to all but its string literals."""
+    # most lines have nothing to change; the parts between the strings can
+    # only match where the whole code does
+    if not self._regex.search(code):
+      return code
+
+    parts = []
+    start = 0
+    for string in _STRING.finditer(code):
+      parts.append(self._regex.sub(self._Replace, code[start:string.start()]))
+      parts.append(string.group())
+      start = string.end()
+    parts.append(self._regex.sub(self._Replace, code[start:]))
+    return "".join(parts)
+
+  def _Replace(self, match):
+    # The group of the alternative is the outermost one, which lastindex
+    # gives as it closes last.
+    return match.expand(self._templates[match.lastindex])
+
+
+def _Renumber(rule, groups, group):
+  """Return the replacement of a rule referring to the groups of its pattern
+  as they are numbered after group, the group of its alternative."""
+  def renumber(reference):
+    number = int(reference.group(1) or reference.group(2))
+    if number > groups:
+      raise ValueError('rule %s: no group %d' % (rule.name, number))
+    return r'\g<%d>' % (group + number)
+  return _GROUP_REFERENCE.sub(renumber, rule.replacement)
@@ -0,0 +1,172 @@
+"""Splitting a run over several processes or nodes, and merging their reports.
+
+'fortress --shard I/N' formats the I-th of N shards of the files found. Every
+shard computes the same partition on its own, from the names and sizes of all
+files, so the shards need not talk to each other: the files are assigned
+largest first, each to the shard with the fewest bytes so far, ties going to
+the shard with the lower number and files of the same size taken in the
+order of their names. The order the files are found in does not matter.
+
+With '--report FILE' a shard writes what it found to FILE as JSON:
+
+  {"report": "fortress", "version": 1, "shard": [I, N], "status": 2,
+   "files": 120, "changed": ["a.f90", ...], "diffs": {"a.f90": "...", ...}}
+
+where status is the exit status of the shard and diffs are there with
+--diff. 'fortress merge-reports FILE...' checks that the reports of all N
+shards are there, prints their diffs in the order of the files, and exits
+with the status of the whole run.
+"""
+
+import heapq
+import json
+import os
+
+_REPORT = 'fortress'
+_VERSION = 1
+
+# What formatting a file costs in addition to its bytes, in bytes; it keeps
+# shards from getting all the small files.
+_FILE_COST = 4096
+
+
+class ReportError(Exception):
+  """Raised if reports cannot be read or do not make up a whole run."""
+
+
+def Shard(filenames, index, count):
+  """Return the files of a shard.
+
+  Arguments:
+    filenames : (iterable of unicode) All files of the run.
+    index     : (int) The shard, from 1 to count.
+    count     : (int) The number of shards.
+
+  Returns:
+    The list of the files of shard index, in the order of filenames.
+  """
+  filenames = list(filenames)
+  sizes = dict((filename, _FileSizeOrZero(filename))
+               for filename in filenames)
+  # the bytes of every shard so far, and the shard
+  loads = [(0, shard) for shard in range(1, count + 1)]
+  mine = set()
+  for filename in sorted(sizes, key=lambda filename: (-sizes[filename],
+                                                      filename)):
+    load, shard = heapq.heappop(loads)
+    if shard == index:
+      mine.add(filename)
+    heapq.heappush(loads, (load + sizes[filename] + _FILE_COST, shard))
+  return [filename for filename in filenames if filename in mine]
+
+
+class Report(object):
+  """What one shard found, to be merged with the reports of the others."""
+
+  def __init__(self, shard=(1, 1)):
+    self.shard = tuple(shard)
+    self.files = 0
+    self.changed = []
+    self.diffs = {}
+    self.status = 0
+
+  def Add(self, filename, changed, diff=None):
+    """Record a file formatted, and its diff if there is one."""
+    self.files += 1
+    if changed:
+      self.changed.append(filename)
+    if diff:
+      self.diffs[filename] = diff
+
+  def Write(self, filename):
+    """Write the report to filename, replacing it atomically, so that no
+    half-written report is ever merged."""
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as tmp:
+        json.dump({'report': _REPORT,
+                   'version': _VERSION,
+                   'shard': list(self.shard),
+                   'status': self.status,
+                   'files': self.files,
+                   'changed': self.changed,
+                   'diffs': self.diffs}, tmp, sort_keys=True)
+      os.replace(tmp_path, filename)
+    except BaseException:
+      try:
+        os.remove(tmp_path)
+      except OSError:
+        pass
+      raise
+
+  @classmethod
+  def Read(cls, filename):
+    """Read a report written by Write().
+
+    Raises:
+      ReportError: If the file cannot be read or is no report.
+    """
+    try:
+      with open(filename) as fd:
+        record = json.load(fd)
+    except (IOError, OSError, ValueError) as err:
+      raise ReportError('cannot read report %s: %s' % (filename, err))
+    if not isinstance(record, dict) or record.get('report') != _REPORT:
+      raise ReportError('%s is not a report of fortress' % filename)
+    if record.get('version') != _VERSION:
+      raise ReportError('%s is a report of another version of fortress'
+                        % filename)
+    report = cls(record['shard'])
+    report.status = record['status']
+    report.files = record['files']
+    report.changed = record['changed']
+    report.diffs = record['diffs']
+    return report
+
+
+def MergeReports(reports):
+  """Merge the reports of all shards of a run into one.
+
+  Arguments:
+    reports : (list of Report) One report per shard.
+
+  Returns:
+    A Report of the whole run, with the changed files in order; its status
+    is 1 if any shard failed, else 2 if any file changed, else 0.
+
+  Raises:
+    ReportError: If reports are missing, doubled or of different runs.
+  """
+  if not reports:
+    raise ReportError('no reports to merge')
+  count = reports[0].shard[1]
+  shards = sorted(report.shard[0] for report in reports)
+  if any(report.shard[1] != count for report in reports):
+    raise ReportError('reports of runs with different numbers of shards')
+  if shards != list(range(1, count + 1)):
+    missing = sorted(set(range(1, count + 1)) - set(shards))
+    if missing:
+      raise ReportError('missing the reports of shards %s of %d'
+                        % (', '.join(map(str, missing)), count))
+    raise ReportError('more than one report of a shard')
+
+  merged = Report((1, 1))
+  for report in reports:
+    merged.files += report.files
+    merged.changed.extend(report.changed)
+    merged.diffs.update(report.diffs)
+  merged.changed.sort()
+  statuses = [report.status for report in reports]
+  merged.status = 1 if 1 in statuses else max(statuses)
+  return merged
+
+
+def _FileSizeOrZero(filename):
+  """Return the size of filename in bytes, or 0 if it cannot be determined."""
+  try:
+    return os.path.getsize(filename)
+  except OSError:
+    return 0
@@ -0,0 +1,118 @@
+"""Detection of the source form of Fortran code, fixed or free.
+
+A tree of legacy code often mixes both forms, so the form is told apart per
+file from the column layout of its first lines rather than taken from the
+style. The lines are not parsed one by one: each layout below is counted
+with a single scan of the head of the code, so detection costs a handful of
+regular expression scans of a few KB whatever the size of the file.
+
+Fixed-form is told by comments with 'C' or '*' in column 1, labels in columns
+1-5 followed by code past column 6, and continuation marks in column 6.
+Free-form is told by code starting in columns 1-5 and lines continued with a
+trailing '&'.
+
+The confidence of the detection grows with the margin of the one form over
+the other and with the number of lines telling them apart. Where it is too
+low, the conventional file extensions decide, and failing those the form the
+style implies.
+"""
+
+import collections
+import os
+import re
+
+AUTO = 'auto'
+FIXED = 'fixed'
+FREE = 'free'
+
+# The values of the SOURCE_FORM style setting.
+FORMS = (AUTO, FIXED, FREE)
+
+# A detected form, FIXED or FREE or None if undecided, and the confidence of
+# the detection from 0.0 to 1.0.
+Form = collections.namedtuple('Form', 'form confidence')
+
+# How much of the code is looked at, in characters.
+HEAD_SIZE = 4096
+
+# Below this confidence, the detection is not relied on.
+MIN_CONFIDENCE = 0.5
+
+# The number of lines telling the forms apart for full confidence.
+_ENOUGH_LINES = 5
+
+_FIXED_EXTENSIONS = frozenset(['.f', '.for', '.ftn', '.f77', '.fpp'])
+_FREE_EXTENSIONS = frozenset(['.f90', '.f95', '.f03', '.f08', '.f18'])
+
+# 'C' or '*' in column 1, not followed by what would make it free-form code
+# like 'call' or 'c = 1'.
+_FIXED_COMMENT = re.compile(r"^[cC*](?!\w| *[=(%])", re.M)
+
+# A label in columns 1-5, column 6 blank and code after it.
+_FIXED_LABEL = re.compile(r"^(?= *\d)[ \d]{5} +\S", re.M)
+
+# A continuation mark in column 6 other than '&', which free-form code may
+# have there as well.
+_FIXED_CONTINUATION = re.compile(r"^ {5}(?:[1-9]|[^\s\w0!&])", re.M)
+
+# '&' in column 6; in free-form code it follows a line ending in '&'.
+_AMPERSAND_IN_COLUMN_6 = re.compile(r"^ {5}&", re.M)
+
+# A name starting in columns 1-5, but for a 'c' in column 1 that may start a
+# comment.
+_FREE_CODE = re.compile(r"^(?:[abd-zABD-Z_]| {1,4}[a-zA-Z_])", re.M)
+
+# A trailing '&', possibly followed by a comment.
+_TRAILING_AMPERSAND = re.compile(r"&[ \t]*(?:![^\n]*)?$", re.M)
+
+
+def Detect(text):
+  """Detect the form of Fortran code from its first HEAD_SIZE characters.
+
+  Arguments:
+    text : (unicode) The code, or its head.
+
+  Returns:
+    A Form; its form is None if the lines do not tell.
+  """
+  head = text[:HEAD_SIZE]
+  trailing = len(_TRAILING_AMPERSAND.findall(head))
+  fixed = len(_FIXED_COMMENT.findall(head)) \
+      + len(_FIXED_LABEL.findall(head)) \
+      + len(_FIXED_CONTINUATION.findall(head)) \
+      + max(0, len(_AMPERSAND_IN_COLUMN_6.findall(head)) - trailing)
+  free = len(_FREE_CODE.findall(head)) + trailing
+
+  if fixed == free:
+    return Form(None, 0.0)
+  margin = float(abs(fixed - free)) / (fixed + free)
+  confidence = margin * min(1.0, float(fixed + free) / _ENOUGH_LINES)
+  return Form(FIXED if fixed > free else FREE, confidence)
+
+
+def Resolve(text, filename=None, override=AUTO, default=FREE):
+  """Return the form to read Fortran code in.
+
+  Arguments:
+    text     : (unicode) The code, or its head.
+    filename : (unicode) The name of the file of the code, if any.
+    override : (unicode) One of FORMS; FIXED or FREE is taken as it is.
+    default  : (unicode) The form if neither the code nor the filename tell.
+
+  Returns:
+    A Form, with the confidence of detecting it from the code; an override
+    has a confidence of 1.0.
+  """
+  if override != AUTO:
+    return Form(override, 1.0)
+
+  detected = Detect(text)
+  if detected.confidence >= MIN_CONFIDENCE:
+    return detected
+
+  extension = os.path.splitext(filename or '')[1].lower()
+  if extension in _FIXED_EXTENSIONS:
+    return Form(FIXED, detected.confidence)
+  if extension in _FREE_EXTENSIONS:
+    return Form(FREE, detected.confidence)
+  return Form(default, detected.confidence)
@@ -7,19 +7,74 @@ __authors__ = [
 
 import re
 
-class UnwrappedLine:
-  """Class that represents a Fortran source code line"""
+from fortress.lib import line_lexer
+from fortress.lib import rewrite_rules
+
+# Bits of UnwrappedLine._flags
+_FREE_FORM = 0x01
+_ENABLED = 0x02
+_CONTINUED = 0x04
+_CONTINUATION = 0x08
+_TIGHT_CONTINUED = 0x10
+_TIGHT_CONTINUATION = 0x20
+_STRING_CONTINUED = 0x40
+_STRING_CONTINUATION = 0x80
+
+
+def _Flag(mask, doc):
+  """Return a property for the bit mask of UnwrappedLine._flags."""
+  def getFlag(self):
+    return bool(self._flags & mask)
+
+  def setFlag(self, value):
+    if value:
+      self._flags |= mask
+    else:
+      self._flags &= ~mask
+
+  return property(getFlag, setFlag, doc=doc)
+
+
+class UnwrappedLine(object):
+  """Class that represents a Fortran source code line
+
+  A tree may have millions of lines held at once, so the representation is
+  kept compact: the attributes live in __slots__, the boolean properties are
+  bits of one integer, remarks are created on first use and blanks are shared
+  between lines instead of being copied for every line.
+  """
+
+  __slots__ = (
+    "_flags", "_remarks", "origLine", "origCodeLength", "line", "lineNo",
+    "preProc", "leftSpace", "code", "commentSpace", "comment", "rightSpace",
+    "fixedComment", "fixedLabel", "fixedCont",
+    "freeLabel", "freeContBeg", "freeContEnd")
+
+  isFreeForm = _Flag(_FREE_FORM, "Whether the line is free-form code.")
+  enabled = _Flag(_ENABLED, "Whether the line is to be reformatted.")
+
+  # line properties
+  isContinued = _Flag(_CONTINUED, "The line is continued.")
+  isContinuation = _Flag(_CONTINUATION, "The line is a continuation.")
+  isTightContinued = _Flag(_TIGHT_CONTINUED,
+                           "The line is continued without a blank.")
+  isTightContinuation = _Flag(_TIGHT_CONTINUATION,
+                              "The line is a continuation without a blank.")
+  isStringContinued = _Flag(_STRING_CONTINUED,
+                            "The line is continued within a string.")
+  isStringContinuation = _Flag(_STRING_CONTINUATION,
+                               "The line continues a string.")
 
   def __init__(self, line, isFreeForm):
     # initializations
-    self.isFreeForm = isFreeForm # TODO: Remove as this can be checked
-    self.remarks = []
+    # TODO: Remove isFreeForm as this can be checked
+    self._flags = _ENABLED | (_FREE_FORM if isFreeForm else 0)
+    self._remarks = None
     self.origLine = line
     self.origCodeLength = 0
 
     self.line = line
     self.lineNo = -1
-    self.enabled = True
 
     # line parts
     self.preProc = ""
@@ -39,13 +94,12 @@ class UnwrappedLine:
     self.freeContBeg = ""
     self.freeContEnd = ""
 
-    # line properties
-    self.isContinued = False
-    self.isContinuation = False
-    self.isTightContinued = False
-    self.isTightContinuation = False
-    self.isStringContinued = False
-    self.isStringContinuation = False
+  @property
+  def remarks(self):
+    """The list of remarks to add below the line."""
+    if self._remarks is None:
+      self._remarks = []
+    return self._remarks
 
   def replaceTabsBySpaces(self, tabLength):
     """Remove all tabs from line and replace by right amount of spaces.
@@ -71,96 +125,54 @@ class UnwrappedLine:
       The line is modified already by stripping away leading and trailing spaces.
 
     """
-    # first strip away any trailing whitespace
-    match = re.match(r"(.*?)(\s+)$", self.line)
-    if match:
-      self.rightSpace = match.group(2)
-      self.line = match.group(1)
-
-    # ignore empty lines
-    if not len(self.line):
-      return
-
-    # check for preprocessor lines
-    if self.line[0] == '#':
-      self.preProc = self.line
-      return
-
-    # some fixed-form checks
-    if not self.isFreeForm:
-      # check for comment symbol in first column
-      if self.line[0] in ['c', 'C', '*', '!']:
-        self.fixedComment = self.line
-        return
-
-      # check for label
-      match = re.match(r"\s{0,4}(\d+)(.*?)$", self.line)
-      if match:
-        self.fixedLabel = match.group(1)
-        self.line = match.group(2)
-      # otherwise check for continuation
-      #elif len(self.line) > 5 and self.line[0] != "\t" and self.line[5] not in [' ', '0']:
-      elif len(self.line) > 5 and self.line[5] == "&":
-        self.fixedCont = self.line[:6]
-        self.isContinuation = True
-        self.line = self.line[6:]
-
-    # strip away left whitespace
-    match = re.match(r"(\s+)(.*?)$", self.line)
-    if match:
-      self.leftSpace = match.group(1)
-      self.line = match.group(2)
-
-    # check for free comments
-    match = re.match(r"((?:[^!'\"]|\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*')*?)(\s*)(!.*?)$", \
-        self.line)
-    if match:
-      self.commentSpace = match.group(2)
-      self.comment = match.group(3)
-      self.line = match.group(1)
-
-    # free-form checks
-    if self.isFreeForm:
-      # check for free label
-      match = re.match(r"(\d+\s+)(.*?)$", self.line)
-      if match:
-        self.freeLabel = match.group(1)
-        self.line = match.group(2)
-
-      # Check for continuations
-      #
-      # TODO: tight (no spaces) freeContXXX > 1
-      # check for continuation start
-      match = re.match(r"(&\s*)(.*?)$", self.line)
-      if match:
-        self.freeContBeg = match.group(1)
-        self.isContinuation = True
-        self.line = match.group(2)
-        # tight?
-        if len(self.freeContBeg) == 1:
-          self.isTightContinuation = True
-
-      # check for continuation end
-      match = re.match(r"(.*?)(\s*&)$", self.line)
-      if match:
-        self.freeContEnd = match.group(2)
-        self.isContinued = True
-        self.line = match.group(1)
-        # tight?
-        if len(self.freeContEnd) == 1:
-          self.isTightContinued = True
+    fields = _FREE_FORM_FIELDS if self.isFreeForm else _FIXED_FORM_FIELDS
+    for kind, text in line_lexer.Lex(self.line, self.isFreeForm):
+      if kind == line_lexer.CODE:
+        self.code = text
+      elif kind == line_lexer.OPEN_STRING:
+        self.code += text
         # break within character string?
-        trans = self.replaceStrings(match.group(1))
-        if re.search(r"[\"']", trans):
-          self.isStringContinued = True
+        self.isStringContinued = True
+      elif kind in _SHARED_KINDS:
+        setattr(self, fields[kind], _Share(text))
+      else:
+        setattr(self, fields[kind], text)
+
+    if len(self.freeContBeg) or len(self.fixedCont):
+      self.isContinuation = True
+      # tight?
+      if len(self.freeContBeg) == 1:
+        self.isTightContinuation = True
+
+    if len(self.freeContEnd):
+      self.isContinued = True
+      # tight?
+      if len(self.freeContEnd) == 1:
+        self.isTightContinued = True
+    else:
+      self.isStringContinued = False
 
     # finished
-    self.code = self.line
     self.line = ""
 
     # record length of code in this line
     self.origCodeLength = len(self.code)
 
+  def codeTokens(self):
+    """Returns the tokens of the code.
+
+    The tokens of the code last asked for are kept, as the indentation passes
+    ask for the same line repeatedly. Keeping them with every line would
+    cost more memory than the line itself.
+    """
+    global _lastCodeTokens
+    code, tokens = _lastCodeTokens
+    if code is not self.code:
+      code = self.code
+      tokens = line_lexer.LexCode(code)
+      _lastCodeTokens = code, tokens
+    return tokens
+
   def hasCode(self):
     """Returns true if line has code."""
     if len(self.code):
@@ -202,12 +214,18 @@ class UnwrappedLine:
     if self.isContinued:
       self.freeContEnd = "&" if self.isTightContinued else " &"
 
-  def setIndentation(self, level, indent):
-    """Set correct multiple of indent to current line."""
+  def setIndentation(self, level, indent, contiIndent=""):
+    """Set correct multiple of indent to current line.
+
+    Continuations are indented by contiIndent in addition.
+    """
     if self.hasCode() or len(self.comment):
-      self.leftSpace = indent * level
+      leftSpace = _Indentation(level, indent)
     else:
-      self.leftSpace = ""
+      leftSpace = ""
+    if self.isContinuation and contiIndent:
+      leftSpace = _Share(leftSpace + contiIndent)
+    self.leftSpace = leftSpace
 
   def fixDeclarationsInCode(self):
     """Replaces real*8 with real(RK)"""
@@ -230,91 +248,11 @@ class UnwrappedLine:
       self.freeContEnd = " &"
 
 
-  def separateStrings(self):
-    """Separate code into statement and string parts."""
-
-    parts = []
-    curPart = ""
-    curQuotes = ""
-    escaped = False
-    for c in self.code:
-      # search for beginning of string
-      if len(curQuotes) == 0 and c in ["\"", "'"]:
-        curQuotes = c
-        parts += [curPart]
-        curPart = c
-      # search for string ending
-      elif len(curQuotes) > 0 and not escaped and c == curQuotes:
-        curQuotes = ""
-        curPart += c
-        parts += [curPart]
-        curPart = ""
-      else:
-        curPart += c
-      
-      escaped = (c == "\\")
-
-    parts += [curPart]
-
-    return parts
-
-
   def addSpacesInCode(self):
     """Enhances readability by adding spaces between various operators."""
-
-    parts = self.separateStrings()
-
-    # now you can go through all even-numbered parts
-    for i in range(0, len(parts), 2):
-      part = parts[i]
-
-      ### commas
-      #part = re.sub(r",(\S)", r", \1", part)
-
-      ### operator /
-      #if part.find("common") == -1:
-      #  part = re.sub(r"(/)(\S)", r"\1 \2", part)
-      #  part = re.sub(r"(\S)(/)", r"\1 \2", part)
-
-      ### operator * (only if it's not **)
-      #part = re.sub(r"((?:[^\*]|^)\*)([^\s\*])", r"\1 \2", part)
-      #part = re.sub(r"([^\s\*])(\*(?:[^\*]|$))", r"\1 \2", part)
-
-      ### operator -
-      ### (need to preserve scientific numbers, e-5 or E-4)
-      #part = re.sub(r"((?:^|[^eE])-)(\S)", r"\1 \2", part)
-      #part = re.sub(r"([^\seE])(-)", r"\1 \2", part)
-
-      ### operator +
-      ### (need to preserve scientific numbers, e+5 or E+4)
-      #part = re.sub(r"((?:^|[^eE])\+)(\S)", r"\1 \2", part)
-      #part = re.sub(r"([^\seE])(\+)", r"\1 \2", part)
-
-      ### operator =
-      #part = re.sub(r"(=)(\S)", r"\1 \2", part)
-      #part = re.sub(r"(\S)(=)", r"\1 \2", part)
-
-      # after 'if', 'where'
-      part = re.sub(r"(?i)\b(if|where)\(", r"\1 (", part)
-      # before 'then'
-      part = re.sub(r"(?i)\)then\b", r") then", part)
-
-      # 'endif', 'enddo', 'endwhile' -> 'end if', ...
-      part = re.sub(r"(?i)\bend(if|do|while)\b", r"end \1", part)
-      # 'elseif' -> 'else if'
-      part = re.sub(r"(?i)\belseif\b", r"else if", part)
-      # 'inout' -> 'in out'
-      part = re.sub(r"(?i)\binout\b", r"in out", part)
-
-      # '.eq.', ...
-      #part = re.sub(r"(?i)(\S)(\.(?:eq|ne|lt|gt|le|ge|and|or)\.)", r"\1 \2", part)
-      #part = re.sub(r"(?i)(\.(?:eq|ne|lt|gt|le|ge|and|or)\.)(\S)", r"\1 \2", part)
-# TODO: Replace with 'modern' rel. op.
-
-      parts[i] = part
-
-    # put parts back together
-    self.code = "".join(parts)
+    code = _SPACING_RULES.Sub(self.code)
+    if code != self.code:
+      self.code = code
 
   def replaceStrings(self, string):
     """Replace strings by a fictitious variable name"""
@@ -327,71 +265,80 @@ class UnwrappedLine:
     return string
 
   def identifyIndentation(self, indents):
-    """Identify level increasing indentation manipulators."""
-    trans = self.code
-
-    trans = self.replaceStrings(trans)
+    """Identify level increasing indentation manipulators.
 
-    # remove string beginnings in continued lines
-    if self.isContinued:
-      trans = re.sub(r"\"([^\"\\]|\\.)*$", r"str", trans)
-      trans = re.sub(r"'([^'\\]|\\.)*$", r"str", trans)
+    indents holds the kinds of the blocks open around the line; only
+    membership is tested on it.
+    """
+    tokens = self.codeTokens()
+    if not tokens:
+      return False
+    if tokens[-1][0] == line_lexer.OPEN_STRING and (not self.isContinued
+        or _EndsInEscape(tokens[-1][1])):
+      # This may well be the end of a string continued from the line before
+      tokens = _ReopenString(tokens)
+    isContinued = self.isContinued
+    first = _Keyword(tokens, 0, isContinued)
+    if first is not None and len(tokens) > 2 and tokens[1][0] == line_lexer.CODE:
+      gap = tokens[1][1]
+      second = _Keyword(tokens, 2, isContinued)
+    else:
+      gap = second = None
 
-        #or re.match(r"(?i)(\w+:\s*)?if\b.*?\bthen\b", self.code) \
-    if re.match(r"(?i)(\w+:\s*)?do\b", trans):
+    if first == "do" or (first and second == "do" and gap[0] == ":"
+                         and not gap[1:].strip()):
       return "do"
-    elif re.search(r"(?i)\bthen$", trans):
+    elif _Keyword(tokens, -1, isContinued) == "then":
       return "if"
-    elif re.match(r"(?i)program\b", trans):
+    elif first == "program":
       return "program"
-    elif re.match(r"(?i)subroutine\b", trans) \
-      or re.match(r"(?i)pure\s+subroutine\b", trans):
+    elif first == "subroutine" \
+      or (first == "pure" and second == "subroutine" and not gap.strip()):
       return "subroutine"
-    elif re.match(r"(?i)module\b", trans) \
-      and not re.match(r"(?i)module\s+procedure\b", trans):
+    elif first == "module" \
+      and not (second == "procedure" and not gap.strip()):
       return "module"
-    elif re.match(r"(?i)type\s*[^\s\(]", trans):
+    elif (_Name(tokens, 0) or "")[:4] == "type" and (len(tokens[0][1]) > 4 \
+      or (len(tokens) > 1 and tokens[1][1].lstrip()[:1] != "(")):
       return "type"
-    elif re.match(r"(?i)interface\b", trans):
+    elif first == "interface":
       return "interface"
-    elif re.match(r"(?i)block\s?data\b", trans):
+    elif first == "blockdata" \
+      or (first == "block" and second == "data" and len(gap) == 1
+          and gap.isspace()):
       return "blockdata"
-    elif re.match(r"(?i)select\b", trans):
+    elif first == "select":
       return "select"
-    elif re.match(r"(?i)case\b", trans):
+    elif first == "case":
       return "select"
-    elif re.match(r"(?i)else$", trans):
+    elif first == "else" and len(tokens) == 1:
       return "if"
-        #or re.match(r"(?i)else(if)?\b", self.code):
-    elif re.match(r"(?i)where\b", trans):
-      # now keep replacing innermost brackets using '!'
-      # (! cannot occur outside of strings)
-      while re.search(r"\([^\(\)]+\)", trans):
-        trans = re.sub(r"\([^\(\)]+\)", "!", trans)
-
-      # now if just one '!' remains, there was only one
-      # bracket term
-      if trans.count("!") == 1:
+    elif first == "where":
+      # If there is just one bracket term, it is a where block
+      if _CountBracketTerms(tokens) == 1:
         return "where"
     # also check for function statement
     # (ignore in continuation lines, it will probably
     # always appear in the first line)
-    elif re.match(r"(?i)contains$", trans):
+    elif first == "contains" and len(tokens) == 1:
       return "contains"
     elif not "subroutine" in indents and not "function" in indents \
       and not "program" in indents \
-      and re.search(r"(?i)\bfunction\b", trans) \
-      and not re.match(r"(?i)end\b", trans) \
-      and not self.isContinuation:
+      and first != "end" \
+      and not self.isContinuation \
+      and "function" in self.code.lower() \
+      and any(_Keyword(tokens, i, isContinued) == "function"
+              for i in range(len(tokens))):
       return "function"
     else:
       return False
 
   def decreasesIndentBefore(self):
     """Identify level decreasing indentation manipulators."""
-    if re.match(r"(?i)(end(if|do|where)?|else(if)?)\b", self.code) \
-        or re.match(r"(?i)case\b", self.code) \
-        or re.match(r"(?i)contains$", self.code):
+    tokens = self.codeTokens()
+    first = _Name(tokens, 0)
+    if first in _INDENT_DECREASING_KEYWORDS \
+        or (first == "contains" and len(tokens) == 1):
       return True
     else:
       return False
@@ -429,9 +376,234 @@ class UnwrappedLine:
     """Returns length of built line."""
     return len(self.buildFullLine()) - 1 # ignore line break
 
-  def rebuild(self):
-    """Returns file as string built from all CodeLines."""
-    output = self.buildFullLine()
-    for remark in self.remarks:
-      output += "! REMARK: " + remark + "\n"
+  def rebuild(self, allowedLength=None):
+    """Returns file as string built from all CodeLines.
+
+    The line is returned without its trailing space and line break, and is
+    followed by its remarks; a line longer than allowedLength, if given, is
+    remarked on as well.
+    """
+    output = self.buildFullLine().rstrip()
+    length = len(output)
+    for remark in self._remarks or ():
+      output += "\n! REMARK: " + remark
+    if allowedLength is not None and length > allowedLength:
+      output += "\n! REMARK: Line above is longer than " \
+                + str(allowedLength) + " characters."
     return output
+
+
+# Line parts the tokens of each kind are stored in.
+_FREE_FORM_FIELDS = {
+  line_lexer.PREPROCESSOR: "preProc",
+  line_lexer.LEADING_SPACE: "leftSpace",
+  line_lexer.LABEL: "freeLabel",
+  line_lexer.CONTINUATION: "freeContBeg",
+  line_lexer.CONTINUATION_END: "freeContEnd",
+  line_lexer.COMMENT_SPACE: "commentSpace",
+  line_lexer.COMMENT: "comment",
+  line_lexer.TRAILING_SPACE: "rightSpace",
+}
+
+_FIXED_FORM_FIELDS = dict(_FREE_FORM_FIELDS)
+_FIXED_FORM_FIELDS.update({
+  line_lexer.COMMENT_LINE: "fixedComment",
+  line_lexer.LABEL: "fixedLabel",
+  line_lexer.CONTINUATION: "fixedCont",
+})
+
+# Kinds of tokens that are blanks or continuation marks, and so are mostly
+# the same in every line.
+_SHARED_KINDS = frozenset([
+  line_lexer.LEADING_SPACE, line_lexer.CONTINUATION,
+  line_lexer.CONTINUATION_END, line_lexer.COMMENT_SPACE,
+  line_lexer.TRAILING_SPACE])
+
+# Strings up to this length are shared between lines.
+_MAX_SHARED_LENGTH = 80
+
+_sharedStrings = {}
+
+# The indentation strings by (level, indent), for levels below this one.
+_MAX_SHARED_LEVEL = 32
+
+_indentations = {}
+
+# The code last lexed by UnwrappedLine.codeTokens() and its tokens.
+_lastCodeTokens = (None, [])
+
+_STRINGS = frozenset([line_lexer.STRING])
+_STRINGS_OF_CONTINUED = frozenset([line_lexer.STRING, line_lexer.OPEN_STRING])
+
+_INDENT_DECREASING_KEYWORDS = frozenset([
+  "end", "endif", "enddo", "endwhere", "else", "elseif", "case"])
+
+# The first names of code that decreasesIndentBefore() and
+# identifyIndentation() look for, apart from "type..."
+_INDENT_CHANGING_NAMES = _INDENT_DECREASING_KEYWORDS | frozenset([
+  "do", "program", "subroutine", "pure", "module", "interface", "blockdata",
+  "block", "select", "where", "contains"])
+
+# What may come in front of the first name of the code of a line: blanks, a
+# label and a leading '&'.
+_LEADING_LABEL = re.compile(r"[\s\d]*(?:&\s*)?")
+
+# The first name of the code of a line and, in lower case, the names it may
+# start with to change the indentation.
+_FIRST_NAME = re.compile(r"\w+")
+_INDENT_CHANGING_PREFIXES = tuple(sorted(_INDENT_CHANGING_NAMES | {"type"}))
+
+# A named DO, in lower case.
+_NAMED_DO = re.compile(r"\w+:\s*do\b")
+
+# The rules of addSpacesInCode(), applied in one scan of the code.
+_SPACING_RULES = rewrite_rules.RewriteRules([
+  # after 'if', 'where'
+  rewrite_rules.Rule("if (", r"\b(if|where)\(", r"\1 ("),
+  # before 'then'
+  rewrite_rules.Rule(") then", r"\)then\b", r") then"),
+  # 'endif', 'enddo', 'endwhile' -> 'end if', ...
+  rewrite_rules.Rule("end if", r"\bend(if|do|while)\b", r"end \1"),
+  # 'elseif' -> 'else if'
+  rewrite_rules.Rule("else if", r"\belseif\b", r"else if"),
+  # 'inout' -> 'in out'
+  rewrite_rules.Rule("in out", r"\binout\b", r"in out"),
+
+  # Not enabled yet; those around operators must keep '**' together and
+  # the exponent of numbers like 1e-5 apart, and '/' in 'common' alone.
+  # rewrite_rules.Rule(", x", r",(\S)", r", \1"),
+  # rewrite_rules.Rule("/ x", r"(/)(\S)", r"\1 \2"),
+  # rewrite_rules.Rule("x /", r"(\S)(/)", r"\1 \2"),
+  # rewrite_rules.Rule("* x", r"((?:[^\*]|^)\*)([^\s\*])", r"\1 \2"),
+  # rewrite_rules.Rule("x *", r"([^\s\*])(\*(?:[^\*]|$))", r"\1 \2"),
+  # rewrite_rules.Rule("- x", r"((?:^|[^eE])-)(\S)", r"\1 \2"),
+  # rewrite_rules.Rule("x -", r"([^\seE])(-)", r"\1 \2"),
+  # rewrite_rules.Rule("+ x", r"((?:^|[^eE])\+)(\S)", r"\1 \2"),
+  # rewrite_rules.Rule("x +", r"([^\seE])(\+)", r"\1 \2"),
+  # rewrite_rules.Rule("= x", r"(=)(\S)", r"\1 \2"),
+  # rewrite_rules.Rule("x =", r"(\S)(=)", r"\1 \2"),
+  # rewrite_rules.Rule("x .eq.", r"(\S)(\.(?:eq|ne|lt|gt|le|ge|and|or)\.)", r"\1 \2"),
+  # rewrite_rules.Rule(".eq. x", r"(\.(?:eq|ne|lt|gt|le|ge|and|or)\.)(\S)", r"\1 \2"),
+  # TODO: Replace with 'modern' rel. op.
+])
+
+
+def MayChangeIndentation(line):
+  """Return False if a line of source code cannot change the indentation.
+
+  This is a quick check of the raw line, so that lines which surely neither
+  increase nor decrease the indentation need not be tokenized. The leading
+  '&' of a continuation is skipped, behind its label if it has one; whether
+  the line is continued or a continuation is not checked for.
+  """
+  lowered = line.lower()
+  if "then" in lowered or "function" in lowered:
+    return True
+  code = lowered.lstrip()
+  if code[:1].isdigit() or code[:1] == "&":
+    code = code[_LEADING_LABEL.match(code).end():]
+  if code.startswith(_INDENT_CHANGING_PREFIXES):
+    name = _FIRST_NAME.match(code).group()
+    return name in _INDENT_CHANGING_NAMES or name[:4] == "type"
+  return ":" in code and _NAMED_DO.match(code) is not None
+
+
+def _Share(text):
+  """Return a string equal to text, shared with other lines if short."""
+  if len(text) > _MAX_SHARED_LENGTH:
+    return text
+  return _sharedStrings.setdefault(text, text)
+
+
+def _Indentation(level, indent):
+  """Return indent repeated level times, shared with other lines."""
+  if level >= _MAX_SHARED_LEVEL:
+    return indent * level
+  key = (level, indent)
+  try:
+    return _indentations[key]
+  except KeyError:
+    return _indentations.setdefault(key, indent * level)
+
+
+def _Name(tokens, index):
+  """Return the lowercase name at tokens[index], or None."""
+  try:
+    kind, text = tokens[index]
+  except IndexError:
+    return None
+  return text.lower() if kind == line_lexer.NAME else None
+
+
+def _Keyword(tokens, index, isContinued):
+  """Return the lowercase name at tokens[index] if it stands alone, or None.
+
+  As string literals are treated like a name, a name directly next to one
+  does not count; neither does one next to an open string literal on a
+  continued line.
+  """
+  name = _Name(tokens, index)
+  if name is None:
+    return None
+  index %= len(tokens)
+  strings = _STRINGS_OF_CONTINUED if isContinued else _STRINGS
+  if (index and tokens[index - 1][0] in strings) \
+      or (index + 1 < len(tokens) and tokens[index + 1][0] in strings):
+    return None
+  return name
+
+
+def _ReopenString(tokens):
+  """Lex the text after the quote of an open string literal as code."""
+  tokens = list(tokens)
+  while tokens[-1][0] == line_lexer.OPEN_STRING:
+    text = tokens.pop()[1]
+    tokens.append((line_lexer.CODE, text[0]))
+    tokens.extend(line_lexer.LexCode(text[1:]))
+  return tokens
+
+
+def _EndsInEscape(text):
+  """Return True if text ends in a backslash that escapes nothing."""
+  return (len(text) - len(text.rstrip("\\"))) % 2 == 1
+
+
+def _CountBracketTerms(tokens):
+  """Count the bracket terms left after reducing closed, non-empty terms.
+
+  This is the number of '!' left after repeatedly replacing innermost
+  bracket terms with '!'. String literals count as contents of a term.
+  """
+  count = 0
+  # for each open bracket: [has contents (1), empty (0) or cannot be
+  # reduced (-1), number of reduced terms inside]
+  stack = []
+  for kind, text in tokens:
+    if kind != line_lexer.CODE:
+      if stack and not stack[-1][0]:
+        stack[-1][0] = 1
+      continue
+    for c in text:
+      if c == "(":
+        stack.append([0, 0])
+      elif c == "!":
+        # left from an open string; counts like a reduced term
+        if stack:
+          stack[-1][0] = stack[-1][0] or 1
+          stack[-1][1] += 1
+        else:
+          count += 1
+      elif c == ")" and stack:
+        reduced, inner = stack.pop()
+        terms = 1 if reduced == 1 else inner
+        if stack:
+          stack[-1][1] += terms
+          if reduced != 1:
+            stack[-1][0] = -1
+          elif not stack[-1][0]:
+            stack[-1][0] = 1
+        else:
+          count += terms
+      elif stack and not stack[-1][0]:
+        stack[-1][0] = 1
+  return count + sum(inner for _, inner in stack)
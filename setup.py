@@ -14,6 +14,7 @@ with codecs.open('README.md', 'r', 'utf-8') as fd:
         long_description=fd.read(),
         maintainer='F&R',
         packages=['fortress', 'fortress.lib'],
+        python_requires='>=3.7',
         classifiers=[
             'Development Status :: 2 - Beta',
             'Environment :: Console',
@@ -21,13 +22,13 @@ with codecs.open('README.md', 'r', 'utf-8') as fd:
             'License :: OSI Approved',
             'Operating System :: OS Independent',
             'Programming Language :: Python',
-            'Programming Language :: Python :: 2',
-            'Programming Language :: Python :: 2.6',
-            'Programming Language :: Python :: 2.7',
             'Programming Language :: Python :: 3',
-            'Programming Language :: Python :: 3.4',
-            'Programming Language :: Python :: 3.5',
+            'Programming Language :: Python :: 3 :: Only',
+            'Programming Language :: Python :: 3.7',
             'Topic :: Software Development :: Libraries :: Python Modules',
             'Topic :: Software Development :: Quality Assurance',
         ],
-        entry_points={'console_scripts': ['fortress = fortress:run_main'],})
+        entry_points={'console_scripts': [
+            'fortress = fortress:run_main',
+            'fortress-client = fortress.lib.format_client:run_main',
+        ],})
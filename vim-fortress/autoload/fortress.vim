@@ -10,10 +10,21 @@
 "    map <leader>ff :call fortress#format()<cr>
 "    imap <leader>ff :call fortress#format()<cr>
 "
+" If fortress-client is installed, the code is formatted by a 'fortress
+" --serve' daemon, which is started on first use and exits when idle. Set
+" g:fortress_use_server to 0 to always run the fortress command instead.
+"
+let g:fortress_use_server = get(g:, 'fortress_use_server', 1)
+
 function! fortress#format() range
   " Determine range to format.
   let l:line_ranges = a:firstline . '-' . a:lastline
-  let l:cmd = 'fortress -l ' . l:line_ranges . ' -s style.ini'
+  if g:fortress_use_server && executable('fortress-client')
+    " Falls back to formatting in-process if there is no daemon yet.
+    let l:cmd = 'fortress-client --spawn -l ' . l:line_ranges . ' -s style.ini'
+  else
+    let l:cmd = 'fortress -l ' . l:line_ranges . ' -s style.ini'
+  endif
 
   " Call fortress with the current buffer
   let l:formatted_text = system(l:cmd, join(getline(1, '$'), "\n") . "\n")